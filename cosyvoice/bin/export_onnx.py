@@ -28,7 +28,7 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../..'.format(ROOT_DIR))
 sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
-from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.file_utils import logging, export_estimator_onnx
 
 
 def get_dummy_input(batch_size, seq_len, out_channels, device):
@@ -92,7 +92,12 @@ def main():
         }
     )
 
-    # 2. test computation consistency
+    # 2. export estimator with dynamic batch size for onnxruntime, see CosyVoiceModel.load_onnx
+    export_estimator_onnx(estimator, '{}/flow.decoder.estimator.dynamic.fp32.onnx'.format(args.model_dir), False, device)
+    if hasattr(estimator, 'static_chunk_size'):
+        export_estimator_onnx(estimator, '{}/flow.decoder.estimator.dynamic.fp32.streaming.onnx'.format(args.model_dir), True, device)
+
+    # 3. test computation consistency
     option = onnxruntime.SessionOptions()
     option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
     option.intra_op_num_threads = 1
@@ -0,0 +1,109 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Chunk schedules decide how many new speech tokens each stream chunk vocodes.
+
+A small first chunk lowers time to first audio, larger later chunks cost less compute
+per second of speech. The model aligns every hop to its flow chunk size afterwards.
+"""
+import time
+from abc import ABC, abstractmethod
+
+
+class StageStats:
+    """Moving average of seconds per speech token of llm and token2wav on this node, shared by all sessions."""
+
+    def __init__(self, decay=0.9):
+        self.decay = decay
+        self.llm = None
+        self.token2wav = None
+
+    def update(self, stage, seconds, num_tokens=1):
+        # NOTE updated by many threads without lock, a lost update only delays the average a little
+        value = seconds / max(num_tokens, 1)
+        last = getattr(self, stage)
+        setattr(self, stage, value if last is None else self.decay * last + (1 - self.decay) * value)
+
+
+class ChunkSchedule(ABC):
+    """Token hop of each stream chunk of one session.
+
+    max_hop is the largest hop next_hop returns, the model sizes the token channel high water of the session with it.
+    """
+
+    def __init__(self, max_hop):
+        self.max_hop = max_hop
+
+    @abstractmethod
+    def next_hop(self, session, token_offset):
+        pass
+
+
+class GrowingSchedule(ChunkSchedule):
+    """Start with first_hop tokens, multiply by scale_factor after each chunk, up to max_hop tokens."""
+
+    def __init__(self, first_hop, max_hop, scale_factor=1):
+        assert scale_factor >= 1, 'scale_factor should be greater than 1'
+        super().__init__(max_hop if scale_factor > 1 else first_hop)
+        self.hop = first_hop
+        self.scale_factor = scale_factor
+
+    def next_hop(self, session, token_offset):
+        hop = self.hop
+        self.hop = min(self.max_hop, int(self.hop * self.scale_factor))
+        return hop
+
+
+class AdaptiveSchedule(ChunkSchedule):
+    """Start with first_hop tokens, then make each chunk as large as the client audio buffer allows.
+
+    The client is assumed to play audio as soon as the first chunk is yielded. The next chunk
+    must be ready before the audio already sent runs out, its cost is estimated from the measured
+    seconds per token of token2wav, plus llm while llm is still decoding.
+    """
+
+    def __init__(self, first_hop, min_hop, max_hop, stats, token_duration, margin=0.5):
+        super().__init__(max_hop)
+        self.first_hop = first_hop
+        self.min_hop = min_hop
+        self.stats = stats
+        # seconds of speech per token
+        self.token_duration = token_duration
+        # fraction of the buffered audio which the next chunk may spend
+        self.margin = margin
+
+    def next_hop(self, session, token_offset):
+        if token_offset == 0 or session.first_chunk_time is None or self.stats.token2wav is None:
+            return self.first_hop
+        buffered = token_offset * self.token_duration - (time.time() - session.first_chunk_time)
+        cost = self.stats.token2wav
+        # llm has to decode the tokens of next chunk too
+        if session.tokens.closed is False and self.stats.llm is not None:
+            cost += self.stats.llm
+        return max(self.min_hop, min(self.max_hop, int(buffered * self.margin / cost)))
+
+
+# name -> factory of a new schedule for one session of model, register custom schedules here
+CHUNK_SCHEDULES = {
+    # the default, first chunk of token_min_hop_len tokens and growing by model.stream_scale_factor
+    'fixed': lambda model: GrowingSchedule(model.token_min_hop_len, model.token_max_hop_len, model.stream_scale_factor),
+    'fast_start': lambda model: GrowingSchedule(model.token_first_hop_len, model.token_max_hop_len, 2),
+    'adaptive': lambda model: AdaptiveSchedule(model.token_first_hop_len, model.token_first_hop_len, model.token_max_hop_len,
+                                               model.stage_stats, 1 / model.flow.input_frame_rate),
+}
+
+
+def build_chunk_schedule(name, model):
+    if name not in CHUNK_SCHEDULES:
+        raise ValueError('unknown chunk schedule {}, choose from {}'.format(name, list(CHUNK_SCHEDULES.keys())))
+    return CHUNK_SCHEDULES[name](model)
@@ -13,6 +13,7 @@
 # limitations under the License.
 import os
 import time
+from collections import deque
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
@@ -20,16 +21,22 @@ from modelscope import snapshot_download
 import torch
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model
+from cosyvoice.cli.synthesis_cache import SynthesisCache
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.class_utils import get_model_type
 
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, lookahead=0, max_ahead_chunks=0, chunk_schedule='fixed',
+                 load_onnx=False, onnx_concurrent=1, synthesis_cache_mb=0, synthesis_cache_dir='', token_cache_size=0, prompt_cache_size=16,
+                 prompt_cache_dir='', prompt_cache_disk_size=1024, spk_store_dir='', spk_cache_size=64):
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
+        self.lookahead = lookahead
+        # speech of repeated utterances, see pipeline
+        self.synthesis_cache = SynthesisCache(synthesis_cache_mb * 1024 * 1024, synthesis_cache_dir) if synthesis_cache_mb > 0 else None
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice.yaml'.format(model_dir)
@@ -43,12 +50,19 @@ class CosyVoice:
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          prompt_cache_size=prompt_cache_size,
+                                          prompt_cache_dir=prompt_cache_dir,
+                                          prompt_cache_disk_size=prompt_cache_disk_size,
+                                          spk_store_dir=spk_store_dir,
+                                          spk_cache_size=spk_cache_size)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
         self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
+        self.model.max_ahead_chunks = max_ahead_chunks
+        self.model.chunk_schedule = chunk_schedule
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
@@ -61,6 +75,10 @@ class CosyVoice:
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        elif load_onnx:
+            self.model.load_onnx('{}/flow.decoder.estimator.dynamic.fp32.onnx'.format(model_dir), onnx_concurrent)
+        if token_cache_size > 0:
+            self.model.load_token_cache(token_cache_size)
         del configs
 
     def list_available_spks(self):
@@ -72,67 +90,131 @@ class CosyVoice:
         model_input = self.frontend.frontend_zero_shot('', prompt_text, prompt_speech_16k, self.sample_rate, '')
         del model_input['text']
         del model_input['text_len']
+        # NOTE speaker store appends the speaker to disk at once
         self.frontend.spk2info[zero_shot_spk_id] = model_input
         return True
 
+    def del_zero_shot_spk(self, zero_shot_spk_id):
+        if zero_shot_spk_id not in self.frontend.spk2info:
+            return False
+        del self.frontend.spk2info[zero_shot_spk_id]
+        return True
+
     def save_spkinfo(self):
-        torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
+        # add and delete are already written to speaker store, only sync them to disk
+        self.frontend.spk2info.flush()
+
+    def spk_cache_key(self, spk_id, *prompt):
+        """Speaker part of synthesis cache key, registered speaker spk_id, or prompt when spk_id is empty"""
+        if self.synthesis_cache is None:
+            return ()
+        if spk_id == '':
+            return prompt
+        # a speaker may be registered again under the same id, its embedding tells the entries apart
+        spk_info = self.frontend.spk2info[spk_id]
+        return (spk_id, spk_info['flow_embedding'] if 'flow_embedding' in spk_info else spk_info['embedding'])
+
+    def pipeline(self, texts, frontend, stream=False, speed=1.0, chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None, seed=None,
+                 cache_key=None):
+        """Synthesize text segments in order, llm of the next self.lookahead segments runs ahead while current segment is vocoded
+
+        chunk_schedule, n_timesteps (flow matching steps), solver (ode solver) and cfg_schedule (steps with classifier-free guidance)
+        override the model defaults for these segments. With seed, every segment draws from its own random streams seeded
+        by seed instead of the global rng, so the speech is reproducible under concurrent requests.
+        cache_key is the mode and speaker or prompt of the request, with the normalized texts and synthesis options it keys
+        the speech of the whole utterance in self.synthesis_cache. A hit streams the cached speech back in short chunks,
+        a miss is synthesized and cached after its last chunk, stream and non stream requests share entries.
+        """
+        options = {'chunk_schedule': chunk_schedule, 'n_timesteps': n_timesteps, 'solver': solver, 'cfg_schedule': cfg_schedule, 'seed': seed}
+        if self.synthesis_cache is None or cache_key is None or not all(isinstance(i, str) for i in texts):
+            yield from self.pipeline_segments(texts, frontend, stream, speed, options)
+            return
+        key = self.synthesis_cache.hash(self.model_dir, *cache_key, texts, speed, n_timesteps, solver, cfg_schedule, seed)
+        pcm = self.synthesis_cache.get(key)
+        if pcm is not None:
+            speech = torch.frombuffer(bytearray(pcm), dtype=torch.int16).float().unsqueeze(dim=0) / (2 ** 15)
+            # 0.2s chunks in stream mode, so that the client starts playing at once
+            chunk_len = int(0.2 * self.sample_rate) if stream is True else max(speech.shape[1], 1)
+            for i in range(0, speech.shape[1], chunk_len):
+                yield {'tts_speech': speech[:, i:i + chunk_len]}
+            return
+        speech = []
+        for model_output in self.pipeline_segments(texts, frontend, stream, speed, options):
+            speech.append(model_output['tts_speech'])
+            yield model_output
+        # NOTE only reached when every segment is synthesized, a closed generator never caches partial speech
+        speech = torch.concat(speech, dim=1) if len(speech) > 0 else torch.zeros(1, 0)
+        self.synthesis_cache.put(key, (speech * (2 ** 15)).clamp(-2 ** 15, 2 ** 15 - 1).to(torch.int16).numpy().tobytes())
+
+    def pipeline_segments(self, texts, frontend, stream, speed, options):
+        pending = deque()
+        try:
+            for i in tqdm(texts):
+                model_input = frontend(i)
+                session = self.model.start_tts(**model_input, stream=stream, **options) if self.lookahead > 0 else None
+                pending.append((i, model_input, session))
+                if len(pending) > self.lookahead:
+                    yield from self.synthesis(*pending.popleft(), stream=stream, speed=speed, **options)
+            while len(pending) > 0:
+                yield from self.synthesis(*pending.popleft(), stream=stream, speed=speed, **options)
+        finally:
+            # generator is closed before all segments are consumed, stop llm started ahead and release their sessions
+            for _, _, session in pending:
+                if session is not None:
+                    session.close()
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_sft(i, spk_id)
+    def synthesis(self, text, model_input, session=None, stream=False, speed=1.0, chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None,
+                  seed=None):
+        start_time = time.time()
+        logging.info('synthesis text {}'.format(text))
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, session=session, chunk_schedule=chunk_schedule,
+                                           n_timesteps=n_timesteps, solver=solver, cfg_schedule=cfg_schedule, seed=seed):
+            speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
+            logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+            yield model_output
             start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None,
+                      seed=None):
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.pipeline(texts, lambda i: self.frontend.frontend_sft(i, spk_id), stream, speed, chunk_schedule, n_timesteps, solver, cfg_schedule, seed,
+                                 cache_key=('sft', *self.spk_cache_key(spk_id)))
+
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True,
+                            chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None, seed=None):
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        for i in texts:
             if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
                 logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+        yield from self.pipeline(texts, lambda i: self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id),
+                                 stream, speed, chunk_schedule, n_timesteps, solver, cfg_schedule, seed,
+                                 cache_key=('zero_shot', *self.spk_cache_key(zero_shot_spk_id, prompt_text, prompt_speech_16k)))
+
+    def inference_cross_lingual(self, tts_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True,
+                                chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None, seed=None):
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.pipeline(texts, lambda i: self.frontend.frontend_cross_lingual(i, prompt_speech_16k, self.sample_rate, zero_shot_spk_id),
+                                 stream, speed, chunk_schedule, n_timesteps, solver, cfg_schedule, seed,
+                                 cache_key=('cross_lingual', *self.spk_cache_key(zero_shot_spk_id, prompt_speech_16k)))
+
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True,
+                           chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None, seed=None):
         assert isinstance(self.model, CosyVoiceModel), 'inference_instruct is only implemented for CosyVoice!'
         if self.instruct is False:
             raise ValueError('{} do not support instruct inference'.format(self.model_dir))
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
-
-    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0):
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.pipeline(texts, lambda i: self.frontend.frontend_instruct(i, spk_id, instruct_text), stream, speed, chunk_schedule, n_timesteps, solver,
+                                 cfg_schedule, seed,
+                                 cache_key=('instruct', instruct_text, *self.spk_cache_key(spk_id)))
+
+    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0, chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None,
+                     seed=None):
         model_input = self.frontend.frontend_vc(source_speech_16k, prompt_speech_16k, self.sample_rate)
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, chunk_schedule=chunk_schedule,
+                                           n_timesteps=n_timesteps, solver=solver, cfg_schedule=cfg_schedule, seed=seed):
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
@@ -141,10 +223,16 @@ class CosyVoice:
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1,
+                 max_batch_size=0, token2wav_batch_size=0, prefix_cache_mb=0, lookahead=0, max_ahead_chunks=0, chunk_schedule='fixed',
+                 load_onnx=False, onnx_concurrent=1, flow_prompt_cache_size=0, synthesis_cache_mb=0, synthesis_cache_dir='',
+                 token_cache_size=0, prompt_cache_size=16, prompt_cache_dir='', prompt_cache_disk_size=1024, spk_store_dir='', spk_cache_size=64):
         self.instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         self.fp16 = fp16
+        self.lookahead = lookahead
+        # speech of repeated utterances, see pipeline
+        self.synthesis_cache = SynthesisCache(synthesis_cache_mb * 1024 * 1024, synthesis_cache_dir) if synthesis_cache_mb > 0 else None
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice2.yaml'.format(model_dir)
@@ -158,17 +246,30 @@ class CosyVoice2(CosyVoice):
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v2.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          prompt_cache_size=prompt_cache_size,
+                                          prompt_cache_dir=prompt_cache_dir,
+                                          prompt_cache_disk_size=prompt_cache_disk_size,
+                                          spk_store_dir=spk_store_dir,
+                                          spk_cache_size=spk_cache_size)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
         self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
+        self.model.max_ahead_chunks = max_ahead_chunks
+        self.model.chunk_schedule = chunk_schedule
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
+        elif max_batch_size > 0:
+            self.model.load_scheduler(max_batch_size)
+        if token2wav_batch_size > 0:
+            self.model.load_token2wav_batcher(token2wav_batch_size)
+        if prefix_cache_mb > 0:
+            self.model.load_prefix_cache(prefix_cache_mb * 1024 * 1024)
         if load_jit:
             self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
@@ -176,19 +277,21 @@ class CosyVoice2(CosyVoice):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        elif load_onnx:
+            self.model.load_onnx('{}/flow.decoder.estimator.dynamic.fp32.onnx'.format(model_dir), onnx_concurrent)
+        if flow_prompt_cache_size > 0:
+            self.model.load_flow_prompt_cache(flow_prompt_cache_size)
+        if token_cache_size > 0:
+            self.model.load_token_cache(token_cache_size)
         del configs
 
     def inference_instruct(self, *args, **kwargs):
         raise NotImplementedError('inference_instruct is not implemented for CosyVoice2!')
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct2(self, tts_text, instruct_text, prompt_speech_16k, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True,
+                            chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None, seed=None):
         assert isinstance(self.model, CosyVoice2Model), 'inference_instruct2 is only implemented for CosyVoice2!'
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
-            model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id)
-            start_time = time.time()
-            logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
-                speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
-                logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
-                yield model_output
-                start_time = time.time()
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)
+        yield from self.pipeline(texts, lambda i: self.frontend.frontend_instruct2(i, instruct_text, prompt_speech_16k, self.sample_rate, zero_shot_spk_id),
+                                 stream, speed, chunk_schedule, n_timesteps, solver, cfg_schedule, seed,
+                                 cache_key=('instruct2', instruct_text, *self.spk_cache_key(zero_shot_spk_id, prompt_speech_16k)))
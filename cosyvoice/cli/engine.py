@@ -0,0 +1,145 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import concurrent.futures
+import queue
+import threading
+import time
+from cosyvoice.utils.file_utils import logging
+
+
+class EngineOverloaded(Exception):
+    """Request queue is full, the request is rejected without waiting."""
+
+
+class EngineUnavailable(Exception):
+    """Engine is closed, or the request waited in queue longer than max_queue_time."""
+
+
+class EngineRequest:
+
+    def __init__(self, func, args, kwargs, loop, output_queue_size):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.loop = loop
+        self.output_queue = asyncio.Queue(maxsize=output_queue_size)
+        self.submit_time = time.time()
+        self.cancelled = False
+
+
+class AsyncEngine:
+    """Run synchronous CosyVoice inference generators for asyncio servers.
+
+    At most max_active requests are synthesized at the same time, each by one worker thread.
+    Up to max_queue requests wait for a free worker, more requests are rejected with
+    EngineOverloaded, and requests which wait longer than max_queue_time fail with EngineUnavailable.
+    Outputs are passed through a bounded asyncio queue, so a worker pauses when its client is slow.
+    """
+
+    def __init__(self, max_active=4, max_queue=16, max_queue_time=10.0, output_queue_size=4):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+        self.output_queue_size = output_queue_size
+        self.request_queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self.lock = threading.Lock()
+        self.num_active = 0
+        self.num_rejected = 0
+        self.num_timeout = 0
+        self.workers = [threading.Thread(target=self.loop, daemon=True) for _ in range(max_active)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func(*args, **kwargs), which returns a generator of model outputs, return an async iterator of its outputs."""
+        if self.closed is True:
+            raise EngineUnavailable('engine is closed')
+        request = EngineRequest(func, args, kwargs, asyncio.get_running_loop(), self.output_queue_size)
+        try:
+            self.request_queue.put_nowait(request)
+        except queue.Full:
+            with self.lock:
+                self.num_rejected += 1
+            raise EngineOverloaded('{} requests are waiting'.format(self.max_queue))
+        return self.iterate(request)
+
+    async def iterate(self, request):
+        try:
+            while True:
+                output = await request.output_queue.get()
+                if output is None:
+                    break
+                if isinstance(output, Exception):
+                    raise output
+                yield output
+        finally:
+            # client is gone or iteration is done, stop the worker and unblock its pending put
+            request.cancelled = True
+            while request.output_queue.empty() is False:
+                request.output_queue.get_nowait()
+
+    def put(self, request, output):
+        """Put output to the asyncio queue of request, block while it is full, return False if the request is cancelled."""
+        future = asyncio.run_coroutine_threadsafe(request.output_queue.put(output), request.loop)
+        while True:
+            try:
+                future.result(timeout=1.0)
+                return True
+            except concurrent.futures.TimeoutError:
+                if request.cancelled is True:
+                    future.cancel()
+                    return False
+
+    def loop(self):
+        while True:
+            request = self.request_queue.get()
+            if request is None:
+                break
+            # client is gone while waiting in queue
+            if request.cancelled is True:
+                continue
+            if time.time() - request.submit_time > self.max_queue_time:
+                with self.lock:
+                    self.num_timeout += 1
+                self.put(request, EngineUnavailable('request waited more than {}s in queue'.format(self.max_queue_time)))
+                continue
+            with self.lock:
+                self.num_active += 1
+            generator = None
+            try:
+                generator = request.func(*request.args, **request.kwargs)
+                for output in generator:
+                    if request.cancelled is True or self.put(request, output) is False:
+                        break
+                else:
+                    self.put(request, None)
+            except Exception as e:
+                logging.error('engine request failed {}'.format(e))
+                self.put(request, e)
+            finally:
+                if generator is not None:
+                    generator.close()
+                with self.lock:
+                    self.num_active -= 1
+
+    def close(self):
+        self.closed = True
+        for _ in self.workers:
+            self.request_queue.put(None)
+
+    def stats(self):
+        with self.lock:
+            return {'active': self.num_active, 'queued': self.request_queue.qsize(), 'rejected': self.num_rejected, 'timeout': self.num_timeout}
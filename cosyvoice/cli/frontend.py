@@ -33,6 +33,8 @@ except ImportError:
     from wetext import Normalizer as EnNormalizer
     use_ttsfrd = False
 from cosyvoice.utils.file_utils import logging
+from cosyvoice.cli.prompt_cache import PromptCache
+from cosyvoice.cli.speaker_store import SpeakerStore
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
@@ -44,7 +46,12 @@ class CosyVoiceFrontEnd:
                  campplus_model: str,
                  speech_tokenizer_model: str,
                  spk2info: str = '',
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 prompt_cache_size: int = 16,
+                 prompt_cache_dir: str = '',
+                 prompt_cache_disk_size: int = 1024,
+                 spk_store_dir: str = '',
+                 spk_cache_size: int = 64):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -55,11 +62,19 @@ class CosyVoiceFrontEnd:
         self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
                                                                      providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
                                                                                 "CPUExecutionProvider"])
-        if os.path.exists(spk2info):
-            self.spk2info = torch.load(spk2info, map_location=self.device)
-        else:
-            self.spk2info = {}
+        # speakers are stored in spk_store_dir, by default the spk2info directory next to spk2info.pt, which is imported once,
+        # model dir is often read only, e.g. hub cache or container image, then speakers are only kept in memory
+        if spk_store_dir == '' and spk2info != '':
+            spk_store_dir = os.path.splitext(spk2info)[0]
+        if spk_store_dir != '' and not SpeakerStore.writable(spk_store_dir):
+            logging.warning('speaker store {} is not writable, keep speakers in memory'.format(spk_store_dir))
+            spk_store_dir = ''
+        self.spk2info = SpeakerStore(spk_store_dir, self.device, spk_cache_size)
+        if len(self.spk2info) == 0 and os.path.exists(spk2info):
+            self.spk2info.load_legacy(spk2info)
         self.allowed_special = allowed_special
+        # prompt speech feature is the same for every split sentence of a request, and usually for many requests
+        self.prompt_cache = PromptCache(prompt_cache_size, prompt_cache_dir, self.device, prompt_cache_disk_size) if prompt_cache_size > 0 else None
         self.use_ttsfrd = use_ttsfrd
         if self.use_ttsfrd:
             self.frd = ttsfrd.TtsFrontendEngine()
@@ -118,6 +133,27 @@ class CosyVoiceFrontEnd:
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    def _extract_prompt_speech(self, prompt_speech_16k, resample_rate, force_token_ratio=True):
+        if self.prompt_cache is not None:
+            key = self.prompt_cache.hash(prompt_speech_16k, resample_rate, force_token_ratio)
+            prompt_input = self.prompt_cache.get(key)
+            if prompt_input is not None:
+                return prompt_input
+        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
+        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
+        speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
+        if resample_rate == 24000 and force_token_ratio is True:
+            # cosyvoice2, force speech_feat % speech_token = 2
+            token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
+            speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
+            speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
+        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt_input = {'speech_feat': speech_feat, 'speech_feat_len': speech_feat_len, 'speech_token': speech_token, 'speech_token_len': speech_token_len,
+                        'embedding': embedding}
+        if self.prompt_cache is not None:
+            self.prompt_cache.put(key, prompt_input)
+        return prompt_input
+
     def text_normalize(self, text, split=True, text_frontend=True):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will skip text_normalize!')
@@ -158,15 +194,10 @@ class CosyVoiceFrontEnd:
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
             prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
-            if resample_rate == 24000:
-                # cosyvoice2, force speech_feat % speech_token = 2
-                token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_speech_16k)
+            prompt_input = self._extract_prompt_speech(prompt_speech_16k, resample_rate)
+            speech_feat, speech_feat_len = prompt_input['speech_feat'], prompt_input['speech_feat_len']
+            speech_token, speech_token_len = prompt_input['speech_token'], prompt_input['speech_token_len']
+            embedding = prompt_input['embedding']
             model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
                            'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
                            'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
@@ -198,15 +229,18 @@ class CosyVoiceFrontEnd:
 
     def frontend_instruct2(self, tts_text, instruct_text, prompt_speech_16k, resample_rate, zero_shot_spk_id):
         model_input = self.frontend_zero_shot(tts_text, instruct_text + '<|endofprompt|>', prompt_speech_16k, resample_rate, zero_shot_spk_id)
+        if zero_shot_spk_id != '':
+            # registered speaker carries the prompt text of its registration, use instruct text instead
+            model_input['prompt_text'], model_input['prompt_text_len'] = self._extract_text_token(instruct_text + '<|endofprompt|>')
         del model_input['llm_prompt_speech_token']
         del model_input['llm_prompt_speech_token_len']
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_speech_16k, resample_rate):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=resample_rate)(prompt_speech_16k)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_resample)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt_input = self._extract_prompt_speech(prompt_speech_16k, resample_rate, force_token_ratio=False)
+        prompt_speech_token, prompt_speech_token_len = prompt_input['speech_token'], prompt_input['speech_token_len']
+        prompt_speech_feat, prompt_speech_feat_len = prompt_input['speech_feat'], prompt_input['speech_feat_len']
+        embedding = prompt_input['embedding']
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
                        'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import queue
+from concurrent.futures import Future
 from typing import Generator
 import torch
 import numpy as np
@@ -22,8 +24,14 @@ from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
 from cosyvoice.utils.common import fade_in_out
-from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
-from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm, export_estimator_onnx
+from cosyvoice.utils.common import TrtContextWrapper, OnnxSessionWrapper
+from cosyvoice.llm.scheduler import Qwen2LMScheduler
+from cosyvoice.llm.prefix_cache import PrefixKVCache
+from cosyvoice.llm.token_cache import SpeechTokenCache
+from cosyvoice.flow.prompt_cache import FlowPromptCache
+from cosyvoice.cli.session import TokenChannel, SynthesisSession, SessionRegistry
+from cosyvoice.cli.chunk_schedule import StageStats, build_chunk_schedule
 
 
 class CosyVoiceModel:
@@ -43,6 +51,8 @@ class CosyVoiceModel:
             self.flow.half()
         self.token_min_hop_len = 2 * self.flow.input_frame_rate
         self.token_max_hop_len = 4 * self.flow.input_frame_rate
+        # first chunk of fast_start and adaptive chunk schedule
+        self.token_first_hop_len = self.flow.input_frame_rate // 2
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
@@ -55,14 +65,20 @@ class CosyVoiceModel:
         # rtf and decoding related
         self.stream_scale_factor = 1
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
+        # default chunk schedule of stream sessions, see cosyvoice/cli/chunk_schedule.py
+        self.chunk_schedule = 'fixed'
+        # default flow matching step number, ode solver and classifier-free guidance schedule, None means flow default,
+        # see cosyvoice/flow/flow_matching.py
+        self.n_timesteps = 10
+        self.solver = None
+        self.cfg_schedule = None
+        # measured seconds per token of llm and token2wav, used by adaptive chunk schedule
+        self.stage_stats = StageStats()
+        # in stream mode, llm pauses when it is max_ahead_chunks chunks ahead of token2wav, 0 means no limit
+        self.max_ahead_chunks = 0
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        # sessions in flight, each one owns its token channel and caches
+        self.sessions = SessionRegistry()
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
@@ -93,6 +109,27 @@ class CosyVoiceModel:
         assert estimator_engine is not None, 'failed to load trt {}'.format(flow_decoder_estimator_model)
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
+    def load_onnx(self, flow_decoder_onnx_model, onnx_concurrent):
+        # NOTE causal estimator of CosyVoice2 uses chunk attention mask in stream mode, it is exported as another graph
+        onnx_models = {False: flow_decoder_onnx_model}
+        if hasattr(self.flow.decoder.estimator, 'static_chunk_size'):
+            onnx_models[True] = flow_decoder_onnx_model.replace('.onnx', '.streaming.onnx')
+        for streaming, onnx_model in onnx_models.items():
+            if not os.path.exists(onnx_model) or os.path.getsize(onnx_model) == 0:
+                export_estimator_onnx(self.flow.decoder.estimator, onnx_model, streaming, self.device)
+        del self.flow.decoder.estimator
+        self.flow.decoder.estimator = OnnxSessionWrapper(onnx_models, onnx_concurrent=onnx_concurrent, device=self.device)
+
+    def load_token_cache(self, max_size):
+        # speech tokens of finished llm jobs, re-synthesis of the same input skips llm
+        self.token_cache = SpeechTokenCache(max_size)
+
+    def token_cache_key(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, seed=None):
+        # NOTE streaming input text is consumed by llm, so it is never cached
+        if not hasattr(self, 'token_cache') or isinstance(text, Generator):
+            return None
+        return self.token_cache.hash(text, prompt_text, llm_prompt_speech_token, llm_embedding, self.llm.sampling, seed)
+
     def get_trt_kwargs(self):
         min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
         opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
@@ -100,143 +137,230 @@ class CosyVoiceModel:
         input_names = ["x", "mask", "mu", "cond"]
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session, token_cache_key=None):
+        try:
+            self._llm_job(text, prompt_text, llm_prompt_speech_token, llm_embedding, session)
+            # only tokens of a finished job are cached, a cancelled or failed job has partial tokens
+            if token_cache_key is not None and session.tokens.cancelled is False:
+                self.token_cache.put(token_cache_key, session.tokens[:])
+        finally:
+            # always wake up the consumer, even if llm fails
+            session.tokens.close()
+
+    def _llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
         with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
             if isinstance(text, Generator):
                 assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
-                for i in self.llm.inference_bistream(text=text,
+                tokens = self.llm.inference_bistream(text=text,
                                                      prompt_text=prompt_text.to(self.device),
                                                      prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
                                                      prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
+                                                     embedding=llm_embedding.to(self.device),
+                                                     generator=session.generator('llm'))
             else:
-                for i in self.llm.inference(text=text.to(self.device),
+                tokens = self.llm.inference(text=text.to(self.device),
                                             text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
                                             prompt_text=prompt_text.to(self.device),
                                             prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
                                             prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                             prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
                                             embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+                                            uuid=session.uuid,
+                                            generator=session.generator('llm'))
+            try:
+                start_time = time.time()
+                for i in tokens:
+                    # consumer is gone, stop decoding at this token
+                    if session.tokens.cancelled is True:
+                        break
+                    self.stage_stats.update('llm', time.time() - start_time)
+                    session.tokens.append(i)
+                    start_time = time.time()
+            finally:
+                # run cleanup of llm now, e.g. abort vllm request or leave scheduler batch
+                tokens.close()
 
-    def vc_job(self, source_speech_token, uuid):
-        self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
-        self.llm_end_dict[uuid] = True
+    def vc_job(self, source_speech_token, session):
+        session.tokens.extend(source_speech_token.flatten().tolist())
+        session.tokens.close()
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session, finalize=False, speed=1.0):
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device),
-                                                                      token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      prompt_token=prompt_token.to(self.device),
-                                                                      prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      prompt_feat=prompt_feat.to(self.device),
-                                                                      prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                                                      embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+            tts_mel, session.flow_cache = self.flow.inference(token=token.to(self.device),
+                                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                              prompt_token=prompt_token.to(self.device),
+                                                              prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                              prompt_feat=prompt_feat.to(self.device),
+                                                              prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                              embedding=embedding.to(self.device),
+                                                              flow_cache=session.flow_cache,
+                                                              n_timesteps=session.n_timesteps,
+                                                              solver=session.solver,
+                                                              cfg_schedule=session.cfg_schedule,
+                                                              generator=session.generator('flow'))
 
         # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window)
         # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
+        if session.hift_cache is not None:
+            hift_cache_mel, hift_cache_source = session.hift_cache['mel'], session.hift_cache['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
+            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source, generator=session.generator('hift'))
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
+            session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                  'source': tts_source[:, :, -self.source_cache_len:],
+                                  'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
+                assert session.hift_cache is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source, generator=session.generator('hift'))
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
         return tts_speech
 
+    def start_tts(self, text=torch.zeros(1, 0, dtype=torch.int32), llm_embedding=torch.zeros(0, 192), prompt_text=torch.zeros(1, 0, dtype=torch.int32),
+                  llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False,
+                  chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None, seed=None, **kwargs):
+        """Allocate a session and start producing speech token in background
+
+        chunk_schedule, n_timesteps, solver and cfg_schedule override the model defaults of the same name for this session.
+        With seed, llm, flow and hift of the session draw from their own random streams, so the same input and seed give
+        the same speech, whatever other sessions run at the same time.
+        """
+        session = self.new_session(str(uuid.uuid1()), stream, chunk_schedule or self.chunk_schedule)
+        session.n_timesteps, session.solver, session.cfg_schedule = n_timesteps or self.n_timesteps, solver or self.solver, cfg_schedule or self.cfg_schedule
+        session.set_seed(seed, self.device)
+        self.sessions.add(session)
+        token_cache_key = self.token_cache_key(text, prompt_text, llm_prompt_speech_token, llm_embedding, seed) if source_speech_token.shape[1] == 0 else None
+        tokens = self.token_cache.get(token_cache_key) if token_cache_key is not None else None
+        if tokens is not None:
+            # same path as source speech token of vc, speech tokens go straight to token2wav
+            session.thread = threading.Thread(target=self.vc_job, args=(torch.tensor([tokens], dtype=torch.int32), session))
+        elif source_speech_token.shape[1] == 0:
+            session.thread = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, session, token_cache_key))
+        else:
+            session.thread = threading.Thread(target=self.vc_job, args=(source_speech_token, session))
+        session.thread.start()
+        return session
+
+    def new_session(self, uuid, stream, chunk_schedule):
+        schedule = build_chunk_schedule(chunk_schedule, self) if stream is True else None
+        # besides max_ahead_chunks chunks, llm can fill the largest chunk and overlap which current token2wav waits for
+        high_water = (self.max_ahead_chunks + 1) * schedule.max_hop + self.token_overlap_len if stream is True and self.max_ahead_chunks > 0 else None
+        return SynthesisSession(uuid, stream, TokenChannel(high_water=high_water), schedule=schedule, flow_cache=torch.zeros(1, 80, 0, 2), mel_overlap=torch.zeros(1, 80, 0))
+
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, session=None,
+            chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None, seed=None, **kwargs):
+        # session is returned by start_tts when llm is started ahead, otherwise start it now
+        if session is None:
+            session = self.start_tts(text=text, llm_embedding=llm_embedding, prompt_text=prompt_text, llm_prompt_speech_token=llm_prompt_speech_token,
+                                     source_speech_token=source_speech_token, stream=stream, chunk_schedule=chunk_schedule,
+                                     n_timesteps=n_timesteps, solver=solver, cfg_schedule=cfg_schedule, seed=seed)
+        with session:
+            if stream is True:
+                token_offset = 0
+                while True:
+                    token_hop_len = session.schedule.next_hop(session, token_offset)
+                    # wake up as soon as enough tokens are ready, or llm ends without enough tokens
+                    if session.tokens.wait(token_offset + token_hop_len + self.token_overlap_len) < token_offset + token_hop_len + self.token_overlap_len:
+                        break
+                    this_tts_speech_token = torch.tensor(session.tokens[token_offset:token_offset + token_hop_len + self.token_overlap_len]) \
                         .unsqueeze(dim=0)
+                    start_time = time.time()
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
+                                                     session=session,
+                                                     finalize=False).cpu()
+                    self.stage_stats.update('token2wav', time.time() - start_time, token_hop_len)
+                    token_offset += token_hop_len
+                    session.vocoded(token_offset)
+                    yield {'tts_speech': this_tts_speech}
+                session.thread.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(session.tokens[token_offset:]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=True)
+                session.finished = True
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                session.thread.join()
+                this_tts_speech_token = torch.tensor(session.tokens[:]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 finalize=True,
+                                                 speed=speed)
+                session.finished = True
+                yield {'tts_speech': this_tts_speech.cpu()}
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
 
 
+class Token2WavBatcher:
+    """Gather token2wav requests of concurrent sessions and run them as one batch.
+
+    A session waits for its own chunk, so one batch never contains two chunks of the
+    same session and per session hift cache is updated in chunk order.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_wait_time=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.request_queue = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        future = Future()
+        self.request_queue.put((request, future))
+        return future.result()
+
+    def loop(self):
+        with torch.inference_mode():
+            while True:
+                batch = [self.request_queue.get()]
+                deadline = time.time() + self.max_wait_time
+                while len(batch) < self.max_batch_size:
+                    try:
+                        batch.append(self.request_queue.get(timeout=max(deadline - time.time(), 0)))
+                    except queue.Empty:
+                        break
+                try:
+                    results = self.model.token2wav_batch([i[0] for i in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    continue
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+
 class CosyVoice2Model(CosyVoiceModel):
 
     def __init__(self,
@@ -252,20 +376,33 @@ class CosyVoice2Model(CosyVoiceModel):
         if self.fp16 is True:
             self.llm.half()
             self.flow.half()
-        # NOTE must matching training static_chunk_size
+        # NOTE must matching training static_chunk_size, every stream chunk ends at multiple of it
         self.token_hop_len = 25
+        self.token_min_hop_len = self.token_hop_len
+        self.token_max_hop_len = 4 * self.token_hop_len
+        # first chunk of fast_start and adaptive chunk schedule, before alignment
+        self.token_first_hop_len = 10
+        self.stream_scale_factor = 1
+        # default chunk schedule of stream sessions, see cosyvoice/cli/chunk_schedule.py
+        self.chunk_schedule = 'fixed'
+        # default flow matching step number, ode solver and classifier-free guidance schedule, None means flow default,
+        # see cosyvoice/flow/flow_matching.py
+        self.n_timesteps = 10
+        self.solver = None
+        self.cfg_schedule = None
+        # measured seconds per token of llm and token2wav, used by adaptive chunk schedule
+        self.stage_stats = StageStats()
         # hift cache
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
         # speech fade in out
         self.speech_window = np.hamming(2 * self.source_cache_len)
         # rtf and decoding related
+        # in stream mode, llm pauses when it is max_ahead_chunks chunks ahead of token2wav, 0 means no limit
+        self.max_ahead_chunks = 0
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
-        self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.hift_cache_dict = {}
+        # sessions in flight, each one owns its token channel and caches
+        self.sessions = SessionRegistry()
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
@@ -282,105 +419,170 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-        tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
-        # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
-            tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
-        else:
-            hift_cache_source = torch.zeros(1, 1, 0)
-        # keep overlap mel and hift cache
-        if finalize is False:
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
-            tts_speech = tts_speech[:, :-self.source_cache_len]
-        else:
-            if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
-                tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-        return tts_speech
+    def load_scheduler(self, max_batch_size):
+        assert not hasattr(self.llm, 'vllm'), 'continuous batching scheduler do not support vllm!'
+        self.llm.scheduler = Qwen2LMScheduler(self.llm, max_batch_size=max_batch_size, fp16=self.fp16)
+
+    def load_prefix_cache(self, max_bytes):
+        assert not hasattr(self.llm, 'vllm'), 'prefix kv cache do not support vllm, use vllm prefix caching instead!'
+        self.llm.prefix_cache = PrefixKVCache(max_bytes)
+
+    def load_flow_prompt_cache(self, max_size):
+        # prompt encoder state of max_size speakers, looked up once per stream session with incremental flow encode
+        self.flow.prompt_cache = FlowPromptCache(max_size)
+
+    def load_token2wav_batcher(self, max_batch_size):
+        self.token2wav_batcher = Token2WavBatcher(self, max_batch_size=max_batch_size)
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, session, stream=False, finalize=False, speed=1.0):
+        request = {'token': token, 'prompt_token': prompt_token, 'prompt_feat': prompt_feat, 'embedding': embedding, 'token_offset': token_offset,
+                   'session': session, 'stream': stream, 'finalize': finalize, 'speed': speed}
+        if hasattr(self, 'token2wav_batcher'):
+            return self.token2wav_batcher.submit(request)
+        return self.token2wav_batch([request])[0]
+
+    def token2wav_batch(self, requests):
+        tts_mels = [None] * len(requests)
+        # 1. flow inference, sessions with same stream mode and flow matching options share one flow matching call
+        flow_options = [(i['stream'], i['session'].n_timesteps, i['session'].solver, i['session'].cfg_schedule) for i in requests]
+        for stream, n_timesteps, solver, cfg_schedule in set(flow_options):
+            index = [i for i, j in enumerate(flow_options) if j == (stream, n_timesteps, solver, cfg_schedule)]
+            # NOTE trt estimator is built with fixed batch size, fall back to one session per call
+            groups = [index] if isinstance(self.flow.decoder.estimator, (torch.nn.Module, OnnxSessionWrapper)) else [[i] for i in index]
+            for group in groups:
+                with torch.cuda.amp.autocast(self.fp16):
+                    feats = self.flow.inference_batch(token=[requests[i]['token'].to(self.device) for i in group],
+                                                      token_len=[torch.tensor([requests[i]['token'].shape[1]], dtype=torch.int32).to(self.device) for i in group],
+                                                      prompt_token=[requests[i]['prompt_token'].to(self.device) for i in group],
+                                                      prompt_token_len=[torch.tensor([requests[i]['prompt_token'].shape[1]], dtype=torch.int32).to(self.device) for i in group],
+                                                      prompt_feat=[requests[i]['prompt_feat'].to(self.device) for i in group],
+                                                      prompt_feat_len=[torch.tensor([requests[i]['prompt_feat'].shape[1]], dtype=torch.int32).to(self.device) for i in group],
+                                                      embedding=[requests[i]['embedding'].to(self.device) for i in group],
+                                                      streaming=stream,
+                                                      finalize=[requests[i]['finalize'] for i in group],
+                                                      flow_cache=[requests[i]['session'].flow_cache for i in group],
+                                                      n_timesteps=n_timesteps,
+                                                      solver=solver,
+                                                      cfg_schedule=cfg_schedule,
+                                                      generator=[requests[i]['session'].generator('flow') for i in group])
+                for i, feat in zip(group, feats):
+                    tts_mels[i] = feat
+        # 2. append hift cache
+        hift_cache_sources = []
+        for i, request in enumerate(requests):
+            hift_cache = request['session'].hift_cache
+            tts_mel = tts_mels[i][:, :, request['token_offset'] * self.flow.token_mel_ratio:]
+            if hift_cache is not None:
+                tts_mel = torch.concat([hift_cache['mel'], tts_mel], dim=2)
+                hift_cache_sources.append(hift_cache['source'])
+            else:
+                hift_cache_sources.append(torch.zeros(1, 1, 0))
+            if request['finalize'] is True and request['speed'] != 1.0:
+                assert hift_cache is None, 'speed change only support non-stream inference mode'
+                tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / request['speed']), mode='linear')
+            tts_mels[i] = tts_mel
+        # 3. hift inference, hift is not masked, so only sessions with same mel and cache length share one call
+        tts_speeches, tts_sources = [None] * len(requests), [None] * len(requests)
+        groups = {}
+        for i in range(len(requests)):
+            groups.setdefault((tts_mels[i].shape[2], hift_cache_sources[i].shape[2]), []).append(i)
+        for group in groups.values():
+            # each seeded session draws sine phase and noise from its own stream
+            generator = [requests[i]['session'].generator('hift') for i in group]
+            tts_speech, tts_source = self.hift.inference(speech_feat=torch.concat([tts_mels[i] for i in group], dim=0),
+                                                         cache_source=torch.concat([hift_cache_sources[i] for i in group], dim=0),
+                                                         generator=generator if any(i is not None for i in generator) else None)
+            for j, i in enumerate(group):
+                tts_speeches[i], tts_sources[i] = tts_speech[j:j + 1], tts_source[j:j + 1]
+        # 4. keep overlap mel and hift cache
+        for i, request in enumerate(requests):
+            session = request['session']
+            tts_mel, tts_speech, tts_source = tts_mels[i], tts_speeches[i], tts_sources[i]
+            if session.hift_cache is not None:
+                tts_speech = fade_in_out(tts_speech, session.hift_cache['speech'], self.speech_window)
+            if request['finalize'] is False:
+                session.hift_cache = {'mel': tts_mel[:, :, -self.mel_cache_len:],
+                                      'source': tts_source[:, :, -self.source_cache_len:],
+                                      'speech': tts_speech[:, -self.source_cache_len:]}
+                tts_speech = tts_speech[:, :-self.source_cache_len]
+            tts_speeches[i] = tts_speech
+        return tts_speeches
+
+    def new_session(self, uuid, stream, chunk_schedule):
+        schedule = build_chunk_schedule(chunk_schedule, self) if stream is True else None
+        # besides max_ahead_chunks chunks, llm can fill the largest chunk, its alignment pad and pre lookahead which current token2wav waits for
+        high_water = (self.max_ahead_chunks + 1) * schedule.max_hop + self.token_hop_len + self.flow.pre_lookahead_len \
+            if stream is True and self.max_ahead_chunks > 0 else None
+        # NOTE incremental flow encode needs forward_chunk, which is not exported in jit flow encoder
+        return SynthesisSession(uuid, stream, TokenChannel(high_water=high_water), schedule=schedule,
+                                flow_cache={} if stream is True and hasattr(self.flow.encoder, 'forward_chunk') else None)
+
+    def align_hop(self, hop, offset):
+        """Extend hop so that the chunk ends at flow chunk boundary, offset is the number of flow tokens before the chunk, including prompt"""
+        return int(np.ceil((offset + hop) / self.token_hop_len) * self.token_hop_len) - offset
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-        if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        else:
-            p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
-        p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, session=None,
+            chunk_schedule=None, n_timesteps=None, solver=None, cfg_schedule=None, seed=None, **kwargs):
+        # session is returned by start_tts when llm is started ahead, otherwise start it now
+        if session is None:
+            session = self.start_tts(text=text, llm_embedding=llm_embedding, prompt_text=prompt_text, llm_prompt_speech_token=llm_prompt_speech_token,
+                                     source_speech_token=source_speech_token, stream=stream, chunk_schedule=chunk_schedule,
+                                     n_timesteps=n_timesteps, solver=solver, cfg_schedule=cfg_schedule, seed=seed)
+        with session:
+            if stream is True:
+                token_offset = 0
+                while True:
+                    this_token_hop_len = self.align_hop(session.schedule.next_hop(session, token_offset), flow_prompt_speech_token.shape[1] + token_offset)
+                    # wake up as soon as enough tokens are ready, or llm ends without enough tokens
+                    if session.tokens.wait(token_offset + this_token_hop_len + self.flow.pre_lookahead_len) < \
+                            token_offset + this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                    this_tts_speech_token = torch.tensor(session.tokens[:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+                    start_time = time.time()
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
                                                      token_offset=token_offset,
-                                                     uuid=this_uuid,
+                                                     session=session,
                                                      stream=stream,
-                                                     finalize=False)
+                                                     finalize=False).cpu()
+                    self.stage_stats.update('token2wav', time.time() - start_time, this_token_hop_len)
                     token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+                    session.vocoded(token_offset)
+                    yield {'tts_speech': this_tts_speech}
+                session.thread.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                # NOTE last chunk decodes with full context, but only encodes its new tokens on top of session.flow_cache, flow matching
+                # still reruns the whole prefix on every chunk, so its cost over a stream grows quadratically with length
+                this_tts_speech_token = torch.tensor(session.tokens[:]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=token_offset,
+                                                 session=session,
+                                                 finalize=True)
+                session.finished = True
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                session.thread.join()
+                this_tts_speech_token = torch.tensor(session.tokens[:]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=0,
+                                                 session=session,
+                                                 finalize=True,
+                                                 speed=speed)
+                session.finished = True
+                yield {'tts_speech': this_tts_speech.cpu()}
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -0,0 +1,95 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import threading
+import torch
+from cosyvoice.utils.cache import LRUCache
+from cosyvoice.utils.file_utils import logging
+
+
+class PromptCache(LRUCache):
+    """Content addressed LRU cache of prompt speech features, bounded by entry number.
+
+    Key is the hash of prompt waveform and extraction options, value is a dict of tensors.
+    When cache_dir is set, every entry is also saved to cache_dir/key.pt and loaded on memory miss,
+    the directory keeps at most max_disk_size files, the ones least recently used by modification time are removed.
+    """
+
+    def __init__(self, max_size=16, cache_dir='', device=torch.device('cpu'), max_disk_size=1024):
+        super().__init__(max_size)
+        self.cache_dir = cache_dir
+        self.device = device
+        self.max_disk_size = max_disk_size
+        if self.cache_dir != '':
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.evict_disk()
+        self.disk_hits = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                value = self.cache[key]
+            self.touch(key)
+            return value
+        if self.cache_dir != '' and os.path.exists(self.path(key)):
+            try:
+                value = torch.load(self.path(key), map_location=self.device)
+            except Exception as e:
+                logging.warning('failed to load prompt cache {}, {}'.format(self.path(key), e))
+            else:
+                with self.lock:
+                    self.disk_hits += 1
+                super().put(key, value)
+                self.touch(key)
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        evicted = super().put(key, value)
+        if self.cache_dir != '':
+            # write to a temporary file first, so that concurrent readers never see a partial file
+            tmp_path = '{}.{}.tmp'.format(self.path(key), threading.get_ident())
+            torch.save({k: v.cpu() for k, v in value.items()}, tmp_path)
+            os.replace(tmp_path, self.path(key))
+            self.evict_disk()
+        return evicted
+
+    def touch(self, key):
+        # keep lru order of disk eviction
+        if self.cache_dir != '':
+            try:
+                os.utime(self.path(key))
+            except OSError:
+                pass
+
+    def evict_disk(self):
+        entries = [i for i in os.scandir(self.cache_dir) if i.name.endswith('.pt')]
+        if len(entries) <= self.max_disk_size:
+            return
+        for entry in sorted(entries, key=lambda i: i.stat().st_mtime)[:len(entries) - self.max_disk_size]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                # NOTE another process sharing cache_dir may have removed it
+                pass
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{}.pt'.format(key))
+
+    def stats(self):
+        return {**super().stats(), 'disk_hits': self.disk_hits}
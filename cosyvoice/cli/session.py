@@ -0,0 +1,208 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+from cosyvoice.utils.common import get_generators
+from cosyvoice.utils.file_utils import logging
+
+
+class TokenChannel:
+    """Speech token hand-off between the llm thread and the token2wav consumer of one session.
+
+    The producer appends tokens and closes the channel when llm finishes, the consumer
+    blocks in wait() until enough tokens are ready instead of polling. The consumer cancels
+    the channel when it stops early, and the producer checks cancelled before each token.
+    With high_water, append() blocks while high_water tokens after the consumed position
+    are ready, so a producer never runs too far ahead of a slow consumer.
+    """
+
+    def __init__(self, high_water=None):
+        self.tokens = []
+        self.closed = False
+        self.cancelled = False
+        self.high_water = high_water
+        # tokens before consumed are already vocoded
+        self.consumed = 0
+        self.cond = threading.Condition()
+
+    def append(self, token):
+        with self.cond:
+            if self.high_water is not None:
+                self.cond.wait_for(lambda: len(self.tokens) < self.consumed + self.high_water or self.cancelled)
+            self.tokens.append(token)
+            self.cond.notify_all()
+
+    def extend(self, tokens):
+        with self.cond:
+            self.tokens.extend(tokens)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def consume(self, num_tokens):
+        """Mark the first num_tokens tokens as vocoded, resume a producer paused at high water."""
+        with self.cond:
+            self.consumed = num_tokens
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.closed = True
+            self.cond.notify_all()
+
+    def wait(self, num_tokens):
+        """Block until at least num_tokens tokens are ready or the channel is closed, return current token number."""
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.tokens) >= num_tokens or self.closed)
+            return len(self.tokens)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.tokens)
+
+    def __getitem__(self, index):
+        with self.cond:
+            return self.tokens[index]
+
+
+class SynthesisSession:
+    """State of one tts call: speech token channel, llm thread, chunk schedule, flow options, random streams, flow and hift caches and timing.
+
+    Caches are only touched by the consumer of tts(), so they need no lock. Use the session
+    as a context manager, exit stops llm if the session is not finished, waits for it and
+    removes the session from its registry.
+    """
+
+    __slots__ = ('uuid', 'stream', 'tokens', 'thread', 'schedule', 'n_timesteps', 'solver', 'cfg_schedule', 'seed', 'generators', 'mel_overlap', 'flow_cache',
+                 'hift_cache', 'registry', 'start_time', 'first_chunk_time', 'vocoded_tokens', 'finished', 'done')
+
+    def __init__(self, uuid, stream, tokens, schedule=None, flow_cache=None, mel_overlap=None):
+        self.uuid = uuid
+        self.stream = stream
+        self.tokens = tokens
+        self.thread = None
+        # chunk schedule of stream session
+        self.schedule = schedule
+        # flow matching step number, ode solver and classifier-free guidance schedule, None means flow default
+        self.n_timesteps = 10
+        self.solver = None
+        self.cfg_schedule = None
+        # seed of llm sampling, flow noise and hift sine phase and noise, None means global rng
+        self.seed = None
+        self.generators = {}
+        self.mel_overlap = mel_overlap
+        self.flow_cache = flow_cache
+        self.hift_cache = None
+        self.registry = None
+        self.start_time = time.time()
+        self.first_chunk_time = None
+        # tokens before vocoded_tokens are vocoded by finished chunks
+        self.vocoded_tokens = 0
+        # set by the consumer before it yields the last chunk
+        self.finished = False
+        # set when the session is closed
+        self.done = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def set_seed(self, seed, device):
+        """Give llm, flow and hift of this session their own random streams, so that the speech only depends on seed and input,
+        not on global rng state or other sessions in flight"""
+        self.seed = seed
+        self.generators = get_generators(seed, device) if seed is not None else {}
+
+    def generator(self, stage):
+        """Random stream of stage llm, flow or hift, None when the session has no seed"""
+        return self.generators.get(stage)
+
+    def vocoded(self, num_tokens):
+        """Mark the first num_tokens tokens as vocoded after a stream chunk, resume llm paused at high water."""
+        if self.first_chunk_time is None:
+            self.first_chunk_time = time.time()
+        self.vocoded_tokens = num_tokens
+        self.tokens.consume(num_tokens)
+
+    def close(self):
+        if self.done.is_set():
+            return
+        cancelled = self.finished is False
+        llm_stopped = cancelled is True and self.tokens.closed is False
+        if cancelled is True:
+            self.tokens.cancel()
+        if self.thread is not None:
+            self.thread.join()
+        if self.registry is not None:
+            self.registry.remove(self, cancelled=cancelled, llm_stopped=llm_stopped)
+        self.done.set()
+
+    def info(self):
+        return {'uuid': self.uuid,
+                'stream': self.stream,
+                'age': time.time() - self.start_time,
+                'first_chunk_latency': self.first_chunk_time - self.start_time if self.first_chunk_time is not None else None,
+                'decoded_tokens': len(self.tokens),
+                'vocoded_tokens': self.vocoded_tokens,
+                'llm_running': self.thread is not None and self.thread.is_alive()}
+
+
+class SessionRegistry:
+    """Sessions in flight and counters of cancelled sessions.
+
+    Writes hold the lock, reads do not, dict get and copy are atomic in CPython.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        # sessions closed before the end, of which llm is stopped early, and speech tokens decoded or vocoded by them
+        self.cancel_stats = {'cancelled': 0, 'llm_stopped': 0, 'decoded_tokens': 0, 'vocoded_tokens': 0}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, uuid):
+        return self.sessions.get(uuid)
+
+    def add(self, session):
+        session.registry = self
+        with self.lock:
+            self.sessions[session.uuid] = session
+
+    def remove(self, session, cancelled=False, llm_stopped=False):
+        with self.lock:
+            self.sessions.pop(session.uuid)
+            if cancelled is True:
+                self.cancel_stats['cancelled'] += 1
+                self.cancel_stats['llm_stopped'] += int(llm_stopped)
+                self.cancel_stats['decoded_tokens'] += len(session.tokens)
+                self.cancel_stats['vocoded_tokens'] += session.vocoded_tokens
+        if cancelled is True:
+            logging.info('session {} cancelled, llm stopped early {}, decoded {} vocoded {} speech tokens'.format(session.uuid, llm_stopped,
+                                                                                                                  len(session.tokens), session.vocoded_tokens))
+
+    def stats(self):
+        with self.lock:
+            return {'sessions': len(self.sessions), **self.cancel_stats}
+
+    def info(self):
+        """Introspect sessions in flight, e.g. to find leaked sessions under load"""
+        return [session.info() for session in list(self.sessions.values())]
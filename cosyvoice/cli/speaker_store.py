@@ -0,0 +1,242 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class SpeakerStore:
+    """Persistent speaker registry with lazy lookup, replaces the single spk2info.pt file.
+
+    An entry is a dict of tensors, e.g. frontend_zero_shot output without text. Tensor bytes are appended
+    to a data file, and one json line per add or delete is appended to store_dir/index.jsonl, so add and
+    delete never rewrite the store, later lines override earlier ones. First line of the index names the
+    data file, compact() writes live entries to a new data file and switches the index atomically.
+    At load time only the index is read into a dict, the data file is memory-mapped and an entry is
+    paged in on lookup, the last cache_size entries looked up are kept on device.
+    When store_dir is empty, entries are only kept in memory.
+    """
+
+    def __init__(self, store_dir='', device=torch.device('cpu'), cache_size=64):
+        self.store_dir = store_dir
+        self.device = device
+        self.cache_size = cache_size
+        # speaker id -> index record, or entry itself when there is no store_dir
+        self.index = {}
+        self.cache = OrderedDict()
+        self.data_file = 'data.0.bin'
+        self.mmap = None
+        # bytes of overridden or deleted entries in data file, reclaimed by compact()
+        self.garbage_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if self.store_dir != '' and os.path.exists(self.index_path):
+            self.load_index()
+
+    @staticmethod
+    def writable(store_dir):
+        """Whether store_dir, or its nearest existing parent when it does not exist yet, can be written"""
+        path = os.path.abspath(store_dir)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return os.access(path, os.W_OK)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.store_dir, 'index.jsonl')
+
+    @property
+    def data_path(self):
+        return os.path.join(self.store_dir, self.data_file)
+
+    def load_index(self):
+        with open(self.index_path, 'r') as f:
+            lines = f.readlines()
+        self.data_file = json.loads(lines[0])['data']
+        for i, line in enumerate(lines[1:]):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # NOTE only the last line can be partial, when a writer is killed while appending it
+                logging.warning('skip broken line {} of speaker index {}'.format(i + 2, self.index_path))
+                continue
+            self.apply(record)
+
+    def apply(self, record):
+        if record['id'] in self.index:
+            self.garbage_bytes += self.nbytes(self.index.pop(record['id']))
+        if record.get('deleted', False) is False:
+            self.index[record['id']] = record
+
+    @staticmethod
+    def nbytes(record):
+        return sum({i['offset']: i['nbytes'] for i in record['tensors'].values() if i['nbytes'] > 0}.values())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, spk_id):
+        return spk_id in self.index
+
+    def __iter__(self):
+        return iter(list(self.index.keys()))
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def __getitem__(self, spk_id):
+        # NOTE return a shallow copy, callers add and delete keys of model input
+        with self.lock:
+            if self.store_dir == '':
+                return dict(self.index[spk_id])
+            if spk_id in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(spk_id)
+                return dict(self.cache[spk_id])
+            if spk_id not in self.index:
+                raise KeyError(spk_id)
+            self.misses += 1
+            value = self.read(self.index[spk_id])
+            self.cache_put(spk_id, value)
+            return dict(value)
+
+    def __setitem__(self, spk_id, value):
+        self.add(spk_id, value)
+
+    def __delitem__(self, spk_id):
+        self.delete(spk_id)
+
+    def cache_put(self, spk_id, value):
+        self.cache[spk_id] = value
+        self.cache.move_to_end(spk_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def read(self, record):
+        end = max([i['offset'] + i['nbytes'] for i in record['tensors'].values()], default=0)
+        if self.mmap is None or len(self.mmap) < end:
+            # data file grows by add, map it again to see the appended bytes
+            with open(self.data_path, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(self.data_path) > 0 else None
+        value, tensors = {}, {}
+        for name, i in record['tensors'].items():
+            key = (i['offset'], i['nbytes'], i['dtype'], tuple(i['shape']))
+            if key not in tensors:
+                if i['nbytes'] == 0:
+                    array = np.zeros(i['shape'], dtype=i['dtype'])
+                else:
+                    array = np.frombuffer(self.mmap, dtype=i['dtype'], count=int(np.prod(i['shape'])), offset=i['offset']).reshape(i['shape'])
+                tensors[key] = torch.from_numpy(array.copy()).to(self.device)
+            value[name] = tensors[key]
+        return value
+
+    def add(self, spk_id, value):
+        """Add or replace speaker spk_id, value is a dict of tensors"""
+        assert all(isinstance(i, torch.Tensor) for i in value.values()), 'speaker store only supports dict of tensors'
+        with self.lock:
+            if self.store_dir == '':
+                self.index[spk_id] = {k: v.to(self.device) for k, v in value.items()}
+                return
+            if not os.path.exists(self.index_path):
+                os.makedirs(self.store_dir, exist_ok=True)
+                with open(self.index_path, 'w') as f:
+                    f.write(json.dumps({'data': self.data_file}) + '\n')
+            record = {'id': spk_id, 'tensors': {}}
+            # write tensor bytes before index line, so that index never points to missing bytes,
+            # a tensor under several names, e.g. llm and flow prompt speech token, is written once
+            written = {}
+            with open(self.data_path, 'ab') as f:
+                for name, tensor in value.items():
+                    if id(tensor) not in written:
+                        array = tensor.detach().cpu().numpy()
+                        written[id(tensor)] = {'dtype': str(array.dtype), 'shape': list(array.shape), 'offset': f.tell(), 'nbytes': array.nbytes}
+                        f.write(array.tobytes())
+                    record['tensors'][name] = written[id(tensor)]
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self.apply(record)
+            self.cache.pop(spk_id, None)
+
+    def delete(self, spk_id):
+        with self.lock:
+            if spk_id not in self.index:
+                raise KeyError(spk_id)
+            if self.store_dir == '':
+                self.index.pop(spk_id)
+                return
+            self.cache.pop(spk_id, None)
+            record = {'id': spk_id, 'deleted': True}
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self.apply(record)
+
+    def load_legacy(self, spk2info):
+        """Import speakers of a spk2info.pt file saved by torch.save"""
+        spk2info = torch.load(spk2info, map_location='cpu')
+        for spk_id, value in spk2info.items():
+            self.add(spk_id, value)
+        logging.info('imported {} speakers into speaker store {}'.format(len(spk2info), self.store_dir))
+
+    def flush(self):
+        """Sync data file and index to disk, add and delete are already written"""
+        with self.lock:
+            if self.store_dir == '' or not os.path.exists(self.index_path):
+                return
+            for path in [self.data_path, self.index_path]:
+                if os.path.exists(path):
+                    with open(path, 'rb+') as f:
+                        os.fsync(f.fileno())
+
+    def compact(self):
+        """Write live entries into a new data file and index, reclaim bytes of overridden or deleted entries"""
+        with self.lock:
+            if self.store_dir == '' or not os.path.exists(self.index_path):
+                return
+            old_data_path = self.data_path
+            data_file = 'data.{}.bin'.format(int(self.data_file.split('.')[1]) + 1)
+            index = {}
+            with open(old_data_path, 'rb') as src, open(os.path.join(self.store_dir, data_file), 'wb') as dst:
+                for spk_id, record in self.index.items():
+                    offsets = {}
+                    for i in record['tensors'].values():
+                        if (i['offset'], i['nbytes']) not in offsets:
+                            src.seek(i['offset'])
+                            offsets[(i['offset'], i['nbytes'])] = dst.tell()
+                            dst.write(src.read(i['nbytes']))
+                    index[spk_id] = {'id': spk_id, 'tensors': {k: {**v, 'offset': offsets[(v['offset'], v['nbytes'])]} for k, v in record['tensors'].items()}}
+                os.fsync(dst.fileno())
+            # write a new index then switch to it atomically, the old data file is removed after that
+            tmp_path = '{}.tmp'.format(self.index_path)
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps({'data': data_file}) + '\n')
+                for record in index.values():
+                    f.write(json.dumps(record) + '\n')
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+            self.index, self.data_file, self.garbage_bytes = index, data_file, 0
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+            os.remove(old_data_path)
+
+    def stats(self):
+        with self.lock:
+            return {'speakers': len(self.index), 'cached': len(self.cache), 'hits': self.hits, 'misses': self.misses,
+                    'garbage_bytes': self.garbage_bytes}
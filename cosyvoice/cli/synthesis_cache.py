@@ -0,0 +1,86 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import threading
+from cosyvoice.utils.cache import LRUCache
+from cosyvoice.utils.file_utils import logging
+
+
+class SynthesisCache(LRUCache):
+    """Size bounded LRU cache of synthesized speech of whole utterances, stored as int16 pcm bytes.
+
+    Key is the hash of model, mode, speaker or prompt, normalized text and synthesis options, see CosyVoice.pipeline.
+    Without cache_dir, value is the pcm bytes kept in memory. When cache_dir is set, pcm is saved to cache_dir/key.pcm,
+    value is only its byte number, and the index is rebuilt from the directory at load time in modification time order,
+    so entries survive restarts.
+    """
+
+    def __init__(self, max_bytes, cache_dir=''):
+        super().__init__(max_bytes)
+        self.cache_dir = cache_dir
+        if self.cache_dir != '':
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entries = [i for i in os.scandir(self.cache_dir) if i.name.endswith('.pcm')]
+            with self.lock:
+                for entry in sorted(entries, key=lambda i: i.stat().st_mtime):
+                    self.cache[entry.name[:-len('.pcm')]] = entry.stat().st_size
+                    self.total_size += entry.stat().st_size
+                evicted = self.evict()
+            self.remove(evicted)
+
+    def size(self, value):
+        return len(value) if isinstance(value, bytes) else value
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{}.pcm'.format(key))
+
+    def get(self, key):
+        value = super().get(key)
+        if value is None or self.cache_dir == '':
+            return value
+        try:
+            with open(self.path(key), 'rb') as f:
+                pcm = f.read()
+            # keep lru order of the next load
+            os.utime(self.path(key))
+        except OSError as e:
+            logging.warning('failed to read synthesis cache {}, {}'.format(self.path(key), e))
+            with self.lock:
+                self.hits -= 1
+                self.misses += 1
+                self.discard(key)
+            return None
+        return pcm
+
+    def put(self, key, pcm):
+        if len(pcm) > self.max_size:
+            return []
+        if self.cache_dir != '':
+            # write to a temporary file first, so that concurrent readers never see a partial file
+            tmp_path = '{}.{}.tmp'.format(self.path(key), threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                f.write(pcm)
+            os.replace(tmp_path, self.path(key))
+        evicted = super().put(key, pcm if self.cache_dir == '' else len(pcm))
+        self.remove(evicted)
+        return evicted
+
+    def remove(self, keys):
+        for key in keys:
+            if self.cache_dir != '' and os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+
+    def stats(self):
+        stats = super().stats()
+        return {**stats, 'hit_rate': stats['hits'] / max(stats['hits'] + stats['misses'], 1), 'bytes': self.total_size}
@@ -62,6 +62,17 @@ class CausalConv1d(torch.nn.Conv1d):
         return x
 
 
+def conv1d_input_slice(conv, x, start, end, bias=True):
+    """Apply conv to x, which holds input channels [start, end) of conv.
+
+    Convolution is linear, so outputs of all input channel slices sum to conv of the whole input,
+    each slice adds bias at most once.
+    """
+    if isinstance(conv, CausalConv1d):
+        x = F.pad(x, (conv.causal_padding, 0), value=0.0)
+    return F.conv1d(x, conv.weight[:, start:end], conv.bias if bias else None, conv.stride, conv.padding, conv.dilation, conv.groups)
+
+
 class CausalBlock1D(Block1D):
     def __init__(self, dim: int, dim_out: int):
         super(CausalBlock1D, self).__init__(dim, dim_out)
@@ -224,26 +235,82 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        return self.forward_step(x, t, self.prepare(mask, mu, spks=spks, cond=cond, streaming=streaming))
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+    def attention_mask(self, mask, streaming=False):
+        """Attention mask of one resolution, mask shape (batch_size, 1, time)"""
+        return add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, 0, -1).repeat(1, mask.size(2), 1)
+
+    def prepare(self, mask, mu, spks=None, cond=None, streaming=False):
+        """Precompute everything that only depends on condition and mask, flow matching calls it once and forward_step every step.
 
-        x = pack([x, mu], "b * t")[0]
+        Condition [mu, spks, cond] is packed after x as input of the first resnet, whose block1 conv and res_conv are
+        linear, so the condition part of both convs is computed here. Masks and attention masks of every resolution
+        are built here as well.
 
+        Returns:
+            dict: condition of forward_step
+        """
+        c = [mu]
         if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
+            c.append(repeat(spks, "b c -> b c t", t=mu.shape[-1]))
         if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+            c.append(cond)
+        c = pack(c, "b * t")[0] * mask
+        x_channels = self.in_channels - c.shape[1]
+        resnet = self.down_blocks[0][0]
+        masks = [mask]
+        for _ in range(len(self.down_blocks) - 1):
+            masks.append(masks[-1][:, :, ::2])
+        return {
+            'x_channels': x_channels,
+            'block1': conv1d_input_slice(resnet.block1.block[0], c, x_channels, self.in_channels),
+            'res_conv': conv1d_input_slice(resnet.res_conv, c, x_channels, self.in_channels),
+            'masks': masks,
+            'attn_masks': [mask_to_bias(self.attention_mask(i, streaming=streaming), mu.dtype) for i in masks],
+        }
+
+    def slice_condition(self, condition, batch_size):
+        """Condition of the first batch_size rows, condition is returned by prepare"""
+        return {
+            'x_channels': condition['x_channels'],
+            'block1': condition['block1'][:batch_size],
+            'res_conv': condition['res_conv'][:batch_size],
+            'masks': [i[:batch_size] for i in condition['masks']],
+            'attn_masks': [i[:batch_size] for i in condition['attn_masks']],
+        }
+
+    def input_resnet(self, x, mask, t, condition):
+        """First resnet of down blocks, same as resnet(pack([x, mu, spks, cond]), mask, t) with condition part of its convs precomputed"""
+        resnet = self.down_blocks[0][0]
+        x = x * mask
+        h = conv1d_input_slice(resnet.block1.block[0], x, 0, condition['x_channels'], bias=False) + condition['block1']
+        h = resnet.block1.block[1:](h) * mask
+        h += resnet.mlp(t).unsqueeze(-1)
+        h = resnet.block2(h, mask)
+        return h + conv1d_input_slice(resnet.res_conv, x, 0, condition['x_channels'], bias=False) + condition['res_conv']
+
+    def forward_step(self, x, t, condition):
+        """Forward pass of one flow matching step, condition is returned by prepare.
+
+        Args:
+            x (torch.Tensor): shape (batch_size, out_channels, time)
+            t (torch.Tensor): shape (batch_size)
+            condition (dict): output of prepare with the same batch_size and time
+
+        Returns:
+            torch.Tensor: shape (batch_size, out_channels, time)
+        """
+        t = self.time_embeddings(t).to(t.dtype)
+        t = self.time_mlp(t)
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
+        masks, attn_masks = list(condition['masks']), list(condition['attn_masks'])
+        for i, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = masks[i]
+            x = self.input_resnet(x, mask_down, t, condition) if i == 0 else resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = attn_masks[i].to(x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -253,15 +320,12 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
         mask_mid = masks[-1]
 
+        attn_mask = attn_masks[-1].to(x.dtype)
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -272,12 +336,11 @@ class ConditionalDecoder(nn.Module):
 
         for resnet, transformer_blocks, upsample in self.up_blocks:
             mask_up = masks.pop()
+            attn_mask = attn_masks.pop().to(x.dtype)
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -288,7 +351,7 @@ class ConditionalDecoder(nn.Module):
             x = upsample(x * mask_up)
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
-        return output * mask
+        return output * condition['masks'][0]
 
 
 class CausalConditionalDecoder(ConditionalDecoder):
@@ -402,93 +465,8 @@ class CausalConditionalDecoder(ConditionalDecoder):
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
-        """Forward pass of the UNet1DConditional model.
-
-        Args:
-            x (torch.Tensor): shape (batch_size, in_channels, time)
-            mask (_type_): shape (batch_size, 1, time)
-            t (_type_): shape (batch_size)
-            spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
-            cond (_type_, optional): placeholder for future use. Defaults to None.
-
-        Raises:
-            ValueError: _description_
-            ValueError: _description_
-
-        Returns:
-            _type_: _description_
-        """
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
-
-        hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
-            x = resnet(x, mask_down, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-            hiddens.append(x)  # Save hidden states for skip connections
-            x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
-
-        for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
-            skip = hiddens.pop()
-            x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
-            x = resnet(x, mask_up, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
-            x = upsample(x * mask_up)
-        x = self.final_block(x, mask_up)
-        output = self.final_proj(x * mask_up)
-        return output * mask
+    def attention_mask(self, mask, streaming=False):
+        """Attention mask of one resolution, chunk mask of static_chunk_size in streaming mode"""
+        if streaming is True:
+            return add_optional_chunk_mask(mask.transpose(1, 2), mask.bool(), False, False, 0, self.static_chunk_size, -1)
+        return super().attention_mask(mask, streaming=streaming)
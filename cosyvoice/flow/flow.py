@@ -17,6 +17,7 @@ from typing import Dict, Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from omegaconf import DictConfig
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -110,11 +111,15 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_schedule=None,
+                  generator=None):
         assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        # xvec projection and prompt conditions
+        prompt = self.inference_prompt(prompt_token, prompt_feat, embedding)
+        embedding = prompt['embedding']
 
         # concat speech token and prompt speech token
         token_len1, token_len2 = prompt_token.shape[1], token.shape[1]
@@ -129,9 +134,7 @@ class MaskedDiffWithXvec(torch.nn.Module):
         h, h_lengths = self.length_regulator.inference(h[:, :token_len1], h[:, token_len1:], mel_len1, mel_len2, self.input_frame_rate)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        conds = F.pad(prompt['conds'], (0, mel_len2)).to(h.dtype)
 
         mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
         feat, flow_cache = self.decoder(
@@ -139,14 +142,27 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            cache=flow_cache
+            cache=flow_cache,
+            solver=solver,
+            cfg_schedule=cfg_schedule,
+            generator=generator
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), flow_cache
 
+    @torch.inference_mode()
+    def inference_prompt(self, prompt_token, prompt_feat, embedding):
+        """Conditions which only depend on the speaker prompt, projected embedding and prompt feat part of conds
+
+        NOTE never cached, they are cheaper to compute than to hash the prompt, and encoder output of prompt
+        can not be reused, full attention encoder and length regulator also see the new tokens.
+        """
+        embedding = self.spk_embed_affine_layer(F.normalize(embedding, dim=1))
+        return {'embedding': embedding, 'conds': prompt_feat.transpose(1, 2).to(embedding.dtype)}
+
 
 class CausalMaskedDiffWithXvec(torch.nn.Module):
     def __init__(self,
@@ -242,11 +258,58 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  flow_cache=None,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_schedule=None,
+                  generator=None):
         assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        h, conds, embedding, mel_len1, mel_len2 = self.inference_encode(token, token_len, prompt_token, prompt_token_len,
+                                                                        prompt_feat, prompt_feat_len, embedding, streaming, finalize, flow_cache)
+
+        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_schedule=cfg_schedule,
+            generator=generator
+        )
+        feat = feat[:, :, mel_len1:]
+        assert feat.shape[2] == mel_len2
+        return feat.float(), flow_cache
+
+    @torch.inference_mode()
+    def inference_encode(self,
+                         token,
+                         token_len,
+                         prompt_token,
+                         prompt_token_len,
+                         prompt_feat,
+                         prompt_feat_len,
+                         embedding,
+                         streaming,
+                         finalize,
+                         flow_cache=None):
+        """Encode prompt and token into decoder condition
+
+        When flow_cache is a dict, which is only set for stream sessions, token is still the whole prefix of the session,
+        but only the tokens after those already in flow_cache are encoded, flow_cache is updated in place.
+        This includes the final call of a stream, which decodes with streaming False, its last segment is encoded with
+        the same chunk mask as the earlier ones instead of re-encoding the whole prefix with full attention.
+        NOTE the decoder still runs on the whole prefix every chunk, see CosyVoice2Model.tts.
+        Non stream inference has full context, so it always encodes the whole prefix.
+        """
+        if flow_cache is not None:
+            return self.inference_encode_chunk(token, prompt_token, prompt_feat, embedding, streaming, finalize, flow_cache)
+        # xvec projection and prompt conditions
+        prompt = self.inference_prompt(prompt_token, prompt_feat, embedding)
+        embedding = prompt['embedding']
 
         # concat text and prompt_text
         token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
@@ -263,19 +326,130 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         h = self.encoder_proj(h)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        conds = F.pad(prompt['conds'], (0, mel_len2)).to(h.dtype)
+        return h, conds, embedding, mel_len1, mel_len2
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+    @torch.inference_mode()
+    def inference_prompt(self, prompt_token, prompt_feat, embedding, incremental=False):
+        """Conditions which only depend on the speaker prompt, projected embedding and prompt feat part of conds
+
+        With incremental, also the encoder cache and output of the longest prompt prefix which ends at chunk
+        boundary and whose lookahead context is still prompt, the chunk causal encoder gives the same output
+        for it whatever tokens follow, so incremental encode of a new session starts after it. They are None
+        if the prompt is shorter than one chunk plus lookahead.
+        Only the incremental result is reused from self.prompt_cache when it is loaded, it is looked up once per
+        stream session, see CosyVoiceModel.load_flow_prompt_cache. Without encoder output the conditions are
+        cheaper to compute than to hash the prompt, and non streaming encode has full attention, so encoder output
+        of prompt is never reused there.
+        """
+        if incremental is False:
+            embedding = self.spk_embed_affine_layer(F.normalize(embedding, dim=1))
+            return {'embedding': embedding, 'conds': prompt_feat.transpose(1, 2).to(embedding.dtype)}
+        key = self.prompt_cache.hash(prompt_token, prompt_feat, embedding) if hasattr(self, 'prompt_cache') else None
+        prompt = self.prompt_cache.get(key) if key is not None else None
+        if prompt is not None:
+            return prompt
+        projected = self.spk_embed_affine_layer(F.normalize(embedding, dim=1))
+        prompt = {'embedding': projected, 'conds': prompt_feat.transpose(1, 2).to(projected.dtype), 'encoder': None, 'h': None}
+        chunk_size = self.encoder.static_chunk_size
+        prefix_len = (prompt_token.shape[1] - self.pre_lookahead_len) // chunk_size * chunk_size
+        if prefix_len > 0:
+            token = self.input_embedding(torch.clamp(prompt_token[:, :prefix_len + self.pre_lookahead_len], min=0))
+            h, prompt['encoder'] = self.encoder.forward_chunk(token[:, :prefix_len], context=token[:, prefix_len:])
+            prompt['h'] = self.encoder_proj(h)
+        if key is not None:
+            self.prompt_cache.put(key, prompt)
+        return prompt
+
+    @torch.inference_mode()
+    def inference_encode_chunk(self,
+                               token,
+                               prompt_token,
+                               prompt_feat,
+                               embedding,
+                               streaming,
+                               finalize,
+                               flow_cache):
+        assert token.shape[0] == 1, 'incremental encode only supports one session'
+        # xvec projection and prompt conditions, computed once per session, encoder starts after cached prompt prefix
+        if 'embedding' not in flow_cache:
+            prompt = self.inference_prompt(prompt_token, prompt_feat, embedding, incremental=True)
+            flow_cache['embedding'], flow_cache['conds'] = prompt['embedding'], prompt['conds']
+            if prompt['encoder'] is not None:
+                flow_cache['encoder'], flow_cache['h'] = prompt['encoder'], prompt['h']
+        embedding = flow_cache['embedding']
+
+        # only embed tokens after encoder cache
+        offset = flow_cache['encoder']['offset'] if 'encoder' in flow_cache else 0
+        token = self.input_embedding(torch.clamp(torch.concat([prompt_token, token], dim=1)[:, offset:], min=0))
+
+        # text encode
+        if finalize is True:
+            h, encoder_cache = self.encoder.forward_chunk(token, cache=flow_cache.get('encoder'))
+        else:
+            token, context = token[:, :-self.pre_lookahead_len], token[:, -self.pre_lookahead_len:]
+            h, encoder_cache = self.encoder.forward_chunk(token, context=context, cache=flow_cache.get('encoder'))
+        h = self.encoder_proj(h)
+        if 'h' in flow_cache:
+            h = torch.concat([flow_cache['h'], h], dim=1)
+        flow_cache['encoder'], flow_cache['h'] = encoder_cache, h
+        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+
+        # get conditions
+        conds = F.pad(flow_cache['conds'], (0, mel_len2)).to(h.dtype)
+        return h, conds, embedding, mel_len1, mel_len2
+
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        streaming,
+                        finalize,
+                        flow_cache=None,
+                        n_timesteps=10,
+                        solver=None,
+                        cfg_schedule=None,
+                        generator=None):
+        """Batch inference of several sessions
+
+        Every argument except streaming is a list with one batch size 1 item per session,
+        flow_cache is either None or a list of per session cache, see inference_encode.
+        n_timesteps, solver and cfg_schedule of flow matching are shared by all sessions of the batch.
+        generator is None or a list of the random stream or None of each session.
+        Sessions are encoded one by one, then padded to the longest mel length and decoded
+        by one flow matching call, padding frames are excluded by mask.
+
+        Returns:
+            list of mel feat of each session, shape (1, 80, mel_len2)
+        """
+        hs, conds, embeddings, mel_len1s, mel_len2s = [], [], [], [], []
+        for i in range(len(token)):
+            h, cond, this_embedding, mel_len1, mel_len2 = self.inference_encode(token[i], token_len[i], prompt_token[i], prompt_token_len[i],
+                                                                                prompt_feat[i], prompt_feat_len[i], embedding[i], streaming, finalize[i],
+                                                                                flow_cache[i] if flow_cache is not None else None)
+            hs.append(h.squeeze(dim=0))
+            conds.append(cond.squeeze(dim=0).transpose(0, 1))
+            embeddings.append(this_embedding)
+            mel_len1s.append(mel_len1)
+            mel_len2s.append(mel_len2)
+        mel_len = torch.tensor([i + j for i, j in zip(mel_len1s, mel_len2s)])
+        h = pad_sequence(hs, batch_first=True, padding_value=0)
+        conds = pad_sequence(conds, batch_first=True, padding_value=0).transpose(1, 2)
+        mask = (~make_pad_mask(mel_len)).to(h)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
-            spks=embedding,
+            spks=torch.concat(embeddings, dim=0),
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_schedule=cfg_schedule,
+            generator=generator
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), None
+        return [feat[i:i + 1, :, mel_len1s[i]:mel_len1s[i] + mel_len2s[i]].float() for i in range(len(token))]
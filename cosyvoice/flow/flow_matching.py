@@ -12,10 +12,44 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import numpy as np
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
-from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.common import OnnxSessionWrapper
+from cosyvoice.utils.sampling import random_like
+
+# ode solvers of flow matching inference, solver name to ConditionalCFM method
+ODE_SOLVERS = {
+    'euler': 'solve_euler',
+    'midpoint': 'solve_midpoint',
+    'heun': 'solve_heun',
+    'adams_bashforth': 'solve_adams_bashforth',
+}
+
+
+def build_cfg_guidance(cfg_schedule, t_span):
+    """Whether each ode step of t_span runs Classifier-Free Guidance
+
+    cfg_schedule:
+        'full': every step, default
+        'none': no step
+        'first:k': first k steps
+        'interval:start:end': steps which start at t in [start, end), t goes from 0 to 1
+    Steps without guidance only run the conditional branch, at half estimator batch size.
+    """
+    n_timesteps = len(t_span) - 1
+    name, *params = (cfg_schedule or 'full').split(':')
+    if name == 'full' and len(params) == 0:
+        return [True] * n_timesteps
+    if name == 'none' and len(params) == 0:
+        return [False] * n_timesteps
+    if name == 'first' and len(params) == 1:
+        return [step < int(params[0]) for step in range(n_timesteps)]
+    if name == 'interval' and len(params) == 2:
+        start, end = float(params[0]), float(params[1])
+        return [start <= t < end for t in t_span[:-1].tolist()]
+    raise ValueError('unknown cfg schedule {}, choose from full, none, first:k, interval:start:end'.format(cfg_schedule))
 
 
 class ConditionalCFM(BASECFM):
@@ -34,7 +68,8 @@ class ConditionalCFM(BASECFM):
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2), solver=None,
+                cfg_schedule=None, generator=None):
         """Forward diffusion
 
         Args:
@@ -47,13 +82,16 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ode solver in ODE_SOLVERS. Defaults to None, which uses cfm_params.solver.
+            cfg_schedule (str, optional): steps with classifier-free guidance, see build_cfg_guidance. Defaults to None, every step.
+            generator (torch.Generator, optional): random stream of the request. Defaults to None, global rng.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = torch.randn_like(mu).to(mu.device).to(mu.dtype) * temperature
+        z = (torch.randn_like(mu) if generator is None else random_like(mu, generator, normal=True)).to(mu.device).to(mu.dtype) * temperature
         cache_size = cache.shape[2]
         # fix prompt and overlap part mu and z
         if cache_size != 0:
@@ -66,9 +104,69 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver, cfg_schedule=cfg_schedule), cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def solve(self, x, t_span, mu, mask, spks, cond, streaming=False, solver=None, cfg_schedule=None):
+        solver = solver or self.solver
+        assert solver in ODE_SOLVERS, 'unknown ode solver {}, choose from {}'.format(solver, list(ODE_SOLVERS.keys()))
+        return getattr(self, ODE_SOLVERS[solver])(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, cfg_schedule=cfg_schedule)
+
+    def prepare_cfg_inputs(self, x, mu, mask, spks, cond, streaming=False):
+        """Allocate estimator inputs of both Classifier-Free Guidance branches, fill the step invariant ones
+
+        Pytorch estimator also precomputes its step invariant condition here, see ConditionalDecoder.prepare.
+        """
+        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+        # NOTE first batch_size rows are conditional branch, last batch_size rows are unconditional branch
+        batch_size = x.size(0)
+        x_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([2 * batch_size, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([2 * batch_size], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([2 * batch_size, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([2 * batch_size, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in[:batch_size], mask_in[batch_size:] = mask, mask
+        mu_in[:batch_size] = mu
+        spks_in[:batch_size] = spks
+        cond_in[:batch_size] = cond
+        inputs = {'x': x_in, 'mask': mask_in, 'mu': mu_in, 't': t_in, 'spks': spks_in, 'cond': cond_in}
+        if isinstance(self.estimator, torch.nn.Module) and hasattr(self.estimator, 'prepare'):
+            inputs['condition'] = self.estimator.prepare(mask_in, mu_in, spks=spks_in, cond=cond_in, streaming=streaming)
+        # steps without guidance run the first batch_size rows only, views keep them in the same memory
+        # NOTE trt estimator is built with fixed batch size, it always runs both branches
+        if isinstance(self.estimator, (torch.nn.Module, OnnxSessionWrapper)):
+            inputs['conditional'] = {k: v[:batch_size] for k, v in inputs.items() if k != 'condition'}
+            if 'condition' in inputs:
+                inputs['conditional']['condition'] = self.estimator.slice_condition(inputs['condition'], batch_size)
+        return inputs
+
+    def cfg_velocity(self, x, t, inputs, streaming=False, guidance=True):
+        """Estimate velocity dphi_dt at time t, inputs is returned by prepare_cfg_inputs, guidance False skips unconditional branch"""
+        # Classifier-Free Guidance inference introduced in VoiceBox
+        batch_size = x.size(0)
+        if guidance is False and 'conditional' in inputs:
+            inputs = inputs['conditional']
+        inputs['x'][:batch_size] = x
+        if inputs['x'].size(0) > batch_size:
+            inputs['x'][batch_size:] = x
+        inputs['t'][:] = t
+        if 'condition' in inputs:
+            dphi_dt = self.estimator.forward_step(inputs['x'], inputs['t'], inputs['condition'])
+        else:
+            dphi_dt = self.forward_estimator(
+                inputs['x'], inputs['mask'],
+                inputs['mu'], inputs['t'],
+                inputs['spks'],
+                inputs['cond'],
+                streaming
+            )
+        dphi_dt, cfg_dphi_dt = dphi_dt[:batch_size], dphi_dt[batch_size:]
+        # NOTE trt estimator writes output to inputs['x'], copy it out before next call
+        if guidance is False:
+            return dphi_dt.clone()
+        return ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_schedule=None):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -82,6 +180,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cfg_schedule (str, optional): steps with classifier-free guidance, see build_cfg_guidance
         """
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)
@@ -90,30 +189,10 @@ class ConditionalCFM(BASECFM):
         # Or in future might add like a return_all_steps flag
         sol = []
 
-        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        inputs = self.prepare_cfg_inputs(x, mu, mask, spks, cond, streaming=streaming)
+        guidance = build_cfg_guidance(cfg_schedule, t_span)
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+            dphi_dt = self.cfg_velocity(x, t, inputs, streaming, guidance[step - 1])
             x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
@@ -122,20 +201,79 @@ class ConditionalCFM(BASECFM):
 
         return sol[-1].float()
 
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_schedule=None):
+        """Explicit midpoint solver, second order, two estimator calls per step. Arguments are the same as solve_euler."""
+        inputs = self.prepare_cfg_inputs(x, mu, mask, spks, cond, streaming=streaming)
+        guidance = build_cfg_guidance(cfg_schedule, t_span)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+            dphi_dt = self.cfg_velocity(x, t, inputs, streaming, guidance[step - 1])
+            dphi_dt = self.cfg_velocity(x + 0.5 * dt * dphi_dt, t + 0.5 * dt, inputs, streaming, guidance[step - 1])
+            x = x + dt * dphi_dt
+        return x.float()
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_schedule=None):
+        """Heun solver (explicit trapezoid), second order, two estimator calls per step. Arguments are the same as solve_euler."""
+        inputs = self.prepare_cfg_inputs(x, mu, mask, spks, cond, streaming=streaming)
+        guidance = build_cfg_guidance(cfg_schedule, t_span)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+            dphi_dt = self.cfg_velocity(x, t, inputs, streaming, guidance[step - 1])
+            next_dphi_dt = self.cfg_velocity(x + dt * dphi_dt, t + dt, inputs, streaming, guidance[step - 1])
+            x = x + 0.5 * dt * (dphi_dt + next_dphi_dt)
+        return x.float()
+
+    def solve_adams_bashforth(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_schedule=None):
+        """Two step Adams-Bashforth solver, second order, one estimator call per step like euler.
+
+        Velocity of the previous step is reused, with variable step size of the cosine t_span.
+        The first step has no history and falls back to euler. Arguments are the same as solve_euler.
+        """
+        inputs = self.prepare_cfg_inputs(x, mu, mask, spks, cond, streaming=streaming)
+        guidance = build_cfg_guidance(cfg_schedule, t_span)
+        last_dphi_dt, last_dt = None, None
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+            dphi_dt = self.cfg_velocity(x, t, inputs, streaming, guidance[step - 1])
+            if last_dphi_dt is None:
+                x = x + dt * dphi_dt
+            else:
+                ratio = dt / last_dt
+                x = x + dt * ((1 + 0.5 * ratio) * dphi_dt - 0.5 * ratio * last_dphi_dt)
+            last_dphi_dt, last_dt = dphi_dt, dt
+        return x.float()
+
     def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+        elif isinstance(self.estimator, OnnxSessionWrapper):
+            onnx_sessions = self.estimator.acquire_estimator()
+            try:
+                estimator = onnx_sessions[streaming]
+                # onnx estimator is exported in fp32, bind torch memory to avoid copies
+                inputs = [i.float().contiguous() for i in [x, mask, mu, t, spks, cond]]
+                output = torch.empty_like(inputs[0])
+                io_binding = estimator.io_binding()
+                for name, i in zip(['x', 'mask', 'mu', 't', 'spks', 'cond'], inputs):
+                    io_binding.bind_input(name, i.device.type, i.device.index or 0, np.float32, list(i.shape), i.data_ptr())
+                io_binding.bind_output('estimator_out', output.device.type, output.device.index or 0, np.float32, list(output.shape), output.data_ptr())
+                if output.is_cuda:
+                    torch.cuda.current_stream().synchronize()
+                estimator.run_with_iobinding(io_binding)
+            finally:
+                self.estimator.release_estimator(onnx_sessions)
+            return output.to(x.dtype)
         else:
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
             # NOTE need to synchronize when switching stream
             torch.cuda.current_stream().synchronize()
             with stream:
-                estimator.set_input_shape('x', (2, 80, x.size(2)))
-                estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                estimator.set_input_shape('t', (2,))
-                estimator.set_input_shape('spks', (2, 80))
-                estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                estimator.set_input_shape('t', (x.size(0),))
+                estimator.set_input_shape('spks', (x.size(0), 80))
+                estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 data_ptrs = [x.contiguous().data_ptr(),
                              mask.contiguous().data_ptr(),
                              mu.contiguous().data_ptr(),
@@ -196,11 +334,27 @@ class ConditionalCFM(BASECFM):
 class CausalConditionalCFM(ConditionalCFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(in_channels, cfm_params, n_spks, spk_emb_dim, estimator)
-        set_all_random_seed(0)
-        self.rand_noise = torch.randn([1, 80, 50 * 300])
+        # NOTE same noise as seeding the global rng with 0, without touching the global rng
+        self.rand_noise = torch.randn([1, 80, 50 * 300], generator=torch.Generator().manual_seed(0))
+        # seeded noise is drawn in blocks of 30s
+        self.noise_block_len = 50 * 30
+
+    def sample_noise(self, mel_len, generator=None):
+        """Noise of mel frames [0, mel_len), shape (1, 80, mel_len)
+
+        A frame gets the same noise in every call of a request, so stream chunks agree with each other and with
+        non stream inference. Requests without generator share rand_noise.
+        """
+        if generator is None:
+            return self.rand_noise[:, :, :mel_len]
+        # restart the stream of the request, fixed size blocks keep the noise of a frame independent of mel_len
+        generator.manual_seed(generator.initial_seed())
+        num_blocks = max((mel_len + self.noise_block_len - 1) // self.noise_block_len, 1)
+        noise = [torch.randn([1, 80, self.noise_block_len], generator=generator, device=generator.device) for _ in range(num_blocks)]
+        return torch.concat(noise, dim=2)[:, :, :mel_len]
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, solver=None, cfg_schedule=None, generator=None):
         """Forward diffusion
 
         Args:
@@ -213,15 +367,20 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ode solver in ODE_SOLVERS. Defaults to None, which uses cfm_params.solver.
+            cfg_schedule (str, optional): steps with classifier-free guidance, see build_cfg_guidance. Defaults to None, every step.
+            generator (torch.Generator or list, optional): random stream of the request, or a list of one stream or None per row.
+                Defaults to None, rand_noise.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        generators = generator if isinstance(generator, list) else [generator] * mu.size(0)
+        z = torch.concat([self.sample_noise(mu.size(2), i).to(mu.device) for i in generators], dim=0).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, solver=solver, cfg_schedule=cfg_schedule), None
@@ -0,0 +1,26 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from cosyvoice.utils.cache import LRUCache
+
+
+class FlowPromptCache(LRUCache):
+    """LRU cache of flow conditions which only depend on the speaker prompt, bounded by entry number.
+
+    Key is the hash of prompt token, prompt feat and embedding, value is a dict of tensors,
+    see CausalMaskedDiffWithXvec.inference_prompt. Cached value is never modified in place,
+    encoder forward_chunk concatenates new attention cache into new tensors.
+    """
+
+    def __init__(self, max_size=16):
+        super().__init__(max_size)
@@ -32,6 +32,7 @@ from torch.distributions.uniform import Uniform
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
+from cosyvoice.utils.sampling import random_like
 
 
 """hifigan based generator implementation.
@@ -138,9 +139,10 @@ class SineGen(torch.nn.Module):
         return uv
 
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, generator=None):
         """
         :param f0: [B, 1, sample_len], Hz
+        :param generator: random stream of the request, or a list of one stream or None per row, None for global rng
         :return: [B, 1, sample_len]
         """
 
@@ -149,8 +151,11 @@ class SineGen(torch.nn.Module):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+        if generator is None:
+            u_dist = Uniform(low=-np.pi, high=np.pi)
+            phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+        else:
+            phase_vec = (random_like(F_mat[:, :, :1], generator) * 2 - 1) * np.pi
         phase_vec[:, 0, :] = 0
 
         # generate sine waveforms
@@ -163,7 +168,7 @@ class SineGen(torch.nn.Module):
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = noise_amp * (torch.randn_like(sine_waves) if generator is None else random_like(sine_waves, generator, normal=True))
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -204,7 +209,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, generator=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
@@ -213,7 +218,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), generator=generator)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -258,7 +263,7 @@ class SineGen2(torch.nn.Module):
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
-    def _f02sine(self, f0_values):
+    def _f02sine(self, f0_values, generator=None):
         """ f0_values: (batchsize, length, dim)
             where dim indicates fundamental tone and overtones
         """
@@ -267,7 +272,10 @@ class SineGen2(torch.nn.Module):
         rad_values = (f0_values / self.sampling_rate) % 1
 
         # initial phase noise (no noise for fundamental component)
-        rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2], device=f0_values.device)
+        if generator is None:
+            rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2], device=f0_values.device)
+        else:
+            rand_ini = random_like(f0_values[:, 0, :], generator)
         rand_ini[:, 0] = 0
         rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
 
@@ -311,10 +319,11 @@ class SineGen2(torch.nn.Module):
             sines = torch.cos(i_phase * 2 * np.pi)
         return sines
 
-    def forward(self, f0):
+    def forward(self, f0, generator=None):
         """ sine_tensor, uv = forward(f0)
         input F0: tensor(batchsize=1, length, dim=1)
                   f0 for unvoiced steps should be 0
+        input generator: random stream of the request, or a list of one stream or None per row, None for global rng
         output sine_tensor: tensor(batchsize=1, length, dim)
         output uv: tensor(batchsize=1, length, 1)
         """
@@ -322,7 +331,7 @@ class SineGen2(torch.nn.Module):
         fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
 
         # generate sine waveforms
-        sine_waves = self._f02sine(fn) * self.sine_amp
+        sine_waves = self._f02sine(fn, generator) * self.sine_amp
 
         # generate uv signal
         uv = self._f02uv(f0)
@@ -331,7 +340,7 @@ class SineGen2(torch.nn.Module):
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = noise_amp * (torch.randn_like(sine_waves) if generator is None else random_like(sine_waves, generator, normal=True))
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -372,7 +381,7 @@ class SourceModuleHnNSF2(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, generator=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
@@ -381,7 +390,7 @@ class SourceModuleHnNSF2(torch.nn.Module):
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x)
+            sine_wavs, uv, _ = self.l_sin_gen(x, generator=generator)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
 
         # source for noise branch, in the same shape as uv
@@ -568,12 +577,12 @@ class HiFTGenerator(nn.Module):
         return generated_speech, f0
 
     @torch.inference_mode()
-    def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+    def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0), generator=None) -> torch.Tensor:
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
-        # f0->source
+        # f0->source, generator is the random stream of sine phase and noise of the request, or a list of them of each row
         s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
+        s, _, _ = self.m_source(s, generator=generator)
         s = s.transpose(1, 2)
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
@@ -16,17 +16,18 @@ import queue
 import random
 import time
 import threading
-from typing import Dict, Optional, Callable, List, Generator
+from typing import Dict, Optional, Callable, List, Generator, Union
 import torch
 from torch import nn
 import torch.nn.functional as F
-from transformers import Qwen2ForCausalLM
+from transformers import Qwen2ForCausalLM, DynamicCache, StaticCache
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
+from cosyvoice.utils.sampling import TokenHistory, mask_eos
 
 
 class TransformerLM(torch.nn.Module):
@@ -147,19 +148,15 @@ class TransformerLM(torch.nn.Module):
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: Union[List, TokenHistory],
             sampling: int,
-            ignore_eos: bool = True,
+            ignore_eos: Union[bool, torch.Tensor] = True,
+            generator: Union[None, torch.Generator, List] = None,
     ):
-        num_trials, max_trials = 0, 100
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
-            num_trials += 1
-            if num_trials > max_trials:
-                raise RuntimeError('sampling reaches max_trials {} and still get eos when ignore_eos is True, check your input!'.format(max_trials))
-        return top_ids
+        # weighted_scores is [V] or [B, V], ignore_eos is a bool or a bool tensor [B],
+        # generator is None for global rng, or the torch.Generator of the request, or a list of them of each row
+        weighted_scores = mask_eos(weighted_scores, self.speech_token_size, ignore_eos)
+        return self.sampling(weighted_scores, decoded_tokens, sampling, generator=generator)
 
     @torch.inference_mode()
     def inference(
@@ -175,6 +172,7 @@ class TransformerLM(torch.nn.Module):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            generator: torch.Generator = None,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
@@ -206,24 +204,35 @@ class TransformerLM(torch.nn.Module):
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
         # 5. step by step decode
-        out_tokens = []
+        history = TokenHistory(device=device)
         offset = 0
-        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # static cache is only implemented by TransformerEncoderLayer, conformer layers also need the cnn cache,
+        # and jit exported llm only has forward_chunk, they concatenate into a growing cache every step
+        static = hasattr(self.llm, 'forward_chunk_static') and all(hasattr(layer, 'forward_static') for layer in self.llm.encoders)
+        if static is True:
+            # every step writes lm_input to the cache, so lm_input and max_len - 1 decoded tokens at most
+            att_cache = self.llm.init_static_cache(lm_input.size(1) + max_len)
+        else:
+            att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            if static is True:
+                y_pred = self.llm.forward_chunk_static(lm_input, offset=offset, att_cache=att_cache)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                                     device=lm_input.device)).to(torch.bool))
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
             # force continue decode first token
             if i == 0:
                 logp[:, self.speech_token_size] = -float('inf')
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), history, sampling, ignore_eos=True if i < min_len else False, generator=generator)
+            history.append(top_ids)
+            top_ids = top_ids.item()
             if top_ids == self.speech_token_size:
                 break
             # in stream mode, yield token one by one
             yield top_ids
-            out_tokens.append(top_ids)
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
@@ -244,20 +253,44 @@ class Qwen2Encoder(torch.nn.Module):
         )
         return outs.hidden_states[-1], masks.unsqueeze(1)
 
-    def forward_one_step(self, xs, masks, cache=None):
+    def forward_one_step(self, xs, masks, cache=None, position_ids=None):
         input_masks = masks[:, -1, :]
-        outs = self.model(
+        # only run the transformer body, lm_head logits and hidden states of other layers are never used
+        outs = self.model.model(
             inputs_embeds=xs,
             attention_mask=input_masks,
-            output_hidden_states=True,
+            position_ids=position_ids,
             return_dict=True,
             use_cache=True,
             past_key_values=cache,
         )
-        xs = outs.hidden_states[-1]
+        xs = outs.last_hidden_state
         new_cache = outs.past_key_values
         return xs, new_cache
 
+    def init_static_cache(self, max_len, prefix=None):
+        """Preallocate kv cache of max_len positions for one sequence, prefix is an optional legacy kv cache copied to the front"""
+        param = next(self.parameters())
+        cache = StaticCache(self.model.config, max_batch_size=1, max_cache_len=max_len, device=param.device, dtype=param.dtype)
+        if prefix is not None:
+            cache_position = torch.arange(prefix[0][0].size(2), device=param.device)
+            for layer_idx, (k, v) in enumerate(prefix):
+                cache.update(k.to(param.dtype), v.to(param.dtype), layer_idx, {'cache_position': cache_position})
+        return cache
+
+    def forward_static(self, xs, cache, offset):
+        """Run xs at positions [offset, offset + T) with a StaticCache, causal mask is derived from the positions inside qwen2"""
+        cache_position = torch.arange(offset, offset + xs.size(1), device=xs.device)
+        outs = self.model.model(
+            inputs_embeds=xs,
+            position_ids=cache_position.unsqueeze(dim=0),
+            cache_position=cache_position,
+            return_dict=True,
+            use_cache=True,
+            past_key_values=cache,
+        )
+        return outs.last_hidden_state
+
 
 class Qwen2LM(TransformerLM):
     def __init__(
@@ -438,8 +471,10 @@ class Qwen2LM(TransformerLM):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            generator: torch.Generator = None,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
+        prompt_text_token = prompt_text
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
         text = self.llm.model.model.embed_tokens(text)
@@ -457,57 +492,102 @@ class Qwen2LM(TransformerLM):
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
-        # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        # 5. reuse kv cache of [sos, prompt_text], which is shared by all sentences of the same prompt
+        # NOTE prompt speech token can not join the cached prefix, the model is trained with the target text between prompt text
+        # and prompt speech token, so their kv depends on every sentence, and moving them to the front changes the trained input.
+        # only 1 + prompt_text_len positions are skipped, measure the gain with tools/benchmark_prefix_cache.py before enabling it
+        cache = None
+        if hasattr(self, 'prefix_cache') and not hasattr(self, 'vllm'):
+            cache, lm_input = self.get_prefix_cache(prompt_text_token, lm_input[:, :1 + prompt_text_token.shape[1]]), lm_input[:, 1 + prompt_text_token.shape[1]:]
+
+        # 6. step by step decode
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, cache=cache, generator=generator):
             yield token
 
+    def get_prefix_cache(self, prompt_text, prefix_input):
+        key = self.prefix_cache.hash(prompt_text)
+        cache = self.prefix_cache.get(key)
+        if cache is None:
+            _, cache = self.llm.forward_one_step(prefix_input,
+                                                 masks=torch.ones((1, 1, prefix_input.shape[1]), device=prefix_input.device, dtype=torch.bool),
+                                                 cache=None)
+            cache = cache.to_legacy_cache()
+            self.prefix_cache.put(key, cache)
+        return cache
+
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, cache=None, generator=None):
+        """Decode speech tokens of lm_input, cache is the optional legacy kv cache of the input before lm_input,
+        generator is the random stream of the request, None for global rng"""
         if hasattr(self, 'vllm'):
             from vllm import SamplingParams, RequestOutput
+            # vllm keeps a per request random stream itself, only pass the seed
             sampling_params = SamplingParams(top_k=sampling,
                                              stop_token_ids=self.stop_token_ids,
                                              min_tokens=min_len,
-                                             max_tokens=max_len)
+                                             max_tokens=max_len,
+                                             seed=generator.initial_seed() if generator is not None else None)
             with self.lock:
                 self.vllm.add_request(uuid, {"prompt_embeds": lm_input.squeeze(0).to(torch.bfloat16).to(lm_input.device)}, sampling_params)
                 self.vllm_output_queue[uuid] = queue.Queue()
-            out_tokens = []
-            while True:
+            out_tokens, finished = [], False
+            try:
+                while True:
+                    with self.lock:
+                        if self.vllm_output_queue[uuid].empty() is True:
+                            request_outputs: List[RequestOutput] = self.vllm.step()
+                            for request_output in request_outputs:
+                                top_ids = list(request_output.outputs[0].token_ids)[-1]
+                                self.vllm_output_queue[request_output.request_id].put(top_ids)
+                    if self.vllm_output_queue[uuid].empty() is False:
+                        top_ids = self.vllm_output_queue[uuid].get()
+                        if top_ids in self.stop_token_ids:
+                            break
+                        # in stream mode, yield token one by one
+                        yield top_ids
+                        out_tokens.append(top_ids)
+                        if len(out_tokens) == max_len:
+                            break
+                    time.sleep(0.001)
+                finished = True
+            finally:
                 with self.lock:
-                    if self.vllm_output_queue[uuid].empty() is True:
-                        request_outputs: List[RequestOutput] = self.vllm.step()
-                        for request_output in request_outputs:
-                            top_ids = list(request_output.outputs[0].token_ids)[-1]
-                            self.vllm_output_queue[request_output.request_id].put(top_ids)
-                if self.vllm_output_queue[uuid].empty() is False:
-                    top_ids = self.vllm_output_queue[uuid].get()
-                    if top_ids in self.stop_token_ids:
+                    # generator is closed before the request finishes, free its vllm slot and kv blocks
+                    if finished is False:
+                        self.vllm.abort_request(uuid)
+                    self.vllm_output_queue.pop(uuid)
+        elif hasattr(self, 'scheduler'):
+            session = self.scheduler.add_request(uuid, lm_input, sampling, min_len, max_len, cache=cache, generator=generator)
+            try:
+                while True:
+                    top_ids = session.output_queue.get()
+                    if top_ids is None:
                         break
+                    if isinstance(top_ids, Exception):
+                        raise top_ids
                     # in stream mode, yield token one by one
                     yield top_ids
-                    out_tokens.append(top_ids)
-                    if len(out_tokens) == max_len:
-                        break
-                time.sleep(0.001)
-            with self.lock:
-                self.vllm_output_queue.pop(uuid)
+            finally:
+                # no-op if the session already left, otherwise it leaves at the next decode step
+                session.cancelled = True
         else:
-            out_tokens = []
-            cache = None
+            history = TokenHistory(device=lm_input.device)
+            # every step writes lm_input to the cache, so prefix, lm_input and max_len - 1 decoded tokens at most
+            offset = cache[0][0].size(2) if cache is not None else 0
+            cache = self.llm.init_static_cache(offset + lm_input.size(1) + max_len, prefix=cache)
             for i in range(max_len):
-                y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                          masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
-                                                          cache=cache)
+                y_pred = self.llm.forward_static(lm_input, cache, offset)
+                offset += lm_input.size(1)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), history, sampling, ignore_eos=True if i < min_len else False, generator=generator)
+                history.append(top_ids, mask=top_ids < self.speech_token_size)
+                top_ids = top_ids.item()
                 if top_ids == self.speech_token_size:
                     break
                 if top_ids > self.speech_token_size:
                     continue
                 # in stream mode, yield token one by one
                 yield top_ids
-                out_tokens.append(top_ids)
                 lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
     @torch.inference_mode()
@@ -522,6 +602,7 @@ class Qwen2LM(TransformerLM):
             sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
+            generator: torch.Generator = None,
     ) -> Generator[torch.Tensor, None, None]:
 
         device = prompt_text.device
@@ -570,14 +651,14 @@ class Qwen2LM(TransformerLM):
                 while True:
                     seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
                     y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                              masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                              masks=torch.ones((1, 1, seq_len), device=lm_input.device, dtype=torch.bool),
                                                               cache=cache)
                     logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
                     if next_fill_index != -1 and len(out_tokens) == next_fill_index:
                         top_ids = self.speech_token_size + 2
                         next_fill_index += (self.mix_ratio[1] + 1)
                     else:
-                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True).item()
+                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True, generator=generator).item()
                     if top_ids == self.speech_token_size + 2:
                         next_fill_index = len(out_tokens) + self.mix_ratio[1] + 1
                         logging.info('fill_token index {} next fill_token index {}'.format(len(out_tokens), next_fill_index))
@@ -596,10 +677,10 @@ class Qwen2LM(TransformerLM):
         while True:
             seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
             y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                      masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                      masks=torch.ones((1, 1, seq_len), device=lm_input.device, dtype=torch.bool),
                                                       cache=cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False).item()
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False, generator=generator).item()
             out_tokens.append(top_ids)
             if top_ids >= self.speech_token_size:
                 if top_ids == self.speech_token_size:
@@ -0,0 +1,31 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from cosyvoice.utils.cache import LRUCache
+
+
+class PrefixKVCache(LRUCache):
+    """LRU cache of llm kv states of shared prompt prefix, bounded by total tensor bytes.
+
+    Cached value is a legacy kv cache tuple, it is never modified in place, because
+    DynamicCache.update concatenates new kv into new tensors.
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes)
+
+    def size(self, cache):
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in cache)
+
+    def stats(self):
+        return {**super().stats(), 'bytes': self.total_size}
@@ -0,0 +1,184 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from contextlib import nullcontext
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.sampling import TokenHistory
+
+
+class LLMSession:
+
+    def __init__(self, uuid, lm_input, sampling, min_len, max_len, cache=None, generator=None):
+        self.uuid = uuid
+        self.lm_input = lm_input
+        # optional legacy kv cache of shared prefix before lm_input
+        self.cache = cache
+        self.sampling = sampling
+        self.min_len = min_len
+        self.max_len = max_len
+        # random stream of the request, None for global rng
+        self.generator = generator
+        # number of decode steps, including fill tokens which are not yielded
+        self.step = 0
+        # number of valid kv positions, used as position id of next input
+        self.position = 0
+        self.out_tokens = []
+        self.output_queue = queue.Queue()
+        # set by the consumer when it stops reading, the session leaves at the next token boundary
+        self.cancelled = False
+
+
+class Qwen2LMScheduler:
+    """Continuous batching scheduler for Qwen2LM decoding.
+
+    All active sessions share one batched Qwen2 forward per decode step. Each session
+    owns one row of a left padded kv cache, sessions join after their own prefill and
+    leave as soon as they meet eos or max_len, both at token boundaries.
+    """
+
+    def __init__(self, llm, max_batch_size=16, fp16=False):
+        self.llm = llm
+        self.max_batch_size = max_batch_size
+        self.fp16 = fp16
+        self.device = next(llm.parameters()).device
+        self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
+        self.waiting_queue = queue.Queue()
+        # running sessions, index i owns row i of cache, attention_mask and history
+        self.running = []
+        self.cache = None
+        self.attention_mask = None
+        self.history = None
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def add_request(self, uuid, lm_input, sampling, min_len, max_len, cache=None, generator=None):
+        session = LLMSession(uuid, lm_input, sampling, min_len, max_len, cache=cache, generator=generator)
+        self.waiting_queue.put(session)
+        return session
+
+    def loop(self):
+        with torch.inference_mode(), self.llm_context, torch.cuda.amp.autocast(self.fp16 is True):
+            while True:
+                # block when there is nothing to decode
+                if len(self.running) == 0:
+                    self.admit(self.waiting_queue.get())
+                while len(self.running) < self.max_batch_size and self.waiting_queue.empty() is False:
+                    self.admit(self.waiting_queue.get())
+                if len(self.running) == 0:
+                    continue
+                try:
+                    self.decode_one_step()
+                except Exception as e:
+                    logging.error('scheduler decode failed {}'.format(e))
+                    for session in self.running:
+                        session.output_queue.put(e)
+                    self.running, self.cache, self.attention_mask, self.history = [], None, None, None
+
+    def admit(self, session):
+        # consumer is gone while waiting, skip its prefill
+        if session.cancelled is True:
+            return
+        prefix_len = session.cache[0][0].size(2) if session.cache is not None else 0
+        try:
+            y_pred, cache = self.llm.llm.forward_one_step(session.lm_input,
+                                                          masks=torch.ones((1, 1, prefix_len + session.lm_input.shape[1]), device=self.device, dtype=torch.bool),
+                                                          cache=DynamicCache.from_legacy_cache(session.cache) if session.cache is not None else None)
+        except Exception as e:
+            logging.error('scheduler prefill failed {}'.format(e))
+            session.output_queue.put(e)
+            return
+        session.position, session.cache = prefix_len + session.lm_input.shape[1], None
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        top_ids = self.llm.sampling_ids(logp.squeeze(dim=0), session.out_tokens, session.sampling, ignore_eos=True if session.step < session.min_len else False,
+                                        generator=session.generator).item()
+        if self.update(session, top_ids) is True:
+            self.join(session, cache)
+
+    def update(self, session, top_ids):
+        """Handle sampled token of one session, return whether the session keeps decoding."""
+        session.step += 1
+        if top_ids == self.llm.speech_token_size:
+            session.output_queue.put(None)
+            return False
+        # fill token, keep last input unchanged
+        if top_ids < self.llm.speech_token_size:
+            session.output_queue.put(top_ids)
+            session.out_tokens.append(top_ids)
+            session.lm_input = self.llm.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+        if session.step == session.max_len:
+            session.output_queue.put(None)
+            return False
+        return True
+
+    def join(self, session, cache):
+        cache = cache.to_legacy_cache()
+        mask = torch.ones((1, cache[0][0].size(2)), device=self.device, dtype=torch.bool)
+        history = TokenHistory(device=self.device)
+        for token in session.out_tokens:
+            history.append(torch.tensor([token], device=self.device))
+        if len(self.running) == 0:
+            self.cache, self.attention_mask, self.history = cache, mask, history
+        else:
+            self.history.concat(history)
+            pad_len = self.attention_mask.size(1) - mask.size(1)
+            old_pad, new_pad = max(-pad_len, 0), max(pad_len, 0)
+            self.attention_mask = torch.concat([F.pad(self.attention_mask, (old_pad, 0), value=False),
+                                                F.pad(mask, (new_pad, 0), value=False)], dim=0)
+            self.cache = tuple((torch.concat([F.pad(k, (0, 0, old_pad, 0)), F.pad(new_k, (0, 0, new_pad, 0))], dim=0),
+                                torch.concat([F.pad(v, (0, 0, old_pad, 0)), F.pad(new_v, (0, 0, new_pad, 0))], dim=0))
+                               for (k, v), (new_k, new_v) in zip(self.cache, cache))
+        self.running.append(session)
+
+    def leave(self, finished):
+        keep = [i for i in range(len(self.running)) if i not in finished]
+        self.running = [self.running[i] for i in keep]
+        if len(self.running) == 0:
+            self.cache, self.attention_mask, self.history = None, None, None
+            return
+        index = torch.tensor(keep, device=self.device)
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        self.history.index_select(index)
+        # drop left padding columns which are no longer used by any session
+        start = int(self.attention_mask.any(dim=0).int().argmax().item())
+        self.attention_mask = self.attention_mask[:, start:]
+        self.cache = tuple((k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:]) for k, v in self.cache)
+
+    def decode_one_step(self):
+        lm_input = torch.concat([session.lm_input for session in self.running], dim=0)
+        position_ids = torch.tensor([[session.position] for session in self.running], device=self.device)
+        attention_mask = torch.concat([self.attention_mask, torch.ones((len(self.running), 1), device=self.device, dtype=torch.bool)], dim=1)
+        y_pred, cache = self.llm.llm.forward_one_step(lm_input,
+                                                      masks=attention_mask.unsqueeze(dim=1),
+                                                      cache=DynamicCache.from_legacy_cache(self.cache),
+                                                      position_ids=position_ids)
+        self.cache, self.attention_mask = cache.to_legacy_cache(), attention_mask
+        # sample all sessions at once, sampling argument is not used by ras_sampling so take the first one
+        logp = self.llm.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        ignore_eos = torch.tensor([session.step < session.min_len for session in self.running], device=self.device)
+        # each seeded session draws from its own stream, so its tokens do not depend on the other sessions of the batch
+        generator = [session.generator for session in self.running]
+        top_ids = self.llm.sampling_ids(logp, self.history, self.running[0].sampling, ignore_eos=ignore_eos,
+                                        generator=generator if any(i is not None for i in generator) else None)
+        self.history.append(top_ids, mask=top_ids < self.llm.speech_token_size)
+        finished = []
+        for i, (session, this_top_ids) in enumerate(zip(self.running, top_ids.tolist())):
+            session.position += 1
+            if session.cancelled is True or self.update(session, this_top_ids) is False:
+                finished.append(i)
+        if len(finished) != 0:
+            self.leave(finished)
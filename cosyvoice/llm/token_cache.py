@@ -0,0 +1,25 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from cosyvoice.utils.cache import LRUCache
+
+
+class SpeechTokenCache(LRUCache):
+    """LRU cache of speech tokens decoded by llm, bounded by entry number.
+
+    Key is the hash of llm input, sampling config and seed, see CosyVoiceModel.token_cache_key,
+    value is the list of speech tokens of a finished llm job.
+    """
+
+    def __init__(self, max_size=1024):
+        super().__init__(max_size)
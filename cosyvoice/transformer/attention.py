@@ -193,8 +193,39 @@ class MultiHeadedAttention(nn.Module):
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
 
+        return self.forward_scores(q, k, v, mask, pos_emb), new_cache
+
+    def forward_scores(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+    ) -> torch.Tensor:
+        """Compute attention output of (#batch, n_head, time, d_k) q, k, v."""
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
-        return self.forward_attention(v, scores, mask), new_cache
+        return self.forward_attention(v, scores, mask)
+
+    @torch.jit.unused
+    def forward_static(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        cache: torch.Tensor,
+        offset: int,
+    ) -> torch.Tensor:
+        """Same as forward, but cache (1, head, max_t, d_k * 2) is preallocated,
+        KEY & VALUE of this chunk are written in place at [offset, offset + time1).
+        """
+        q, k, v = self.forward_qkv(query, key, value)
+        end = offset + q.size(2)
+        cache[:, :, offset:end] = torch.cat((k, v), dim=-1)
+        k, v = torch.split(cache[:, :, :end], cache.size(-1) // 2, dim=-1)
+        return self.forward_scores(q, k, v, mask, pos_emb)
 
 
 class RelPositionMultiHeadedAttention(MultiHeadedAttention):
@@ -274,7 +305,6 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
                 and `head * d_k == size`
         """
         q, k, v = self.forward_qkv(query, key, value)
-        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
 
         # NOTE(xcsong):
         #   when export onnx model, for 1st chunk, we feed
@@ -302,6 +332,18 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
 
+        return self.forward_scores(q, k, v, mask, pos_emb), new_cache
+
+    def forward_scores(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+    ) -> torch.Tensor:
+        """Compute attention output of (#batch, n_head, time, d_k) q, k, v with rel. positional encoding."""
+        q = q.transpose(1, 2)  # (batch, time1, head, d_k)
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
         p = p.transpose(1, 2)  # (batch, head, time1, d_k)
@@ -327,4 +369,4 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         scores = (matrix_ac + matrix_bd) / math.sqrt(
             self.d_k)  # (batch, head, time1, time2)
 
-        return self.forward_attention(v, scores, mask), new_cache
+        return self.forward_attention(v, scores, mask)
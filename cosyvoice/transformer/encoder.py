@@ -271,6 +271,58 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def init_static_cache(self, max_len: int) -> torch.Tensor:
+        """Preallocate attention cache of max_len frames for forward_chunk_static,
+            with shape (elayers, head, max_len, d_k * 2)
+        """
+        param = next(self.parameters())
+        self_attn = self.encoders[0].self_attn
+        return torch.zeros((len(self.encoders), self_attn.h, max_len, self_attn.d_k * 2), device=param.device, dtype=param.dtype)
+
+    @torch.jit.unused
+    def forward_chunk_static(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        att_cache: torch.Tensor,
+    ) -> torch.Tensor:
+        """ Forward just one chunk with a preallocated attention cache
+
+        Same as forward_chunk with required_cache_size < 0, but KEY & VALUE of
+        this chunk are written in place into att_cache at [offset, offset + time)
+        instead of being concatenated into a new cache, and the causal mask is
+        built from offset. Only transformer layers without cnn_module are supported.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim)
+            offset (int): number of frames already in att_cache
+            att_cache (torch.Tensor): cache from init_static_cache
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, time, hidden-dim).
+        """
+        assert xs.size(0) == 1
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, offset)
+        chunk_size = xs.size(1)
+        assert offset + chunk_size <= att_cache.size(2), 'static cache of {} frames is full'.format(att_cache.size(2))
+        pos_emb = self.embed.position_encoding(offset=0, size=offset + chunk_size)
+        if chunk_size > 1:
+            att_mask = torch.ones((1, chunk_size, offset + chunk_size), device=xs.device, dtype=torch.bool).tril(offset)
+        else:
+            # one query attends all keys, use fake mask
+            att_mask = torch.ones((0, 0, 0), device=xs.device, dtype=torch.bool)
+        for i, layer in enumerate(self.encoders):
+            xs = layer.forward_static(xs, att_mask, pos_emb, att_cache[i:i + 1], offset)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
@@ -105,6 +105,34 @@ class TransformerEncoderLayer(nn.Module):
         fake_cnn_cache = torch.zeros((0, 0, 0), dtype=x.dtype, device=x.device)
         return x, mask, new_att_cache, fake_cnn_cache
 
+    @torch.jit.unused
+    def forward_static(
+        self,
+        x: torch.Tensor,
+        mask: torch.Tensor,
+        pos_emb: torch.Tensor,
+        att_cache: torch.Tensor,
+        offset: int,
+    ) -> torch.Tensor:
+        """Same as forward, but att_cache (#batch=1, head, max_t, d_k * 2) is
+        preallocated and updated in place at [offset, offset + time).
+        """
+        residual = x
+        if self.normalize_before:
+            x = self.norm1(x)
+        x_att = self.self_attn.forward_static(x, x, x, mask, pos_emb, att_cache, offset)
+        x = residual + self.dropout(x_att)
+        if not self.normalize_before:
+            x = self.norm1(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm2(x)
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm2(x)
+        return x
+
 
 class ConformerEncoderLayer(nn.Module):
     """Encoder layer module.
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
 import torch
 from torch import nn
@@ -32,6 +32,7 @@ from cosyvoice.utils.class_utils import (
 )
 from cosyvoice.utils.mask import make_pad_mask
 from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import subsequent_chunk_mask
 
 
 class Upsample1D(nn.Module):
@@ -62,6 +63,20 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, input_lengths: torch.Tensor,
+                      cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        cache: last stride * 2 upsampled frames of previous chunk, (batch_size, channels, stride * 2)
+        """
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.stride * 2, 0), value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -self.stride * 2:]
+        outputs = self.conv(outputs)
+        return outputs, input_lengths * self.stride, new_cache
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, channels: int, pre_lookahead_len: int = 1):
@@ -101,6 +116,34 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor = torch.zeros(0, 0, 0),
+                      cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, seq_len, channels)
+        cache: conv1 outputs of last frames of previous chunk, (batch_size, channels, conv2.kernel_size - 1)
+        """
+        outputs = inputs.transpose(1, 2).contiguous()
+        context = context.transpose(1, 2).contiguous()
+        # look ahead
+        if context.size(2) == 0:
+            outputs = F.pad(outputs, (0, self.pre_lookahead_len), mode='constant', value=0.0)
+        else:
+            assert context.size(2) == self.pre_lookahead_len
+            outputs = torch.concat([outputs, context], dim=2)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        # NOTE conv1 output of previous chunk is computed with real lookahead context, so it can be reused
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.conv2.kernel_size[0] - 1, 0), mode='constant', value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        new_cache = outputs[:, :, -(self.conv2.kernel_size[0] - 1):]
+        outputs = self.conv2(outputs)
+        outputs = outputs.transpose(1, 2).contiguous()
+
+        # residual connection
+        outputs = outputs + inputs
+        return outputs, new_cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -318,3 +361,71 @@ class UpsampleConformerEncoder(torch.nn.Module):
         for layer in self.up_encoders:
             xs, chunk_masks, _, _ = layer(xs, chunk_masks, pos_emb, mask_pad)
         return xs
+
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor = torch.zeros(0, 0, 0),
+        cache: Optional[Dict] = None,
+    ) -> Tuple[torch.Tensor, Dict]:
+        """Streaming encode the tokens after those already in cache.
+
+        The output is the same as the corresponding part of forward(streaming=True) on the
+        whole prefix, given that every segment except the last one ends at chunk boundary.
+
+        Args:
+            xs: new input tensor (1, T, D)
+            context: pre lookahead context (1, pre_lookahead_len, D), empty for the last segment
+            cache: cache returned by previous segment, None for the first segment
+        Returns:
+            xs: output tensor of new input (1, T * up_layer.stride, D)
+            cache: cache for next segment
+        """
+        assert xs.size(0) == 1
+        assert self.static_chunk_size > 0, 'forward_chunk only supports static chunk streaming encoder'
+        assert all(layer.conv_module is None for layer in self.encoders) and all(layer.conv_module is None for layer in self.up_encoders), \
+            'forward_chunk does not support conformer conv module'
+        if cache is None:
+            cache = {'offset': 0,
+                     'pre_lookahead_layer': torch.zeros(0, 0, 0), 'encoders': torch.zeros(0, 0, 0, 0),
+                     'up_layer': torch.zeros(0, 0, 0), 'up_encoders': torch.zeros(0, 0, 0, 0)}
+        offset = cache['offset']
+        assert offset % self.static_chunk_size == 0, 'every streaming segment except the last one should end at chunk boundary'
+        masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, masks)
+        if context.size(1) != 0:
+            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context, _, _ = self.embed(context, context_masks, offset=xs.size(1))
+        # lookahead + conformer encoder
+        xs, pre_lookahead_cache = self.pre_lookahead_layer.forward_chunk(xs, context=context, cache=cache['pre_lookahead_layer'])
+        xs, encoders_cache = self.forward_layers_chunk(xs, self.encoders, self.embed, offset, self.static_chunk_size, cache['encoders'])
+
+        # upsample + conformer encoder
+        xs = xs.transpose(1, 2).contiguous()
+        xs, _, up_layer_cache = self.up_layer.forward_chunk(xs, masks.sum(dim=-1).squeeze(dim=1), cache=cache['up_layer'])
+        xs = xs.transpose(1, 2).contiguous()
+        masks = torch.ones(1, 1, xs.size(1), device=xs.device, dtype=torch.bool)
+        xs, _, _ = self.up_embed(xs, masks)
+        xs, up_encoders_cache = self.forward_layers_chunk(xs, self.up_encoders, self.up_embed, offset * self.up_layer.stride,
+                                                          self.static_chunk_size * self.up_layer.stride, cache['up_encoders'])
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        cache = {'offset': offset + xs.size(1) // self.up_layer.stride,
+                 'pre_lookahead_layer': pre_lookahead_cache, 'encoders': encoders_cache,
+                 'up_layer': up_layer_cache, 'up_encoders': up_encoders_cache}
+        return xs, cache
+
+    def forward_layers_chunk(self, xs: torch.Tensor, layers: torch.nn.ModuleList, embed: torch.nn.Module,
+                             offset: int, chunk_size: int, att_cache: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # new frames see all cached frames and the chunks of their own up to themselves
+        pos_emb = embed.position_encoding(offset=0, size=offset + xs.size(1))
+        chunk_masks = torch.concat([torch.ones(xs.size(1), offset, device=xs.device, dtype=torch.bool),
+                                    subsequent_chunk_mask(xs.size(1), chunk_size, device=xs.device)], dim=1).unsqueeze(dim=0)
+        r_att_cache = []
+        for i, layer in enumerate(layers):
+            xs, _, new_att_cache, _ = layer(xs, chunk_masks, pos_emb, att_cache=att_cache[i:i + 1] if att_cache.size(0) > 0 else att_cache)
+            r_att_cache.append(new_att_cache)
+        return xs, torch.concat(r_att_cache, dim=0)
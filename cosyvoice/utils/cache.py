@@ -0,0 +1,92 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""LRU cache shared by the inference caches of llm, flow, frontend and synthesized speech."""
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+
+
+def tensor_hash(*args):
+    """sha1 of args, a tensor is hashed by its shape and bytes, anything else by its repr"""
+    m = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg, torch.Tensor):
+            m.update(str(tuple(arg.shape)).encode())
+            m.update(arg.detach().cpu().numpy().tobytes())
+        else:
+            m.update(repr(arg).encode())
+    return m.hexdigest()
+
+
+class LRUCache:
+    """Thread safe LRU cache with hit and miss counters, bounded by the total size of its values.
+
+    The size of a value is 1 by default, so max_size is the entry number, subclasses override size()
+    for a byte budget, and get() or put() to keep entries on disk.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    hash = staticmethod(tensor_hash)
+
+    def size(self, value):
+        return 1
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.cache:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+    def put(self, key, value):
+        """Insert or replace key, return the keys evicted to make room for it, a value larger than max_size is not cached"""
+        size = self.size(value)
+        if size > self.max_size:
+            return []
+        with self.lock:
+            self.discard(key)
+            self.cache[key] = value
+            self.total_size += size
+            return self.evict()
+
+    def discard(self, key):
+        # NOTE caller holds self.lock
+        if key in self.cache:
+            self.total_size -= self.size(self.cache.pop(key))
+
+    def evict(self):
+        # NOTE caller holds self.lock
+        evicted = []
+        while self.total_size > self.max_size:
+            key, value = self.cache.popitem(last=False)
+            self.total_size -= self.size(value)
+            evicted.append(key)
+        return evicted
+
+    def __len__(self):
+        return len(self.cache)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.cache)}
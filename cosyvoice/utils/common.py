@@ -22,6 +22,9 @@ from typing import List
 
 import numpy as np
 import torch
+import torch.nn.functional as F
+
+from cosyvoice.utils.sampling import TokenHistory, top_k_top_p_sampling, multinomial_sampling, repetition_aware_sampling
 
 IGNORE_ID = -1
 
@@ -107,36 +110,32 @@ def init_weights(m, mean=0.0, std=0.01):
         m.weight.data.normal_(mean, std)
 
 
+def _sampling_input(weighted_scores, decoded_tokens, win_size):
+    """Convert scores [V] or [B, V] and decoded_tokens (list of one row or TokenHistory) to batched form."""
+    scores = weighted_scores.unsqueeze(dim=0) if weighted_scores.dim() == 1 else weighted_scores
+    if isinstance(decoded_tokens, TokenHistory):
+        window = decoded_tokens.window(win_size)
+    else:
+        window = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long, device=scores.device).reshape(1, -1)
+    return scores, window
+
+
 # Repetition Aware Sampling in VALL-E 2
-def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
-    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
-    return top_ids
-
-
-def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
-    return top_ids
-
-
-def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
-    return top_ids
+def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, generator=None):
+    scores, window = _sampling_input(weighted_scores, decoded_tokens, win_size)
+    # pad window of short history, so that threshold is always win_size * tau_r
+    window = F.pad(window, (0, win_size - window.size(1)), value=-1)
+    return repetition_aware_sampling(scores, window, top_p=top_p, top_k=top_k, tau_r=tau_r, generator=generator)
+
+
+def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25, generator=None):
+    scores = weighted_scores.unsqueeze(dim=0) if weighted_scores.dim() == 1 else weighted_scores
+    return top_k_top_p_sampling(scores, top_p=top_p, top_k=top_k, generator=generator)
+
+
+def random_sampling(weighted_scores, decoded_tokens, sampling, generator=None):
+    scores = weighted_scores.unsqueeze(dim=0) if weighted_scores.dim() == 1 else weighted_scores
+    return multinomial_sampling(scores, generator)
 
 
 def fade_in_out(fade_in_mel, fade_out_mel, window):
@@ -157,6 +156,11 @@ def set_all_random_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
+def get_generators(seed, device, stages=('llm', 'flow', 'hift')):
+    """Independent random streams of each stage of one request, the global rng is left untouched"""
+    return {stage: torch.Generator(device=device).manual_seed(seed * len(stages) + i) for i, stage in enumerate(stages)}
+
+
 def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     assert mask.dtype == torch.bool
     assert dtype in [torch.float32, torch.bfloat16, torch.float16]
@@ -184,3 +188,26 @@ class TrtContextWrapper:
 
     def release_estimator(self, context, stream):
         self.trt_context_pool.put([context, stream])
+
+
+class OnnxSessionWrapper:
+    def __init__(self, onnx_models, onnx_concurrent=1, device='cpu'):
+        """onnx_models maps streaming to onnx model path, estimator without a streaming graph ignores streaming"""
+        import onnxruntime
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # concurrent sessions share the threads torch is allowed to use
+        option.intra_op_num_threads = max(1, torch.get_num_threads() // onnx_concurrent)
+        providers = ['CUDAExecutionProvider'] if torch.device(device).type == 'cuda' else ['CPUExecutionProvider']
+        self.onnx_session_pool = queue.Queue(maxsize=onnx_concurrent)
+        for _ in range(onnx_concurrent):
+            onnx_sessions = {k: onnxruntime.InferenceSession(v, sess_options=option, providers=providers) for k, v in onnx_models.items()}
+            onnx_sessions.setdefault(True, onnx_sessions[False])
+            self.onnx_session_pool.put(onnx_sessions)
+        assert self.onnx_session_pool.empty() is False, 'no avaialbe estimator session'
+
+    def acquire_estimator(self):
+        return self.onnx_session_pool.get()
+
+    def release_estimator(self, onnx_sessions):
+        self.onnx_session_pool.put(onnx_sessions)
@@ -88,6 +88,49 @@ def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     logging.info("Succesfully convert onnx to trt...")
 
 
+class StreamingEstimator(torch.nn.Module):
+    """Causal flow decoder estimator with streaming chunk attention mask, for onnx export"""
+
+    def __init__(self, estimator):
+        super().__init__()
+        self.estimator = estimator
+
+    def forward(self, x, mask, mu, t, spks, cond):
+        return self.estimator(x, mask, mu, t, spks, cond, streaming=True)
+
+
+@torch.no_grad()
+def export_estimator_onnx(estimator, onnx_model, streaming, device):
+    """Export flow decoder estimator with dynamic batch size and length, for onnxruntime"""
+    logging.info('Exporting estimator to {}...'.format(onnx_model))
+    batch_size, seq_len = 2, 256
+    out_channels = estimator.out_channels
+    x = torch.rand((batch_size, out_channels, seq_len), dtype=torch.float32, device=device)
+    mask = torch.ones((batch_size, 1, seq_len), dtype=torch.float32, device=device)
+    t = torch.rand((batch_size), dtype=torch.float32, device=device)
+    spks = torch.rand((batch_size, out_channels), dtype=torch.float32, device=device)
+    torch.onnx.export(
+        StreamingEstimator(estimator) if streaming is True else estimator,
+        (x, mask, x, t, spks, x),
+        onnx_model,
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['x', 'mask', 'mu', 't', 'spks', 'cond'],
+        output_names=['estimator_out'],
+        dynamic_axes={
+            'x': {0: 'batch_size', 2: 'seq_len'},
+            'mask': {0: 'batch_size', 2: 'seq_len'},
+            'mu': {0: 'batch_size', 2: 'seq_len'},
+            't': {0: 'batch_size'},
+            'spks': {0: 'batch_size'},
+            'cond': {0: 'batch_size', 2: 'seq_len'},
+            'estimator_out': {0: 'batch_size', 2: 'seq_len'},
+        }
+    )
+    logging.info('Succesfully export estimator...')
+
+
 def export_cosyvoice2_vllm(model, model_path, device):
     if os.path.exists(model_path):
         return
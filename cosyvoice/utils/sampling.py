@@ -0,0 +1,110 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batched sampling kernels over [B, V] scores, without python loop or device sync."""
+import torch
+
+
+class TokenHistory:
+    """Ring buffer of the last decoded tokens of each row, unused slots are -1."""
+
+    def __init__(self, batch_size=1, size=64, device=torch.device('cpu')):
+        self.size = size
+        self.tokens = torch.full((batch_size, size), -1, dtype=torch.long, device=device)
+        # number of tokens appended to each row
+        self.count = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def __len__(self):
+        return self.tokens.size(0)
+
+    def append(self, ids, mask=None):
+        """Append ids [B] to each row, rows where mask is False are left unchanged."""
+        rows = torch.arange(len(self), device=self.tokens.device)
+        pos = self.count % self.size
+        ids = ids.reshape(-1).to(self.tokens)
+        if mask is not None:
+            ids = torch.where(mask, ids, self.tokens[rows, pos])
+            self.count += mask.long()
+        else:
+            self.count += 1
+        self.tokens[rows, pos] = ids
+
+    def window(self, win_size):
+        """Return the last win_size tokens of each row as [B, win_size], most recent first."""
+        assert win_size <= self.size, 'win_size {} is larger than history size {}'.format(win_size, self.size)
+        pos = (self.count.unsqueeze(1) - 1 - torch.arange(win_size, device=self.tokens.device)) % self.size
+        # rows with less than win_size tokens wrap to slots which are never written, so they read -1
+        return self.tokens.gather(1, pos)
+
+    def index_select(self, index):
+        self.tokens, self.count = self.tokens.index_select(0, index), self.count.index_select(0, index)
+
+    def concat(self, other):
+        self.tokens, self.count = torch.concat([self.tokens, other.tokens], dim=0), torch.concat([self.count, other.count], dim=0)
+
+
+def random_like(x, generator=None, normal=False):
+    """Uniform or normal noise of the shape of x, drawn from generator.
+
+    generator is None for the global rng, a torch.Generator, or a list with one generator or None per row of x,
+    so that rows of different requests in one batch draw from their own stream.
+    """
+    sample = torch.randn if normal is True else torch.rand
+    if isinstance(generator, list):
+        return torch.concat([random_like(x[i:i + 1], g, normal) for i, g in enumerate(generator)], dim=0)
+    return sample(x.shape, generator=generator, device=generator.device if generator is not None else x.device).to(x)
+
+
+def probs_sampling(probs, generator=None):
+    """Sample one index per row of probs [B, V], which do not need to sum to 1, return [B, 1]."""
+    if generator is None:
+        return probs.multinomial(1, replacement=True)
+    # inverse transform sampling with one uniform of each row, u is in (0, cdf[-1]], so the first index whose cdf reaches u
+    # always exists and has nonzero probability, scaling by probs.sum() instead may round past cdf[-1] onto a zero probability tail
+    cdf = probs.cumsum(dim=-1)
+    u = (1 - random_like(probs[:, :1], generator)) * cdf[:, -1:]
+    return torch.searchsorted(cdf, u)
+
+
+def top_k_top_p_sampling(scores, top_p=0.8, top_k=25, generator=None):
+    """Sample one id per row of scores [B, V] from the smallest top_k set whose probability reaches top_p."""
+    probs, indices = scores.softmax(dim=-1).topk(min(top_k, scores.size(-1)), dim=-1)
+    # keep a token while the probability before it is still less than top_p
+    keep = (probs.cumsum(dim=-1) - probs) < top_p
+    probs = probs.masked_fill(~keep, 0)
+    return indices.gather(-1, probs_sampling(probs, generator)).squeeze(dim=-1)
+
+
+def multinomial_sampling(scores, generator=None):
+    return probs_sampling(scores.softmax(dim=-1), generator).squeeze(dim=-1)
+
+
+def repetition_aware_sampling(scores, window, top_p=0.8, top_k=25, tau_r=0.1, generator=None):
+    """Repetition Aware Sampling in VALL-E 2, window [B, win_size] holds recent tokens of each row, -1 for empty."""
+    top_ids = top_k_top_p_sampling(scores, top_p=top_p, top_k=top_k, generator=generator)
+    rep_num = (window == top_ids.unsqueeze(dim=-1)).sum(dim=-1)
+    repeated = rep_num >= window.size(-1) * tau_r
+    if not repeated.any():
+        return top_ids
+    # resample only the repeated rows, so that the other rows do not draw from their stream
+    index = repeated.nonzero().squeeze(dim=-1)
+    if isinstance(generator, list):
+        generator = [generator[i] for i in index.tolist()]
+    return top_ids.index_put((index,), multinomial_sampling(scores.index_select(0, index), generator))
+
+
+def mask_eos(scores, eos_id, ignore_eos):
+    """Forbid eos_id in rows where ignore_eos is True, ignore_eos is a bool or a bool tensor [B]."""
+    ignore_eos = torch.as_tensor(ignore_eos, device=scores.device)
+    scores[..., eos_id] = scores[..., eos_id].masked_fill(ignore_eos, -float('inf'))
+    return scores
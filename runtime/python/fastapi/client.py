@@ -20,6 +20,21 @@ import numpy as np
 
 
 def main():
+    if args.mode in ['register', 'list', 'delete']:
+        url = "http://{}:{}/speakers".format(args.host, args.port)
+        if args.mode == 'register':
+            payload = {
+                'zero_shot_spk_id': args.zero_shot_spk_id,
+                'prompt_text': args.prompt_text
+            }
+            files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+            response = requests.request("POST", url, data=payload, files=files)
+        elif args.mode == 'list':
+            response = requests.request("GET", url)
+        else:
+            response = requests.request("DELETE", '{}/{}'.format(url, args.zero_shot_spk_id))
+        logging.info('get response {} {}'.format(response.status_code, response.text))
+        return
     url = "http://{}:{}/inference_{}".format(args.host, args.port, args.mode)
     if args.mode == 'sft':
         payload = {
@@ -30,15 +45,19 @@ def main():
     elif args.mode == 'zero_shot':
         payload = {
             'tts_text': args.tts_text,
-            'prompt_text': args.prompt_text
+            'prompt_text': args.prompt_text,
+            'zero_shot_spk_id': args.zero_shot_spk_id
         }
-        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+        # registered speaker replaces prompt wav upload, see register mode
+        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))] if args.zero_shot_spk_id == '' else []
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     elif args.mode == 'cross_lingual':
         payload = {
             'tts_text': args.tts_text,
+            'zero_shot_spk_id': args.zero_shot_spk_id
         }
-        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+        # registered speaker replaces prompt wav upload, see register mode
+        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))] if args.zero_shot_spk_id == '' else []
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     else:
         payload = {
@@ -66,8 +85,8 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
-                        help='request mode')
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'register', 'list', 'delete'],
+                        help='request mode, register/list/delete manage zero shot speakers')
     parser.add_argument('--tts_text',
                         type=str,
                         default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
@@ -80,6 +99,10 @@ if __name__ == "__main__":
     parser.add_argument('--prompt_wav',
                         type=str,
                         default='../../../asset/zero_shot_prompt.wav')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='registered speaker used instead of prompt_wav, or speaker to register/delete')
     parser.add_argument('--instruct_text',
                         type=str,
                         default='Theo \'Crimson\', is a fiery, passionate rebel leader. \
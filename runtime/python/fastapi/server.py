@@ -16,8 +16,9 @@ import sys
 import argparse
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException
 from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import numpy as np
@@ -25,6 +26,7 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.cli.engine import AsyncEngine, EngineOverloaded, EngineUnavailable
 from cosyvoice.utils.file_utils import load_wav
 
 app = FastAPI()
@@ -37,48 +39,122 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+def to_pcm(model_output):
+    return (model_output['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+
+
+async def generate_data(first_output, model_output):
+    if first_output is None:
+        return
+    yield to_pcm(first_output)
+    async for i in model_output:
+        yield to_pcm(i)
+
+
+async def stream(func, *args):
+    """Run func(*args) in engine, wait first output so that overload is returned as 429/503 instead of a broken stream."""
+    try:
+        model_output = engine.submit(func, *args)
+        first_output = await model_output.__anext__()
+    except StopAsyncIteration:
+        first_output = None
+    except EngineOverloaded as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except EngineUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return StreamingResponse(generate_data(first_output, model_output))
+
+
+def check_prompt(prompt_wav, zero_shot_spk_id):
+    """A request either uploads prompt wav or references a registered speaker, whose frontend features are reused."""
+    if zero_shot_spk_id != '':
+        if zero_shot_spk_id not in cosyvoice.frontend.spk2info:
+            raise HTTPException(status_code=404, detail='speaker {} is not registered'.format(zero_shot_spk_id))
+        return None
+    if prompt_wav is None:
+        raise HTTPException(status_code=400, detail='either prompt_wav or zero_shot_spk_id is required')
+    return prompt_wav.file
+
+
+# prompt wav is loaded in engine worker, so that it does not block the event loop
+def load_prompt(prompt_wav):
+    return load_wav(prompt_wav, 16000) if prompt_wav is not None else None
+
+
+def zero_shot_job(tts_text, prompt_text, prompt_wav, zero_shot_spk_id):
+    return cosyvoice.inference_zero_shot(tts_text, prompt_text, load_prompt(prompt_wav), zero_shot_spk_id)
+
+
+def cross_lingual_job(tts_text, prompt_wav, zero_shot_spk_id):
+    return cosyvoice.inference_cross_lingual(tts_text, load_prompt(prompt_wav), zero_shot_spk_id)
+
+
+def instruct2_job(tts_text, instruct_text, prompt_wav, zero_shot_spk_id):
+    return cosyvoice.inference_instruct2(tts_text, instruct_text, load_prompt(prompt_wav), zero_shot_spk_id)
 
 
 @app.get("/inference_sft")
 @app.post("/inference_sft")
 async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+    return await stream(cosyvoice.inference_sft, tts_text, spk_id)
 
 
 @app.get("/inference_zero_shot")
 @app.post("/inference_zero_shot")
-async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(''), prompt_wav: UploadFile = File(None), zero_shot_spk_id: str = Form('')):
+    return await stream(zero_shot_job, tts_text, prompt_text, check_prompt(prompt_wav, zero_shot_spk_id), zero_shot_spk_id)
 
 
 @app.get("/inference_cross_lingual")
 @app.post("/inference_cross_lingual")
-async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File(None), zero_shot_spk_id: str = Form('')):
+    return await stream(cross_lingual_job, tts_text, check_prompt(prompt_wav, zero_shot_spk_id), zero_shot_spk_id)
 
 
 @app.get("/inference_instruct")
 @app.post("/inference_instruct")
 async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+    return await stream(cosyvoice.inference_instruct, tts_text, spk_id, instruct_text)
 
 
 @app.get("/inference_instruct2")
 @app.post("/inference_instruct2")
-async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File(None), zero_shot_spk_id: str = Form('')):
+    return await stream(instruct2_job, tts_text, instruct_text, check_prompt(prompt_wav, zero_shot_spk_id), zero_shot_spk_id)
+
+
+@app.post("/speakers")
+async def register_speaker(zero_shot_spk_id: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
+    """Extract frontend features of prompt once and store them, synthesis requests then only send zero_shot_spk_id"""
+    if zero_shot_spk_id == '':
+        raise HTTPException(status_code=400, detail='zero_shot_spk_id should not be empty')
+    await run_in_threadpool(lambda: cosyvoice.add_zero_shot_spk(prompt_text, load_wav(prompt_wav.file, 16000), zero_shot_spk_id))
+    return {'zero_shot_spk_id': zero_shot_spk_id}
+
+
+@app.get("/speakers")
+async def list_speakers():
+    return {'spk_ids': cosyvoice.list_available_spks()}
+
+
+@app.delete("/speakers/{zero_shot_spk_id}")
+async def delete_speaker(zero_shot_spk_id: str):
+    if cosyvoice.del_zero_shot_spk(zero_shot_spk_id) is False:
+        raise HTTPException(status_code=404, detail='speaker {} is not registered'.format(zero_shot_spk_id))
+    return {'zero_shot_spk_id': zero_shot_spk_id}
+
+
+@app.get("/stats")
+async def stats():
+    return {**engine.stats(), **cosyvoice.model.sessions.stats(), 'speaker_store': cosyvoice.frontend.spk2info.stats(),
+            'synthesis_cache': cosyvoice.synthesis_cache.stats() if cosyvoice.synthesis_cache is not None else None,
+            'token_cache': cosyvoice.model.token_cache.stats() if hasattr(cosyvoice.model, 'token_cache') else None,
+            'prompt_cache': cosyvoice.frontend.prompt_cache.stats() if cosyvoice.frontend.prompt_cache is not None else None}
+
+
+@app.get("/sessions")
+async def sessions():
+    return cosyvoice.model.sessions.info()
 
 
 if __name__ == '__main__':
@@ -90,12 +166,33 @@ if __name__ == '__main__':
                         type=str,
                         default='iic/CosyVoice-300M',
                         help='local path or modelscope repo id')
+    parser.add_argument('--max_active',
+                        type=int,
+                        default=4,
+                        help='max number of requests synthesized at the same time')
+    parser.add_argument('--max_queue',
+                        type=int,
+                        default=16,
+                        help='max number of waiting requests, more requests get 429')
+    parser.add_argument('--max_queue_time',
+                        type=float,
+                        default=10,
+                        help='requests waiting longer than this get 503')
+    parser.add_argument('--synthesis_cache_mb',
+                        type=int,
+                        default=0,
+                        help='cache speech of repeated utterances up to this size, 0 means no cache')
+    parser.add_argument('--synthesis_cache_dir',
+                        type=str,
+                        default='',
+                        help='keep synthesis cache on disk in this dir, in memory if empty')
     args = parser.parse_args()
     try:
-        cosyvoice = CosyVoice(args.model_dir)
+        cosyvoice = CosyVoice(args.model_dir, synthesis_cache_mb=args.synthesis_cache_mb, synthesis_cache_dir=args.synthesis_cache_dir)
     except Exception:
         try:
-            cosyvoice = CosyVoice2(args.model_dir)
+            cosyvoice = CosyVoice2(args.model_dir, synthesis_cache_mb=args.synthesis_cache_mb, synthesis_cache_dir=args.synthesis_cache_dir)
         except Exception:
             raise TypeError('no valid model_type!')
+    engine = AsyncEngine(max_active=args.max_active, max_queue=args.max_queue, max_queue_time=args.max_queue_time)
     uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -27,9 +27,28 @@ import numpy as np
 from cosyvoice.utils.file_utils import load_wav
 
 
+def prompt_audio():
+    # registered speaker replaces prompt audio upload, see register mode
+    if args.zero_shot_spk_id != '' and args.mode != 'register':
+        return b''
+    prompt_speech = load_wav(args.prompt_wav, 16000)
+    return (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+
+
 def main():
     with grpc.insecure_channel("{}:{}".format(args.host, args.port)) as channel:
         stub = cosyvoice_pb2_grpc.CosyVoiceStub(channel)
+        if args.mode in ['register', 'list', 'delete']:
+            if args.mode == 'register':
+                register_request = cosyvoice_pb2.registerSpeakerRequest(zero_shot_spk_id=args.zero_shot_spk_id, prompt_text=args.prompt_text,
+                                                                        prompt_audio=prompt_audio())
+                response = stub.RegisterSpeaker(register_request)
+            elif args.mode == 'list':
+                response = stub.ListSpeakers(cosyvoice_pb2.listSpeakersRequest())
+            else:
+                response = stub.DeleteSpeaker(cosyvoice_pb2.deleteSpeakerRequest(zero_shot_spk_id=args.zero_shot_spk_id))
+            logging.info('get response {}'.format(list(response.spk_ids)))
+            return
         request = cosyvoice_pb2.Request()
         if args.mode == 'sft':
             logging.info('send sft request')
@@ -42,15 +61,15 @@ def main():
             zero_shot_request = cosyvoice_pb2.zeroshotRequest()
             zero_shot_request.tts_text = args.tts_text
             zero_shot_request.prompt_text = args.prompt_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            zero_shot_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+            zero_shot_request.prompt_audio = prompt_audio()
+            zero_shot_request.zero_shot_spk_id = args.zero_shot_spk_id
             request.zero_shot_request.CopyFrom(zero_shot_request)
         elif args.mode == 'cross_lingual':
             logging.info('send cross_lingual request')
             cross_lingual_request = cosyvoice_pb2.crosslingualRequest()
             cross_lingual_request.tts_text = args.tts_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            cross_lingual_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+            cross_lingual_request.prompt_audio = prompt_audio()
+            cross_lingual_request.zero_shot_spk_id = args.zero_shot_spk_id
             request.cross_lingual_request.CopyFrom(cross_lingual_request)
         else:
             logging.info('send instruct request')
@@ -80,8 +99,8 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
-                        help='request mode')
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'register', 'list', 'delete'],
+                        help='request mode, register/list/delete manage zero shot speakers')
     parser.add_argument('--tts_text',
                         type=str,
                         default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
@@ -94,6 +113,10 @@ if __name__ == "__main__":
     parser.add_argument('--prompt_wav',
                         type=str,
                         default='../../../asset/zero_shot_prompt.wav')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='registered speaker used instead of prompt_wav, or speaker to register/delete')
     parser.add_argument('--instruct_text',
                         type=str,
                         default='Theo \'Crimson\', is a fiery, passionate rebel leader. \
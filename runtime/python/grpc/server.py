@@ -34,30 +34,50 @@ logging.basicConfig(level=logging.DEBUG,
 class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
     def __init__(self, args):
         try:
-            self.cosyvoice = CosyVoice(args.model_dir, trt_concurrent=args.max_conc)
+            self.cosyvoice = CosyVoice(args.model_dir, trt_concurrent=args.max_conc, synthesis_cache_mb=args.synthesis_cache_mb,
+                                       synthesis_cache_dir=args.synthesis_cache_dir)
         except Exception:
             try:
-                self.cosyvoice = CosyVoice2(args.model_dir, trt_concurrent=args.max_conc)
+                self.cosyvoice = CosyVoice2(args.model_dir, trt_concurrent=args.max_conc, synthesis_cache_mb=args.synthesis_cache_mb,
+                                            synthesis_cache_dir=args.synthesis_cache_dir)
             except Exception:
                 raise TypeError('no valid model_type!')
         logging.info('grpc service initialized')
 
+    def prompt_speech(self, prompt_audio, zero_shot_spk_id, context):
+        """A request either sends prompt audio or references a registered speaker, whose frontend features are reused."""
+        if zero_shot_spk_id != '':
+            if zero_shot_spk_id not in self.cosyvoice.frontend.spk2info:
+                context.abort(grpc.StatusCode.NOT_FOUND, 'speaker {} is not registered'.format(zero_shot_spk_id))
+            return None
+        if len(prompt_audio) == 0:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'either prompt_audio or zero_shot_spk_id is required')
+        prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
+        return prompt_speech_16k.float() / (2**15)
+
     def Inference(self, request, context):
         if request.HasField('sft_request'):
             logging.info('get sft inference request')
             model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
         elif request.HasField('zero_shot_request'):
             logging.info('get zero_shot inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.zero_shot_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
+            prompt_speech_16k = self.prompt_speech(request.zero_shot_request.prompt_audio, request.zero_shot_request.zero_shot_spk_id, context)
             model_output = self.cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
                                                               request.zero_shot_request.prompt_text,
-                                                              prompt_speech_16k)
+                                                              prompt_speech_16k,
+                                                              request.zero_shot_request.zero_shot_spk_id)
         elif request.HasField('cross_lingual_request'):
             logging.info('get cross_lingual inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.cross_lingual_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k)
+            prompt_speech_16k = self.prompt_speech(request.cross_lingual_request.prompt_audio, request.cross_lingual_request.zero_shot_spk_id, context)
+            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k,
+                                                                  request.cross_lingual_request.zero_shot_spk_id)
+        elif request.HasField('instruct2_request'):
+            logging.info('get instruct2 inference request')
+            prompt_speech_16k = self.prompt_speech(request.instruct2_request.prompt_audio, request.instruct2_request.zero_shot_spk_id, context)
+            model_output = self.cosyvoice.inference_instruct2(request.instruct2_request.tts_text,
+                                                              request.instruct2_request.instruct_text,
+                                                              prompt_speech_16k,
+                                                              request.instruct2_request.zero_shot_spk_id)
         else:
             logging.info('get instruct inference request')
             model_output = self.cosyvoice.inference_instruct(request.instruct_request.tts_text,
@@ -65,10 +85,35 @@ class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
                                                              request.instruct_request.instruct_text)
 
         logging.info('send inference response')
-        for i in model_output:
-            response = cosyvoice_pb2.Response()
-            response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-            yield response
+        try:
+            for i in model_output:
+                # client is gone, stop synthesis instead of decoding the rest of the text
+                if context.is_active() is False:
+                    logging.info('client disconnected, cancel inference')
+                    break
+                response = cosyvoice_pb2.Response()
+                response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+                yield response
+        finally:
+            # stop llm threads and release session variables now, also when grpc closes this generator
+            model_output.close()
+
+    def RegisterSpeaker(self, request, context):
+        logging.info('register speaker {}'.format(request.zero_shot_spk_id))
+        if request.zero_shot_spk_id == '':
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'zero_shot_spk_id should not be empty')
+        prompt_speech_16k = self.prompt_speech(request.prompt_audio, '', context)
+        self.cosyvoice.add_zero_shot_spk(request.prompt_text, prompt_speech_16k, request.zero_shot_spk_id)
+        return cosyvoice_pb2.speakerResponse(spk_ids=[request.zero_shot_spk_id])
+
+    def ListSpeakers(self, request, context):
+        return cosyvoice_pb2.speakerResponse(spk_ids=self.cosyvoice.list_available_spks())
+
+    def DeleteSpeaker(self, request, context):
+        logging.info('delete speaker {}'.format(request.zero_shot_spk_id))
+        if self.cosyvoice.del_zero_shot_spk(request.zero_shot_spk_id) is False:
+            context.abort(grpc.StatusCode.NOT_FOUND, 'speaker {} is not registered'.format(request.zero_shot_spk_id))
+        return cosyvoice_pb2.speakerResponse(spk_ids=[request.zero_shot_spk_id])
 
 
 def main():
@@ -92,5 +137,13 @@ if __name__ == '__main__':
                         type=str,
                         default='iic/CosyVoice-300M',
                         help='local path or modelscope repo id')
+    parser.add_argument('--synthesis_cache_mb',
+                        type=int,
+                        default=0,
+                        help='cache speech of repeated utterances up to this size, 0 means no cache')
+    parser.add_argument('--synthesis_cache_dir',
+                        type=str,
+                        default='',
+                        help='keep synthesis cache on disk in this dir, in memory if empty')
     args = parser.parse_args()
     main()
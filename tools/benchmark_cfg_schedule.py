@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare classifier-free guidance schedules of flow matching, report estimator rows, rtf and mel L1 against full guidance."""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from omegaconf import DictConfig
+from cosyvoice.flow.decoder import CausalConditionalDecoder
+from cosyvoice.flow.flow_matching import CausalConditionalCFM, build_cfg_guidance
+
+# 50 mel frames per second of speech in CosyVoice2
+MEL_FRAME_RATE = 50
+
+
+def build_decoder(flow_model, device):
+    # same shape as CosyVoice2-0.5B flow decoder
+    estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[256], dropout=0.0, attention_head_dim=64, n_blocks=4,
+                                         num_mid_blocks=12, num_heads=8, act_fn='gelu', static_chunk_size=50, num_decoding_left_chunks=-1)
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine', 'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    decoder = CausalConditionalCFM(240, cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator)
+    if flow_model != '':
+        state_dict = torch.load(flow_model, map_location='cpu')
+        decoder.load_state_dict({k.replace('decoder.', '', 1): v for k, v in state_dict.items() if k.startswith('decoder.')}, strict=True)
+    return decoder.to(device).eval()
+
+
+@torch.inference_mode()
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    decoder = build_decoder(args.flow_model, device)
+    torch.manual_seed(0)
+    mu = torch.randn(args.batch_size, 80, args.mel_len, device=device)
+    mask = torch.ones(args.batch_size, 1, args.mel_len, device=device)
+    spks = torch.randn(args.batch_size, 80, device=device)
+    cond = torch.zeros(args.batch_size, 80, args.mel_len, device=device)
+    # NOTE first part of cond is prompt feat in inference
+    cond[:, :, :args.mel_len // 3] = torch.randn(args.batch_size, 80, args.mel_len // 3, device=device)
+    t_span = 1 - torch.cos(torch.linspace(0, 1, args.n_timesteps + 1) * 0.5 * torch.pi)
+    # CausalConditionalCFM uses fixed noise, so every schedule starts from the same point
+    reference = decoder(mu, mask, args.n_timesteps, spks=spks, cond=cond, solver=args.solver, cfg_schedule='full')[0]
+    print('cfg_schedule\tguided steps\testimator rows\trtf\tmel l1')
+    for cfg_schedule in args.cfg_schedule:
+        guidance = build_cfg_guidance(cfg_schedule, t_span)
+        # estimator rows relative to full guidance, unguided steps run half batch
+        rows = sum([1.0 if i is True else 0.5 for i in guidance]) / len(guidance)
+        # warmup
+        decoder(mu, mask, args.n_timesteps, spks=spks, cond=cond, solver=args.solver, cfg_schedule=cfg_schedule)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(args.num_runs):
+            feat = decoder(mu, mask, args.n_timesteps, spks=spks, cond=cond, solver=args.solver, cfg_schedule=cfg_schedule)[0]
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        rtf = (time.time() - start_time) / args.num_runs / (args.batch_size * args.mel_len / MEL_FRAME_RATE)
+        l1 = (feat - reference).abs().mean().item()
+        print('{}\t{}/{}\t{:.2f}\t{:.3f}\t{:.4f}'.format(cfg_schedule, sum(guidance), len(guidance), rows, rtf, l1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flow_model', type=str, default='', help='flow.pt of CosyVoice2, use random weights if empty, which only measures speed')
+    parser.add_argument('--cfg_schedule', type=str, nargs='+', default=['full', 'first:7', 'first:5', 'first:3', 'interval:0.0:0.5', 'interval:0.2:0.8', 'none'])
+    parser.add_argument('--solver', type=str, default='euler')
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--mel_len', type=int, default=500)
+    parser.add_argument('--num_runs', type=int, default=3)
+    args = parser.parse_args()
+    main(args)
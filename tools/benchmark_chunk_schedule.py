@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Stream zero shot inference with every chunk schedule, report time to first audio, total time, chunks and rtf."""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
+from cosyvoice.cli.chunk_schedule import CHUNK_SCHEDULES
+from cosyvoice.utils.file_utils import load_wav
+
+
+def single_job(cosyvoice, args, prompt_speech_16k, chunk_schedule):
+    start_time = time.time()
+    first_time, speech_len, num_chunks = None, 0, 0
+    for model_output in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, prompt_speech_16k, stream=True, chunk_schedule=chunk_schedule):
+        if first_time is None:
+            first_time = time.time() - start_time
+        speech_len += model_output['tts_speech'].shape[1] / cosyvoice.sample_rate
+        num_chunks += 1
+    total_time = time.time() - start_time
+    return first_time, total_time, num_chunks, total_time / speech_len
+
+
+def main(args):
+    try:
+        cosyvoice = CosyVoice(args.model_dir)
+    except Exception:
+        try:
+            cosyvoice = CosyVoice2(args.model_dir)
+        except Exception:
+            raise TypeError('no valid model_type!')
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    # warmup, also fills the measured llm and token2wav speed used by adaptive schedule
+    single_job(cosyvoice, args, prompt_speech_16k, 'fixed')
+    print('schedule\tfirst audio(s)\ttotal(s)\tchunks\trtf')
+    for chunk_schedule in args.chunk_schedule:
+        results = np.array([single_job(cosyvoice, args, prompt_speech_16k, chunk_schedule) for _ in range(args.num_runs)])
+        print('{}\t{:.3f}\t{:.3f}\t{:.1f}\t{:.3f}'.format(chunk_schedule, *results.mean(axis=0)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='{}/../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--chunk_schedule', type=str, nargs='+', default=list(CHUNK_SCHEDULES.keys()))
+    parser.add_argument('--num_runs', type=int, default=3)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Load test of runtime/python/fastapi/server.py, report status codes and latency of accepted requests per concurrency."""
+import argparse
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+
+def single_job(url, payload):
+    start_time = time.time()
+    response = requests.request("GET", url, data=payload, stream=True)
+    first_time = None
+    for _ in response.iter_content(chunk_size=16000):
+        if first_time is None:
+            first_time = time.time()
+    end_time = time.time()
+    return response.status_code, (first_time or end_time) - start_time, end_time - start_time
+
+
+def main(args):
+    url = "http://{}:{}/inference_sft".format(args.host, args.port)
+    payload = {'tts_text': args.tts_text, 'spk_id': args.spk_id}
+    print('concurrency\t200\t429\t503\tfirst byte p50/p99(s)\ttotal p50/p99(s)')
+    for concurrency in args.concurrency:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda _: single_job(url, payload), range(concurrency * args.requests_per_client)))
+        codes = Counter(r[0] for r in results)
+        first = np.array([r[1] for r in results if r[0] == 200])
+        total = np.array([r[2] for r in results if r[0] == 200])
+        if len(total) == 0:
+            first, total = np.zeros(1), np.zeros(1)
+        print('{}\t{}\t{}\t{}\t{:.2f}/{:.2f}\t{:.2f}/{:.2f}'.format(concurrency, codes[200], codes[429], codes[503],
+                                                                    np.percentile(first, 50), np.percentile(first, 99),
+                                                                    np.percentile(total, 50), np.percentile(total, 99)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=50000)
+    parser.add_argument('--tts_text', type=str, default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
+    parser.add_argument('--spk_id', type=str, default='中文女')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--requests_per_client', type=int, default=4)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Check incremental flow encode of a stream session against encoding the whole prefix every chunk, report max diff and encode ms.
+
+Every chunk of the session is encoded both ways, the incremental encoder output must match the static chunk mask forward of the whole prefix.
+The final chunk is also compared with full attention encode, which stream sessions used before, that diff is only reported.
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from benchmark_flow_prompt_cache import build_flow
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def encode(flow, token, prompt_token, prompt_feat, embedding, streaming, finalize, flow_cache):
+    synchronize()
+    start_time = time.time()
+    h = flow.inference_encode(token, torch.tensor([token.shape[1]], dtype=torch.int32, device=token.device),
+                              prompt_token, torch.tensor([prompt_token.shape[1]], dtype=torch.int32, device=token.device),
+                              prompt_feat, torch.tensor([prompt_feat.shape[1]], dtype=torch.int32, device=token.device),
+                              embedding, streaming, finalize, flow_cache)[0]
+    synchronize()
+    return h, (time.time() - start_time) * 1000
+
+
+@torch.inference_mode()
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    flow = build_flow(args.flow_model, device)
+    torch.manual_seed(0)
+    prompt_token = torch.randint(0, 6561, (1, args.prompt_len), device=device)
+    prompt_feat = torch.randn(1, args.prompt_len * flow.token_mel_ratio, 80, device=device)
+    embedding = torch.randn(1, 192, device=device)
+    chunk_size = flow.encoder.static_chunk_size
+    print('token_len\tchunks\tincremental ms\tprefix ms\tmax diff\tfinal full attention diff')
+    for num_tokens in args.token_len:
+        token = torch.randint(0, 6561, (1, num_tokens), device=device)
+        flow_cache, incremental_ms, prefix_ms, max_diff, num_chunks = {}, 0, 0, 0, 0
+        token_offset = 0
+        while True:
+            # same as CosyVoice2Model.align_hop, every chunk except the last ends at encoder chunk boundary
+            hop = (args.prompt_len + token_offset + args.token_hop_len + chunk_size - 1) // chunk_size * chunk_size - args.prompt_len - token_offset
+            if token_offset + hop + flow.pre_lookahead_len > num_tokens:
+                break
+            this_token = token[:, :token_offset + hop + flow.pre_lookahead_len]
+            h, ms = encode(flow, this_token, prompt_token, prompt_feat, embedding, True, False, flow_cache)
+            ref_h, ref_ms = encode(flow, this_token, prompt_token, prompt_feat, embedding, True, False, None)
+            incremental_ms, prefix_ms, num_chunks = incremental_ms + ms, prefix_ms + ref_ms, num_chunks + 1
+            max_diff = max(max_diff, (h - ref_h).abs().max().item())
+            token_offset += hop
+        # final chunk decodes with streaming False, but keeps encoding incrementally
+        h, ms = encode(flow, token, prompt_token, prompt_feat, embedding, False, True, flow_cache)
+        ref_h, ref_ms = encode(flow, token, prompt_token, prompt_feat, embedding, True, True, None)
+        full_h, _ = encode(flow, token, prompt_token, prompt_feat, embedding, False, True, None)
+        incremental_ms, prefix_ms, num_chunks = incremental_ms + ms, prefix_ms + ref_ms, num_chunks + 1
+        max_diff = max(max_diff, (h - ref_h).abs().max().item())
+        assert max_diff < args.tolerance, 'incremental encode mismatch, max diff {}'.format(max_diff)
+        full_diff = (h - full_h).abs().max().item()
+        print('{}\t{}\t{:.2f}\t{:.2f}\t{:.1e}\t{:.1e}'.format(num_tokens, num_chunks, incremental_ms, prefix_ms, max_diff, full_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flow_model', type=str, default='', help='flow.pt of CosyVoice2, use random weights if empty')
+    parser.add_argument('--prompt_len', type=int, default=150, help='prompt speech token number, 25 tokens per second')
+    parser.add_argument('--token_len', type=int, nargs='+', default=[50, 200, 500, 1000])
+    parser.add_argument('--token_hop_len', type=int, default=25)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Check ConditionalDecoder prepare/forward_step against the packed per step forward, report max diff and time per step."""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from einops import pack, rearrange, repeat
+from cosyvoice.flow.decoder import ConditionalDecoder, CausalConditionalDecoder
+from cosyvoice.utils.common import mask_to_bias
+
+
+def build_estimator(causal, device):
+    # same shape as CosyVoice-300M and CosyVoice2-0.5B flow decoder
+    if causal is True:
+        estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[256], dropout=0.0, attention_head_dim=64, n_blocks=4,
+                                             num_mid_blocks=12, num_heads=8, act_fn='gelu', static_chunk_size=50, num_decoding_left_chunks=-1)
+    else:
+        estimator = ConditionalDecoder(in_channels=320, out_channels=80, channels=[256, 256], dropout=0.0, attention_head_dim=64, n_blocks=4,
+                                       num_mid_blocks=12, num_heads=8, act_fn='gelu')
+    return estimator.to(device).eval()
+
+
+def packed_forward(estimator, x, mask, mu, t, spks, cond, streaming):
+    """Per step forward before prepare/forward_step split, packs condition and builds attention masks in every call"""
+    t = estimator.time_mlp(estimator.time_embeddings(t).to(t.dtype))
+    x = pack([x, mu, repeat(spks, "b c -> b c t", t=x.shape[-1]), cond], "b * t")[0]
+
+    def transformer(transformer_blocks, x, mask):
+        x = rearrange(x, "b c t -> b t c").contiguous()
+        attn_mask = mask_to_bias(estimator.attention_mask(mask, streaming=streaming), x.dtype)
+        for transformer_block in transformer_blocks:
+            x = transformer_block(hidden_states=x, attention_mask=attn_mask, timestep=t)
+        return rearrange(x, "b t c -> b c t").contiguous()
+
+    hiddens, masks = [], [mask]
+    for resnet, transformer_blocks, downsample in estimator.down_blocks:
+        x = transformer(transformer_blocks, resnet(x, masks[-1], t), masks[-1])
+        hiddens.append(x)
+        x = downsample(x * masks[-1])
+        masks.append(masks[-1][:, :, ::2])
+    masks = masks[:-1]
+    for resnet, transformer_blocks in estimator.mid_blocks:
+        x = transformer(transformer_blocks, resnet(x, masks[-1], t), masks[-1])
+    for resnet, transformer_blocks, upsample in estimator.up_blocks:
+        mask_up, skip = masks.pop(), hiddens.pop()
+        x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
+        x = upsample(transformer(transformer_blocks, resnet(x, mask_up, t), mask_up) * mask_up)
+    x = estimator.final_block(x, mask_up)
+    return estimator.final_proj(x * mask_up) * mask
+
+
+def timeit(func, num_runs):
+    func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(num_runs):
+        output = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / num_runs * 1000, output
+
+
+@torch.inference_mode()
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    print('estimator\tstreaming\tmel_len\tpacked ms/step\tprepare ms\tstep ms/step\tmax diff')
+    for causal in [False, True]:
+        estimator = build_estimator(causal, device)
+        for streaming in ([False, True] if causal is True else [False]):
+            for mel_len in args.mel_len:
+                # classifier-free guidance batch, last half is unconditional branch
+                batch_size = 2 * args.batch_size
+                x = torch.randn(batch_size, 80, mel_len, device=device)
+                mask = torch.ones(batch_size, 1, mel_len, device=device)
+                mask[batch_size // 2 - 1, :, mel_len * 3 // 4:] = 0
+                mu = torch.randn(batch_size, 80, mel_len, device=device)
+                t = torch.rand(batch_size, device=device)
+                spks = torch.randn(batch_size, 80, device=device)
+                cond = torch.randn(batch_size, 80, mel_len, device=device)
+                mu[batch_size // 2:], spks[batch_size // 2:], cond[batch_size // 2:] = 0, 0, 0
+                packed_ms, packed_output = timeit(lambda: packed_forward(estimator, x, mask, mu, t, spks, cond, streaming), args.num_runs)
+                prepare_ms, condition = timeit(lambda: estimator.prepare(mask, mu, spks=spks, cond=cond, streaming=streaming), args.num_runs)
+                step_ms, step_output = timeit(lambda: estimator.forward_step(x, t, condition), args.num_runs)
+                max_diff = (packed_output - step_output).abs().max().item()
+                assert max_diff < args.tolerance, 'forward_step mismatch, max diff {}'.format(max_diff)
+                print('{}\t{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.1e}'.format(type(estimator).__name__, streaming, mel_len, packed_ms, prepare_ms, step_ms, max_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--mel_len', type=int, nargs='+', default=[200, 500, 1000])
+    parser.add_argument('--num_runs', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+    main(args)
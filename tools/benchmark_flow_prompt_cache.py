@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure flow prompt cache on short stream sentences where prompt dominates sequence length, report encode and flow ms and max diff.
+
+Only stream sessions with incremental encode use the cache, non stream inference always computes prompt conditions.
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from omegaconf import DictConfig
+from cosyvoice.flow.decoder import CausalConditionalDecoder
+from cosyvoice.flow.flow import CausalMaskedDiffWithXvec
+from cosyvoice.flow.flow_matching import CausalConditionalCFM
+from cosyvoice.flow.prompt_cache import FlowPromptCache
+from cosyvoice.transformer.upsample_encoder import UpsampleConformerEncoder
+
+
+def build_flow(flow_model, device):
+    # same shape as CosyVoice2-0.5B flow
+    encoder = UpsampleConformerEncoder(input_size=512, output_size=512, attention_heads=8, linear_units=2048, num_blocks=6, dropout_rate=0.1,
+                                       positional_dropout_rate=0.1, attention_dropout_rate=0.1, normalize_before=True, input_layer='linear',
+                                       pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn', use_cnn_module=False,
+                                       macaron_style=False, static_chunk_size=25)
+    estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[256], dropout=0.0, attention_head_dim=64, n_blocks=4,
+                                         num_mid_blocks=12, num_heads=8, act_fn='gelu', static_chunk_size=50, num_decoding_left_chunks=-1)
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine', 'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    decoder = CausalConditionalCFM(240, cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator)
+    flow = CausalMaskedDiffWithXvec(input_size=512, output_size=80, spk_embed_dim=192, vocab_size=6561, input_frame_rate=25, token_mel_ratio=2,
+                                    pre_lookahead_len=3, encoder=encoder, decoder=decoder)
+    if flow_model != '':
+        flow.load_state_dict(torch.load(flow_model, map_location='cpu'), strict=True)
+    return flow.to(device).eval()
+
+
+def timeit(func, num_runs):
+    func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(num_runs):
+        output = func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / num_runs * 1000, output
+
+
+@torch.inference_mode()
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    flow = build_flow(args.flow_model, device)
+    torch.manual_seed(0)
+    prompt_token = torch.randint(0, 6561, (1, args.prompt_len), device=device)
+    prompt_feat = torch.randn(1, args.prompt_len * flow.token_mel_ratio, 80, device=device)
+    embedding = torch.randn(1, 192, device=device)
+    prompt_token_len = torch.tensor([prompt_token.shape[1]], dtype=torch.int32, device=device)
+    prompt_feat_len = torch.tensor([prompt_feat.shape[1]], dtype=torch.int32, device=device)
+    print('token_len\tprompt_len\tencode ms\tcached encode ms\tflow ms\tcached flow ms\tmax diff')
+    for num_tokens in args.token_len:
+        token = torch.randint(0, 6561, (1, num_tokens), device=device)
+        token_len = torch.tensor([num_tokens], dtype=torch.int32, device=device)
+        # NOTE stream session encodes incrementally from a fresh flow cache, a short sentence is one finalize chunk
+        encode = lambda: flow.inference_encode(token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding,
+                                               True, True, {})[0]
+        inference = lambda: flow.inference(token, token_len, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding,
+                                           True, True, {}, n_timesteps=args.n_timesteps)[0]
+        if hasattr(flow, 'prompt_cache'):
+            del flow.prompt_cache
+        encode_ms, h = timeit(encode, args.num_runs)
+        flow_ms, _ = timeit(inference, args.num_runs)
+        # timeit warmup fills the cache, so only hits are measured
+        flow.prompt_cache = FlowPromptCache(max_size=1)
+        cached_encode_ms, cached_h = timeit(encode, args.num_runs)
+        cached_flow_ms, _ = timeit(inference, args.num_runs)
+        max_diff = (h - cached_h).abs().max().item()
+        assert max_diff < args.tolerance, 'prompt cache mismatch, max diff {}'.format(max_diff)
+        print('{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.1e}'.format(num_tokens, args.prompt_len, encode_ms, cached_encode_ms, flow_ms,
+                                                                      cached_flow_ms, max_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flow_model', type=str, default='', help='flow.pt of CosyVoice2, use random weights if empty')
+    parser.add_argument('--prompt_len', type=int, default=150, help='prompt speech token number, 25 tokens per second')
+    parser.add_argument('--token_len', type=int, nargs='+', default=[10, 25, 50, 100])
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--num_runs', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+    main(args)
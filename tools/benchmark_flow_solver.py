@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare ode solvers and step numbers of flow matching, report estimator calls, rtf and mel L1 against 10 step euler reference."""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from omegaconf import DictConfig
+from cosyvoice.flow.decoder import CausalConditionalDecoder
+from cosyvoice.flow.flow_matching import CausalConditionalCFM, ODE_SOLVERS
+
+# 50 mel frames per second of speech in CosyVoice2
+MEL_FRAME_RATE = 50
+# estimator calls per step of each solver
+SOLVER_NFE = {'euler': 1, 'midpoint': 2, 'heun': 2, 'adams_bashforth': 1}
+
+
+def build_decoder(flow_model, device):
+    # same shape as CosyVoice2-0.5B flow decoder
+    estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[256], dropout=0.0, attention_head_dim=64, n_blocks=4,
+                                         num_mid_blocks=12, num_heads=8, act_fn='gelu', static_chunk_size=50, num_decoding_left_chunks=-1)
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine', 'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    decoder = CausalConditionalCFM(240, cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator)
+    if flow_model != '':
+        state_dict = torch.load(flow_model, map_location='cpu')
+        decoder.load_state_dict({k.replace('decoder.', '', 1): v for k, v in state_dict.items() if k.startswith('decoder.')}, strict=True)
+    return decoder.to(device).eval()
+
+
+@torch.inference_mode()
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    decoder = build_decoder(args.flow_model, device)
+    torch.manual_seed(0)
+    mu = torch.randn(args.batch_size, 80, args.mel_len, device=device)
+    mask = torch.ones(args.batch_size, 1, args.mel_len, device=device)
+    spks = torch.randn(args.batch_size, 80, device=device)
+    cond = torch.zeros(args.batch_size, 80, args.mel_len, device=device)
+    # NOTE first part of cond is prompt feat in inference
+    cond[:, :, :args.mel_len // 3] = torch.randn(args.batch_size, 80, args.mel_len // 3, device=device)
+    # CausalConditionalCFM uses fixed noise, so every solver starts from the same point
+    reference = decoder(mu, mask, 10, spks=spks, cond=cond, solver='euler')[0]
+    print('solver\tsteps\tnfe\trtf\tmel l1')
+    for solver in args.solver:
+        for n_timesteps in args.n_timesteps:
+            # warmup
+            decoder(mu, mask, n_timesteps, spks=spks, cond=cond, solver=solver)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start_time = time.time()
+            for _ in range(args.num_runs):
+                feat = decoder(mu, mask, n_timesteps, spks=spks, cond=cond, solver=solver)[0]
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            rtf = (time.time() - start_time) / args.num_runs / (args.batch_size * args.mel_len / MEL_FRAME_RATE)
+            l1 = (feat - reference).abs().mean().item()
+            print('{}\t{}\t{}\t{:.3f}\t{:.4f}'.format(solver, n_timesteps, SOLVER_NFE[solver] * n_timesteps, rtf, l1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flow_model', type=str, default='', help='flow.pt of CosyVoice2, use random weights if empty, which only measures solver error')
+    parser.add_argument('--solver', type=str, nargs='+', default=list(ODE_SOLVERS.keys()))
+    parser.add_argument('--n_timesteps', type=int, nargs='+', default=[2, 4, 5, 6, 8, 10])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--mel_len', type=int, default=500)
+    parser.add_argument('--num_runs', type=int, default=3)
+    args = parser.parse_args()
+    main(args)
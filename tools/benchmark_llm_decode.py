@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare Qwen2Encoder decode steps, report tokens/s of each and max diff of their hidden states against the full causal lm."""
+import argparse
+import os
+import sys
+import time
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.llm.llm import Qwen2Encoder
+
+
+def full_step(llm, lm_input, cache, offset):
+    # previous decode step, full causal lm with hidden states of all layers and a L x L mask
+    masks = torch.tril(torch.ones((1, offset + lm_input.size(1), offset + lm_input.size(1)), dtype=torch.bool))
+    outs = llm.model(inputs_embeds=lm_input, attention_mask=masks[:, -1, :], output_hidden_states=True, return_dict=True, use_cache=True, past_key_values=cache)
+    return outs.hidden_states[-1], outs.past_key_values
+
+
+def lean_step(llm, lm_input, cache, offset):
+    return llm.forward_one_step(lm_input, masks=torch.ones((1, 1, offset + lm_input.size(1)), dtype=torch.bool), cache=cache)
+
+
+def static_step(llm, lm_input, cache, offset):
+    return llm.forward_static(lm_input, cache, offset), cache
+
+
+@torch.inference_mode()
+def benchmark(llm, step, prompt, num_tokens, static=False):
+    """Prefill prompt, then feed back the last hidden state for num_tokens - 1 steps, return tokens/s and the hidden state of every step"""
+    lm_input = prompt
+    cache = llm.init_static_cache(prompt.size(1) + num_tokens) if static is True else None
+    offset, outputs = 0, []
+    start_time = time.time()
+    for i in range(num_tokens):
+        if i == 1:
+            # exclude prefill
+            start_time = time.time()
+        y_pred, cache = step(llm, lm_input, cache, offset)
+        offset += lm_input.size(1)
+        lm_input = y_pred[:, -1:]
+        outputs.append(lm_input)
+    return (num_tokens - 1) / (time.time() - start_time), torch.concat(outputs, dim=1)
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    llm = Qwen2Encoder.__new__(Qwen2Encoder)
+    torch.nn.Module.__init__(llm)
+    if args.pretrain_path != '':
+        llm.model = Qwen2ForCausalLM.from_pretrained(args.pretrain_path)
+    else:
+        # same shape as CosyVoice-BlankEN, with random weights
+        llm.model = Qwen2ForCausalLM(Qwen2Config(vocab_size=151936, hidden_size=896, intermediate_size=4864, num_hidden_layers=24,
+                                                 num_attention_heads=14, num_key_value_heads=2, max_position_embeddings=32768, tie_word_embeddings=True))
+    llm.eval()
+    torch.manual_seed(0)
+    prompt = torch.randn(1, args.prompt_len, llm.model.config.hidden_size)
+    print('path\ttokens/s\tmax diff')
+    reference = None
+    for name, step, static in [('full causal lm', full_step, False), ('transformer body', lean_step, False), ('transformer body + static cache', static_step, True)]:
+        # warmup
+        benchmark(llm, step, prompt, 10, static)
+        speed, outputs = benchmark(llm, step, prompt, args.num_tokens, static)
+        reference = outputs if reference is None else reference
+        max_diff = (outputs - reference).abs().max().item()
+        assert max_diff < args.tolerance, '{} mismatch, max diff {}'.format(name, max_diff)
+        print('{}\t{:.1f}\t{:.1e}'.format(name, speed, max_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrain_path', type=str, default='', help='CosyVoice-BlankEN dir, use random weights if empty')
+    parser.add_argument('--prompt_len', type=int, default=150)
+    parser.add_argument('--num_tokens', type=int, default=200)
+    parser.add_argument('--num_threads', type=int, default=4)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+    main(args)
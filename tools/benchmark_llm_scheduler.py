@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.utils.file_utils import load_wav, logging
+
+
+def single_job(model, model_input, i):
+    device = model.device
+    llm_prompt_speech_token = model_input['llm_prompt_speech_token']
+    num_tokens = 0
+    for _ in model.llm.inference(text=model_input['text'].to(device),
+                                 text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(device),
+                                 prompt_text=model_input['prompt_text'].to(device),
+                                 prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(device),
+                                 prompt_speech_token=llm_prompt_speech_token.to(device),
+                                 prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(device),
+                                 embedding=model_input['llm_embedding'].to(device),
+                                 uuid='benchmark_{}'.format(i)):
+        num_tokens += 1
+    return num_tokens
+
+
+def benchmark(model, model_input, concurrency, num_requests):
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        num_tokens = sum(executor.map(lambda i: single_job(model, model_input, i), range(num_requests)))
+    cost = time.time() - start_time
+    return num_tokens, cost
+
+
+def main(args):
+    cosyvoice = CosyVoice2(args.model_dir)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    prompt_text = cosyvoice.frontend.text_normalize(args.prompt_text, split=False)
+    tts_text = cosyvoice.frontend.text_normalize(args.tts_text, split=True)[0]
+    model_input = cosyvoice.frontend.frontend_zero_shot(tts_text, prompt_text, prompt_speech_16k, cosyvoice.sample_rate, '')
+    # warmup
+    single_job(cosyvoice.model, model_input, 0)
+
+    results = {}
+    for mode in ['sequential', 'scheduler']:
+        if mode == 'scheduler':
+            cosyvoice.model.load_scheduler(max(args.concurrency))
+        for concurrency in args.concurrency:
+            num_tokens, cost = benchmark(cosyvoice.model, model_input, concurrency, concurrency * args.num_rounds)
+            results[(mode, concurrency)] = num_tokens / cost
+            logging.info('mode {} concurrency {} tokens {} cost {:.3f}s throughput {:.2f} tokens/s'.format(mode, concurrency, num_tokens, cost, num_tokens / cost))
+    print('concurrency\tsequential tokens/s\tscheduler tokens/s\tspeedup')
+    for concurrency in args.concurrency:
+        sequential, scheduler = results[('sequential', concurrency)], results[('scheduler', concurrency)]
+        print('{}\t{:.2f}\t{:.2f}\t{:.2f}x'.format(concurrency, sequential, scheduler, scheduler / sequential))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--num_rounds', type=int, default=2, help='number of requests per concurrent session')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Check TransformerLM decode with forward_chunk_static against forward_chunk, report max diff of prefill and single token steps and tokens/s."""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.transformer.encoder import TransformerEncoder
+
+
+def build_llm(device):
+    # same shape as CosyVoice-300M llm
+    llm = TransformerEncoder(input_size=1024, output_size=1024, attention_heads=16, linear_units=4096, num_blocks=14, dropout_rate=0.1,
+                             positional_dropout_rate=0.1, attention_dropout_rate=0.0, input_layer='linear_legacy',
+                             pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn', static_chunk_size=1)
+    return llm.to(device).eval()
+
+
+def chunk_step(llm, lm_input, offset, cache):
+    # same call as TransformerLM.inference without static cache
+    att_cache, cnn_cache = cache
+    att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool)
+    y_pred, att_cache, cnn_cache = llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1, att_cache=att_cache, cnn_cache=cnn_cache,
+                                                     att_mask=att_mask)
+    return y_pred, (att_cache, cnn_cache)
+
+
+def static_step(llm, lm_input, offset, cache):
+    return llm.forward_chunk_static(lm_input, offset=offset, att_cache=cache), cache
+
+
+@torch.inference_mode()
+def decode(llm, step, prompt, num_tokens, static):
+    """Prefill prompt, then feed back the last output for num_tokens - 1 steps, return tokens/s, prefill output and step outputs"""
+    if static is True:
+        cache = llm.init_static_cache(prompt.size(1) + num_tokens)
+    else:
+        cache = (torch.zeros((0, 0, 0, 0), device=prompt.device), torch.zeros((0, 0, 0, 0), device=prompt.device))
+    lm_input, offset, outputs = prompt, 0, []
+    for i in range(num_tokens):
+        if i == 1:
+            # exclude prefill
+            if prompt.device.type == 'cuda':
+                torch.cuda.synchronize()
+            start_time = time.time()
+        y_pred, cache = step(llm, lm_input, offset, cache)
+        offset += lm_input.size(1)
+        outputs.append(y_pred)
+        lm_input = y_pred[:, -1:]
+    if prompt.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (num_tokens - 1) / (time.time() - start_time), outputs[0], torch.concat(outputs[1:], dim=1)
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    llm = build_llm(device)
+    torch.manual_seed(0)
+    prompt = torch.randn(1, args.prompt_len, 1024, device=device)
+    # warmup
+    decode(llm, chunk_step, prompt, 10, False)
+    decode(llm, static_step, prompt, 10, True)
+    chunk_speed, chunk_prefill, chunk_steps = decode(llm, chunk_step, prompt, args.num_tokens, False)
+    static_speed, static_prefill, static_steps = decode(llm, static_step, prompt, args.num_tokens, True)
+    prefill_diff = (chunk_prefill - static_prefill).abs().max().item()
+    step_diff = (chunk_steps - static_steps).abs().max().item()
+    assert prefill_diff < args.tolerance, 'static cache prefill mismatch, max diff {}'.format(prefill_diff)
+    assert step_diff < args.tolerance, 'static cache step mismatch, max diff {}'.format(step_diff)
+    print('path\ttokens/s\tprefill max diff\tstep max diff')
+    print('forward_chunk\t{:.1f}\t-\t-'.format(chunk_speed))
+    print('forward_chunk_static\t{:.1f}\t{:.1e}\t{:.1e}'.format(static_speed, prefill_diff, step_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prompt_len', type=int, default=150)
+    parser.add_argument('--num_tokens', type=int, default=300)
+    parser.add_argument('--num_threads', type=int, default=4)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare flow matching rtf of eager pytorch and onnxruntime estimator on cpu.
+
+load_onnx has no published numbers yet, run this on the target cpu to check that onnxruntime is actually faster there.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from omegaconf import DictConfig
+from cosyvoice.flow.decoder import CausalConditionalDecoder
+from cosyvoice.flow.flow_matching import CausalConditionalCFM
+from cosyvoice.utils.common import OnnxSessionWrapper
+from cosyvoice.utils.file_utils import export_estimator_onnx
+
+# 50 mel frames per second of speech in CosyVoice2
+MEL_FRAME_RATE = 50
+
+
+def build_decoder(flow_model):
+    # same shape as CosyVoice2-0.5B flow decoder
+    estimator = CausalConditionalDecoder(in_channels=320, out_channels=80, channels=[256], dropout=0.0, attention_head_dim=64, n_blocks=4,
+                                         num_mid_blocks=12, num_heads=8, act_fn='gelu', static_chunk_size=50, num_decoding_left_chunks=-1)
+    cfm_params = DictConfig({'sigma_min': 1e-06, 'solver': 'euler', 't_scheduler': 'cosine', 'training_cfg_rate': 0.2, 'inference_cfg_rate': 0.7, 'reg_loss_type': 'l1'})
+    decoder = CausalConditionalCFM(240, cfm_params, n_spks=1, spk_emb_dim=80, estimator=estimator)
+    if flow_model != '':
+        state_dict = torch.load(flow_model, map_location='cpu')
+        decoder.load_state_dict({k.replace('decoder.', '', 1): v for k, v in state_dict.items() if k.startswith('decoder.')}, strict=True)
+    return decoder.eval()
+
+
+@torch.inference_mode()
+def benchmark(decoder, batch_size, seq_len, streaming, num_runs):
+    mu = torch.randn(batch_size, 80, seq_len)
+    mask = torch.ones(batch_size, 1, seq_len)
+    spks = torch.randn(batch_size, 80)
+    cond = torch.randn(batch_size, 80, seq_len)
+    # warmup
+    decoder(mu, mask, 10, spks=spks, cond=cond, streaming=streaming)
+    start_time = time.time()
+    for _ in range(num_runs):
+        feat = decoder(mu, mask, 10, spks=spks, cond=cond, streaming=streaming)[0]
+    return (time.time() - start_time) / num_runs / (batch_size * seq_len / MEL_FRAME_RATE), feat
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    decoder = build_decoder(args.flow_model)
+    eager_estimator = decoder.estimator
+    with tempfile.TemporaryDirectory() as onnx_dir:
+        onnx_models = {streaming: '{}/estimator.{}.onnx'.format(onnx_dir, streaming) for streaming in [False, True]}
+        for streaming, onnx_model in onnx_models.items():
+            export_estimator_onnx(eager_estimator, onnx_model, streaming, 'cpu')
+        onnx_estimator = OnnxSessionWrapper(onnx_models)
+        print('batch_size\tmel_len\tstreaming\teager rtf\tonnx rtf\tspeedup\tmax diff')
+        for batch_size in args.batch_size:
+            for seq_len in args.mel_len:
+                for streaming in [False, True]:
+                    del decoder.estimator
+                    decoder.estimator = eager_estimator
+                    eager_rtf, eager_feat = benchmark(decoder, batch_size, seq_len, streaming, args.num_runs)
+                    del decoder.estimator
+                    decoder.estimator = onnx_estimator
+                    onnx_rtf, onnx_feat = benchmark(decoder, batch_size, seq_len, streaming, args.num_runs)
+                    max_diff = (eager_feat - onnx_feat).abs().max().item()
+                    print('{}\t{}\t{}\t{:.3f}\t{:.3f}\t{:.2f}x\t{:.1e}'.format(batch_size, seq_len, streaming, eager_rtf, onnx_rtf, eager_rtf / onnx_rtf, max_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flow_model', type=str, default='', help='flow.pt of CosyVoice2, use random weights if empty')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--mel_len', type=int, nargs='+', default=[100, 500])
+    parser.add_argument('--num_runs', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=4)
+    args = parser.parse_args()
+    main(args)
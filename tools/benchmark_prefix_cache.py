@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure Qwen2LM prefill with and without the [sos, prompt_text] prefix kv cache, report ms, skipped positions and max diff.
+
+llm input is [sos, prompt_text, text, task_id, prompt_speech_token], a cache hit only skips the first 1 + prompt_text_len positions.
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+from transformers import Qwen2Config, Qwen2ForCausalLM
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.llm.llm import Qwen2Encoder
+
+
+def build_llm(pretrain_path):
+    llm = Qwen2Encoder.__new__(Qwen2Encoder)
+    torch.nn.Module.__init__(llm)
+    if pretrain_path != '':
+        llm.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
+    else:
+        # same shape as CosyVoice-BlankEN, with random weights
+        llm.model = Qwen2ForCausalLM(Qwen2Config(vocab_size=151936, hidden_size=896, intermediate_size=4864, num_hidden_layers=24,
+                                                 num_attention_heads=14, num_key_value_heads=2, max_position_embeddings=32768, tie_word_embeddings=True))
+    return llm.eval()
+
+
+def prefill(llm, lm_input, prefix=None):
+    # same as Qwen2LM.inference_wrapper without scheduler, prefix is the legacy kv cache of the positions before lm_input
+    offset = prefix[0][0].size(2) if prefix is not None else 0
+    cache = llm.init_static_cache(offset + lm_input.size(1) + 1, prefix=prefix)
+    return llm.forward_static(lm_input, cache, offset)[:, -1]
+
+
+def timeit(func, num_runs):
+    func()
+    start_time = time.time()
+    for _ in range(num_runs):
+        output = func()
+    return (time.time() - start_time) / num_runs * 1000, output
+
+
+@torch.inference_mode()
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    llm = build_llm(args.pretrain_path)
+    hidden_size = llm.model.config.hidden_size
+    torch.manual_seed(0)
+    print('prompt_text_len\ttext_len\tprompt_speech_len\tskipped positions\tprefill ms\tcached prefill ms\tmax diff')
+    for prompt_text_len in args.prompt_text_len:
+        prefix_len = 1 + prompt_text_len
+        lm_input = torch.randn(1, prefix_len + args.text_len + 1 + args.prompt_speech_len, hidden_size)
+        # cache hit, prefix kv is computed once per prompt, same as Qwen2LM.get_prefix_cache
+        _, prefix = llm.forward_one_step(lm_input[:, :prefix_len], masks=torch.ones((1, 1, prefix_len), dtype=torch.bool), cache=None)
+        prefix = prefix.to_legacy_cache()
+        full_ms, full_output = timeit(lambda: prefill(llm, lm_input), args.num_runs)
+        cached_ms, cached_output = timeit(lambda: prefill(llm, lm_input[:, prefix_len:], prefix), args.num_runs)
+        max_diff = (full_output - cached_output).abs().max().item()
+        assert max_diff < args.tolerance, 'prefix cache mismatch, max diff {}'.format(max_diff)
+        print('{}\t{}\t{}\t{}/{}\t{:.2f}\t{:.2f}\t{:.1e}'.format(prompt_text_len, args.text_len, args.prompt_speech_len, prefix_len, lm_input.size(1),
+                                                                 full_ms, cached_ms, max_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pretrain_path', type=str, default='', help='CosyVoice-BlankEN dir, use random weights if empty')
+    parser.add_argument('--prompt_text_len', type=int, nargs='+', default=[10, 30, 60])
+    parser.add_argument('--text_len', type=int, default=30)
+    parser.add_argument('--prompt_speech_len', type=int, default=150, help='prompt speech token number, 25 tokens per second')
+    parser.add_argument('--num_threads', type=int, default=4)
+    parser.add_argument('--num_runs', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.utils.common import ras_sampling
+from cosyvoice.utils.sampling import TokenHistory, mask_eos
+
+
+def legacy_nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
+    prob, indices = [], []
+    cum_prob = 0.0
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+    for i in range(len(sorted_idx)):
+        if cum_prob < top_p and len(prob) < top_k:
+            cum_prob += sorted_value[i]
+            prob.append(sorted_value[i])
+            indices.append(sorted_idx[i])
+        else:
+            break
+    prob = torch.tensor(prob).to(weighted_scores)
+    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
+    return indices[prob.multinomial(1, replacement=True)]
+
+
+def legacy_ras_sampling(weighted_scores, decoded_tokens, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    top_ids = legacy_nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
+    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    if rep_num >= win_size * tau_r:
+        top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    return top_ids
+
+
+def legacy_sampling_ids(weighted_scores, decoded_tokens, eos_id, ignore_eos):
+    # old sampling_ids resamples until it does not get eos
+    while True:
+        top_ids = legacy_ras_sampling(weighted_scores, decoded_tokens)
+        if (not ignore_eos) or (eos_id not in top_ids):
+            return top_ids
+
+
+def legacy_step(logp, out_tokens, eos_id, ignore_eos):
+    top_ids = [legacy_sampling_ids(logp[i], out_tokens[i], eos_id, ignore_eos).item() for i in range(logp.size(0))]
+    for i in range(logp.size(0)):
+        out_tokens[i].append(top_ids[i])
+    return top_ids
+
+
+def batched_step(logp, history, eos_id, ignore_eos):
+    top_ids = ras_sampling(mask_eos(logp, eos_id, ignore_eos), history, 25)
+    history.append(top_ids)
+    return top_ids.tolist()
+
+
+def benchmark(fn, logits, state, eos_id, num_steps, device):
+    start_time = time.time()
+    for i in range(num_steps):
+        logp = logits[i % logits.size(0)].log_softmax(dim=-1)
+        fn(logp, state, eos_id, i < num_steps // 2)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / num_steps
+
+
+def main(args):
+    device = torch.device(args.device)
+    eos_id = args.vocab_size - 3
+    print('batch_size\tlegacy(ms/step)\tbatched(ms/step)\tspeedup')
+    for batch_size in args.batch_size:
+        # peaky logits, similar to a trained llm
+        logits = torch.randn(16, batch_size, args.vocab_size, device=device) * 4
+        legacy_state = [torch.randint(0, eos_id, (args.history_len,)).tolist() for _ in range(batch_size)]
+        history = TokenHistory(batch_size, device=device)
+        for token in torch.randint(0, eos_id, (args.history_len, batch_size), device=device):
+            history.append(token)
+        legacy = benchmark(legacy_step, logits, legacy_state, eos_id, args.num_steps, device)
+        batched = benchmark(batched_step, logits, history, eos_id, args.num_steps, device)
+        print('{}\t{:.3f}\t{:.3f}\t{:.1f}x'.format(batch_size, legacy * 1000, batched * 1000, legacy / batched))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--vocab_size', type=int, default=6564)
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--history_len', type=int, default=100)
+    parser.add_argument('--num_steps', type=int, default=200)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Check that a seeded session samples the same tokens alone and in a batch of other sessions, report per step cost of seeded sampling."""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.utils.common import ras_sampling, get_generators
+from cosyvoice.utils.sampling import TokenHistory
+
+
+def decode(logits, seeds, device):
+    """Sample logits [num_steps, B, V] step by step, row i draws from the llm stream of seeds[i], None rows use global rng"""
+    generator = [get_generators(i, device)['llm'] if i is not None else None for i in seeds]
+    if all(i is None for i in generator):
+        generator = None
+    history = TokenHistory(len(seeds), device=device)
+    tokens = []
+    for step_logits in logits:
+        top_ids = ras_sampling(step_logits.log_softmax(dim=-1), history, 25, generator=generator)
+        history.append(top_ids)
+        tokens.append(top_ids)
+    return torch.stack(tokens, dim=1)
+
+
+def timeit(logits, seeds, device):
+    start_time = time.time()
+    decode(logits, seeds, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / logits.size(0) * 1000
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    print('batch_size\tglobal rng(ms/step)\tseeded(ms/step)\tbatch invariant')
+    for batch_size in args.batch_size:
+        # peaky logits, similar to a trained llm
+        logits = torch.randn(args.num_steps, batch_size, args.vocab_size, device=device) * 4
+        seeds = list(range(batch_size))
+        batched = decode(logits, seeds, device)
+        # every row decoded alone with its own seed, and again in a batch where the other rows use global rng
+        alone = torch.concat([decode(logits[:, i:i + 1], [seeds[i]], device) for i in range(batch_size)], dim=0)
+        mixed = decode(logits, [seeds[0]] + [None] * (batch_size - 1), device)[:1]
+        invariant = torch.equal(batched, alone) and torch.equal(mixed, alone[:1])
+        assert invariant is True, 'seeded sampling depends on other sessions of the batch'
+        print('{}\t{:.3f}\t{:.3f}\t{}'.format(batch_size, timeit(logits, [None] * batch_size, device), timeit(logits, seeds, device), invariant))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--vocab_size', type=int, default=6564)
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--num_steps', type=int, default=200)
+    args = parser.parse_args()
+    main(args)
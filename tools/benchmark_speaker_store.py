@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare spk2info.pt and SpeakerStore with many zero-shot speakers, report load time, rss and lookup latency."""
+import argparse
+import copy
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.cli.speaker_store import SpeakerStore
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def fake_speaker(prompt_seconds):
+    # same keys and shapes as frontend_zero_shot output of CosyVoice2, 25 speech tokens and 50 mel frames per second
+    prompt_text = torch.randint(0, 151643, (1, 5 * prompt_seconds), dtype=torch.int32)
+    speech_token = torch.randint(0, 6561, (1, 25 * prompt_seconds), dtype=torch.int32)
+    speech_feat = torch.randn(1, 50 * prompt_seconds, 80)
+    embedding = torch.randn(1, 192)
+    return {'prompt_text': prompt_text, 'prompt_text_len': torch.tensor([prompt_text.shape[1]], dtype=torch.int32),
+            'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': torch.tensor([speech_token.shape[1]], dtype=torch.int32),
+            'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': torch.tensor([speech_token.shape[1]], dtype=torch.int32),
+            'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': torch.tensor([speech_feat.shape[1]], dtype=torch.int32),
+            'llm_embedding': embedding, 'flow_embedding': embedding}
+
+
+def lookup_ms(spk2info, spk_ids, num_lookups):
+    start_time = time.time()
+    for _ in range(num_lookups):
+        spk2info[random.choice(spk_ids)]['flow_embedding']
+    return (time.time() - start_time) / num_lookups * 1000
+
+
+def main(args):
+    random.seed(0)
+    torch.manual_seed(0)
+    work_dir = args.work_dir if args.work_dir != '' else tempfile.mkdtemp()
+    legacy_path, store_dir = os.path.join(work_dir, 'spk2info.pt'), os.path.join(work_dir, 'spk2info')
+    spk_ids = ['spk{}'.format(i) for i in range(args.num_spks)]
+    if not os.path.exists(legacy_path):
+        # NOTE speakers share one fake entry to keep setup fast, every entry is still saved on its own
+        spk2info = {i: fake_speaker(args.prompt_seconds) for i in spk_ids[:100]}
+        spk2info = {i: spk2info[spk_ids[j % 100]] for j, i in enumerate(spk_ids)}
+        torch.save({k: copy.deepcopy(v) for k, v in spk2info.items()}, legacy_path)
+        start_time = time.time()
+        store = SpeakerStore(store_dir)
+        for spk_id, value in spk2info.items():
+            store.add(spk_id, value)
+        store.flush()
+        print('add {} speakers to store: {:.2f}s'.format(args.num_spks, time.time() - start_time))
+        del spk2info, store
+        gc.collect()
+    # cold lookups pick any speaker, hot lookups only pick the first hot_spks speakers, which fit in store device cache
+    hot_ids = spk_ids[:args.hot_spks]
+    print('format\tload s\trss mb\tcold lookup ms\thot lookup ms')
+    base_rss, start_time = rss_mb(), time.time()
+    store = SpeakerStore(store_dir, cache_size=args.hot_spks)
+    load_time, load_rss = time.time() - start_time, rss_mb() - base_rss
+    cold_ms, hot_ms = lookup_ms(store, spk_ids, args.num_lookups), lookup_ms(store, hot_ids, args.num_lookups)
+    print('store\t{:.3f}\t{:.1f}\t{:.3f}\t{:.3f}'.format(load_time, load_rss, cold_ms, hot_ms))
+    print('store stats {}, rss after lookups {:.1f} mb'.format(store.stats(), rss_mb() - base_rss))
+    del store
+    gc.collect()
+    base_rss, start_time = rss_mb(), time.time()
+    spk2info = torch.load(legacy_path, map_location='cpu')
+    load_time, load_rss = time.time() - start_time, rss_mb() - base_rss
+    cold_ms, hot_ms = lookup_ms(spk2info, spk_ids, args.num_lookups), lookup_ms(spk2info, hot_ids, args.num_lookups)
+    print('spk2info.pt\t{:.3f}\t{:.1f}\t{:.3f}\t{:.3f}'.format(load_time, load_rss, cold_ms, hot_ms))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_spks', type=int, default=10000)
+    parser.add_argument('--prompt_seconds', type=int, default=6)
+    parser.add_argument('--hot_spks', type=int, default=64)
+    parser.add_argument('--num_lookups', type=int, default=1000)
+    parser.add_argument('--work_dir', type=str, default='', help='reuse spk2info.pt and store of a previous run, use a temporary dir if empty')
+    args = parser.parse_args()
+    main(args)
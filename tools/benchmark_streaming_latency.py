@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import sys
+import time
+import numpy as np
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice2
+from cosyvoice.utils.file_utils import load_wav, logging
+
+
+def single_job(cosyvoice, tts_text, prompt_text, prompt_speech_16k):
+    """Return time to first audio and gaps between consecutive chunks of one streaming request."""
+    start_time = time.time()
+    chunk_times = []
+    for _ in cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, stream=True, text_frontend=False):
+        chunk_times.append(time.time())
+    return chunk_times[0] - start_time, np.diff(chunk_times).tolist()
+
+
+def main(args):
+    cosyvoice = CosyVoice2(args.model_dir)
+    prompt_speech_16k = load_wav(args.prompt_wav, 16000)
+    # warmup
+    single_job(cosyvoice, args.tts_text, args.prompt_text, prompt_speech_16k)
+
+    ttfa, gaps = [], []
+    for i in range(args.num_requests):
+        this_ttfa, this_gaps = single_job(cosyvoice, args.tts_text, args.prompt_text, prompt_speech_16k)
+        logging.info('request {} ttfa {:.3f}s chunks {}'.format(i, this_ttfa, len(this_gaps) + 1))
+        ttfa.append(this_ttfa)
+        gaps.extend(this_gaps)
+    print('metric\tmean(ms)\tp50(ms)\tp90(ms)')
+    for name, value in [('time to first audio', ttfa), ('inter chunk latency', gaps)]:
+        value = np.array(value) * 1000
+        print('{}\t{:.1f}\t{:.1f}\t{:.1f}'.format(name, value.mean(), np.percentile(value, 50), np.percentile(value, 90)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--prompt_wav', type=str, default='asset/zero_shot_prompt.wav')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--num_requests', type=int, default=10)
+    args = parser.parse_args()
+    main(args)